@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 # predict_with_hf_model.py
 
+import os
 from transformers import pipeline
+from model_registry import register_model, get_model
+import prediction_cache
+from metrics import timed, observe, BATCH_SIZE_BUCKETS
 
 # 1) Installez si besoin :
 #    pip install transformers torch
@@ -17,20 +21,114 @@ MODELS = [
 # 3) Choisissez le modèle à utiliser (ici GoEmotions)
 selected_model = MODELS[0]
 
-# 4) Créez la pipeline en récupérant toutes les étiquettes hzea zj
-pipe = pipeline(
-    "text-classification",
-    model=selected_model,
-    tokenizer=selected_model,
-    #top_k= 3  #return_all_scores=True 
-    return_all_scores=True
-)
+# 4) Créez les pipelines (toutes les étiquettes, top_k=None), une seule fois par
+#    processus via le registre (au premier appel ou pendant le warmup).
+#    Chaque modèle de MODELS est enregistré, mais n'est chargé que s'il est utilisé.
+EMOTION_BATCH_SIZE = 32
 
+def registry_name(model: str):
+    return f"emotion:{model}"
 
-def predict_sentiment(text: str):
+MODEL_NAME = registry_name(selected_model)
+# Version des prédictions enregistrées (post_predictions) : à changer si le modèle change
+MODEL_VERSION = os.getenv("EMOTION_MODEL_VERSION", selected_model)
+
+def load_emotion_pipeline(model: str = selected_model):
+    return pipeline(
+        "text-classification",
+        model=model,
+        tokenizer=model,
+        top_k=None
+    )
+
+for _model in MODELS:
+    register_model(registry_name(_model), lambda model=_model: load_emotion_pipeline(model))
+
+
+# Passe avant du pipeline, mesurée (durée + tailles des lots envoyés au modèle)
+def _run_pipeline(pipe, texts, model, batch_size):
+    for start in range(0, len(texts), batch_size):
+        observe("inference_batch_size", len(texts[start:start + batch_size]), BATCH_SIZE_BUCKETS,
+                model=registry_name(model))
+    with timed(f"model_forward.{registry_name(model)}"):
+        return list(pipe(texts, batch_size=batch_size, truncation=True))
+
+
+def _top_k(scores, top_k):
+    scores = sorted(scores, key=lambda x: x["score"], reverse=True)
+    return scores[:top_k] if top_k else scores
+
+
+# Scores par label, format des scores enregistrés dans post_predictions
+def scores_by_label(scores):
+    return {score["label"]: float(score["score"]) for score in scores}
+
+
+def predict_sentiment(text: str, use_cache: bool = True):
     # on récupère une liste de dicts : [{"label": "...", "score": ...}, ...]
-    scores = pipe(text)[0]
-    return scores
+    return predict_sentiments([text], use_cache=use_cache)[0]
+
+
+def predict_sentiments(texts: list, use_cache: bool = True, model: str = selected_model,
+                       batch_size: int = EMOTION_BATCH_SIZE, top_k: int = None):
+    # un seul appel à la pipeline pour toute la liste (par lots de batch_size, textes
+    # tronqués à la longueur max du modèle) : une liste de scores par texte.
+    # Le cache est indexé sur le texte tel que la pipeline le reçoit (texte brut : URL et
+    # mentions comprises) ; seuls les textes absents du cache sont envoyés à la pipeline.
+    # top_k ne garde que les k meilleurs labels.
+    texts = list(texts)
+    if not texts:
+        return []
+    pipe = get_model(registry_name(model))
+    if not use_cache:
+        return [_top_k(scores, top_k) for scores in _run_pipeline(pipe, texts, model, batch_size)]
+
+    results = [None] * len(texts)
+    for i, scores in prediction_cache.get_many(model, texts).items():
+        results[i] = scores
+    missing = {}
+    for i, scores in enumerate(results):
+        if scores is None:
+            missing.setdefault(texts[i], []).append(i)
+    if missing:
+        computed = _run_pipeline(pipe, list(missing), model, batch_size)
+        for indices, scores in zip(missing.values(), computed):
+            for i in indices:
+                results[i] = scores
+        prediction_cache.put_many(model, list(missing), computed)
+    return [_top_k(scores, top_k) for scores in results]
+
+
+# Passe plusieurs modèles de MODELS sur le même lot de textes ; renvoie, pour chaque
+# texte, un dict {modèle: scores}
+def score_emotions(texts: list, models: list = None, batch_size: int = EMOTION_BATCH_SIZE,
+                   top_k: int = None, use_cache: bool = True):
+    texts = list(texts)
+    models = models or [selected_model]
+    merged = [{} for _ in texts]
+    for model in models:
+        all_scores = predict_sentiments(texts, use_cache=use_cache, model=model,
+                                        batch_size=batch_size, top_k=top_k)
+        for result, scores in zip(merged, all_scores):
+            result[model] = scores
+    return merged
+
+
+# Annote des pages de posts au fil de l'eau avec l'émotion principale et tous les scores
+# (store=True : enregistrées aussi dans post_predictions)
+def predict_sentiment_pages(pages, text_key: str = "text", batch_size: int = EMOTION_BATCH_SIZE,
+                            store: bool = False):
+    for page in pages:
+        if not len(page):
+            continue
+        all_scores = predict_sentiments([text or "" for text in page[text_key]], batch_size=batch_size)
+        page["sentiment"] = [max(scores, key=lambda x: x["score"])["label"] for scores in all_scores]
+        page["emotion_scores"] = all_scores
+        if store:
+            from predictions import save_page_predictions
+            save_page_predictions(page, MODEL_NAME, MODEL_VERSION, page["sentiment"].tolist(),
+                                  [scores_by_label(scores) for scores in all_scores])
+        yield page
 
 if __name__ == "__main__":
     tweet = input("Entrez un tweet à tester : ")
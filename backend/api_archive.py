@@ -0,0 +1,356 @@
+import argparse
+import atexit
+import glob
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+from collections import Counter
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from metrics import timed, inc
+
+# Enregistrement et rejeu des réponses de l'API Bluesky.
+# - Enregistrement (BLUESKY_RECORD_DIR) : chaque appel de collector._call_api ajoute la réponse
+#   brute (JSON de l'API, avant normalisation : rien n'est perdu si un post est ignoré) à une
+#   archive JSONL compressée (gzip), découpée en morceaux de BLUESKY_ARCHIVE_CHUNK_RECORDS
+#   réponses. Un morceau est écrit sous un nom ".part" puis renommé une fois fermé (un ".part"
+#   laissé par un arrêt brutal reste lisible jusqu'à sa dernière ligne complète).
+# - Rejeu par client (BLUESKY_REPLAY_DIR) : get_client() renvoie un ReplayClient qui répond aux
+#   mêmes appels (endpoint + paramètres) avec les réponses enregistrées, sans réseau ni quota :
+#   collecteurs, imports et benchmarks s'exécutent à l'identique et de façon déterministe.
+# - Ré-ingestion : python api_archive.py reingest <archive> repasse toutes les pages
+#   enregistrées par la normalisation (records) et l'insertion (db.ingest_posts), en lots de
+#   REPLAY_BATCH_ROWS posts, avec collected_at = date de l'enregistrement.
+# Une ligne d'archive : {"t": date, "endpoint": ..., "params": {...}, "format": "model"|"plain",
+# "response": {...}} ; "model" = modèle atproto sérialisé par alias (format de l'API).
+
+BLUESKY_RECORD_DIR = os.getenv("BLUESKY_RECORD_DIR")
+BLUESKY_REPLAY_DIR = os.getenv("BLUESKY_REPLAY_DIR")
+BLUESKY_ARCHIVE_CHUNK_RECORDS = int(os.getenv("BLUESKY_ARCHIVE_CHUNK_RECORDS", "500"))
+REPLAY_BATCH_ROWS = int(os.getenv("REPLAY_BATCH_ROWS", "5000"))
+CHUNK_SUFFIX = ".jsonl.gz"
+
+# Endpoint -> source des posts ("search", "user", "single") pour la ré-ingestion
+POST_ENDPOINTS = {"search_posts": "search", "get_author_feed": "user", "get_post_thread": "single"}
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def _response_models():
+    from atproto import models
+    return {
+        "search_posts": models.AppBskyFeedSearchPosts.Response,
+        "get_author_feed": models.AppBskyFeedGetAuthorFeed.Response,
+        "get_profile": models.AppBskyActorDefs.ProfileViewDetailed,
+        "resolve_handle": models.ComAtprotoIdentityResolveHandle.Response,
+        "get_post_thread": models.AppBskyFeedGetPostThread.Response,
+    }
+
+
+# Objet quelconque -> JSON : modèles atproto (pydantic) au format de l'API, sinon attributs
+def _plain(value):
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    if isinstance(value, dict):
+        return {key: _plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(item) for item in value]
+    if hasattr(value, "__dict__"):
+        return {key: _plain(item) for key, item in vars(value).items() if not key.startswith("_")}
+    return str(value)
+
+
+def _serialize(response):
+    if hasattr(response, "model_dump"):
+        return "model", response.model_dump(mode="json", by_alias=True, exclude_none=True)
+    return "plain", _plain(response)
+
+
+def _namespace(value):
+    if isinstance(value, dict):
+        return SimpleNamespace(**{key: _namespace(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return [_namespace(item) for item in value]
+    return value
+
+
+# Ligne d'archive -> objet réponse équivalent à celui du client atproto
+def load_response(record):
+    if record.get("format") == "model":
+        from atproto_client.models.utils import get_or_create
+        return get_or_create(record["response"], _response_models()[record["endpoint"]], strict=False)
+    return _namespace(record["response"])
+
+
+# Paramètres -> clé de recherche (paramètres absents et None confondus)
+def _params_key(params):
+    return json.dumps({key: value for key, value in (params or {}).items() if value is not None}, sort_keys=True)
+
+
+class ArchiveWriter:
+    def __init__(self, directory, chunk_records=BLUESKY_ARCHIVE_CHUNK_RECORDS):
+        self.directory = directory
+        self.chunk_records = chunk_records
+        self._file = None
+        self._path = None
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _open_chunk(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # Noms triables dans l'ordre d'écriture, uniques entre processus
+        name = f"chunk-{time.time_ns():020d}-{os.getpid()}{CHUNK_SUFFIX}"
+        self._path = os.path.join(self.directory, name)
+        self._file = gzip.open(f"{self._path}.part", "wt", encoding="utf-8")
+        self._count = 0
+
+    def _close_chunk(self):
+        if self._file is None:
+            return
+        self._file.close()
+        os.rename(f"{self._path}.part", self._path)
+        self._file = None
+
+    def write(self, endpoint, params, response):
+        response_format, payload = _serialize(response)
+        line = json.dumps({
+            "t": datetime.now(timezone.utc).isoformat(),
+            "endpoint": endpoint,
+            "params": params,
+            "format": response_format,
+            "response": payload,
+        }, ensure_ascii=False, separators=(",", ":"), default=str)
+        with self._lock:
+            if self._file is None:
+                self._open_chunk()
+            self._file.write(line + "\n")
+            self._count += 1
+            if self._count >= self.chunk_records:
+                self._close_chunk()
+        inc("bluesky_responses_recorded_total", endpoint=endpoint)
+
+    def close(self):
+        with self._lock:
+            self._close_chunk()
+
+
+def start_recording(directory=None):
+    global _recorder
+    with _recorder_lock:
+        if _recorder is None:
+            _recorder = ArchiveWriter(directory or BLUESKY_RECORD_DIR)
+            print(f"✅ Enregistrement des réponses Bluesky dans {_recorder.directory}")
+        return _recorder
+
+
+def stop_recording():
+    global _recorder
+    with _recorder_lock:
+        if _recorder is not None:
+            _recorder.close()
+            _recorder = None
+
+
+atexit.register(stop_recording)
+
+
+# Appelé par collector._call_api après chaque réponse (sauf en rejeu : rien de nouveau à archiver)
+def record_response(endpoint, params, response):
+    recorder = _recorder
+    if recorder is None:
+        if not BLUESKY_RECORD_DIR or BLUESKY_REPLAY_DIR:
+            return
+        recorder = start_recording()
+    recorder.write(endpoint, params, response)
+
+
+def chunk_paths(path):
+    if os.path.isfile(path):
+        return [path]
+    paths = glob.glob(os.path.join(path, f"*{CHUNK_SUFFIX}")) + glob.glob(os.path.join(path, f"*{CHUNK_SUFFIX}.part"))
+    return sorted(paths, key=os.path.basename)
+
+
+# Lignes d'une archive (répertoire ou fichier), dans l'ordre d'enregistrement.
+# Un morceau tronqué (arrêt brutal) est lu jusqu'à la dernière ligne complète.
+def iter_records(path):
+    for chunk in chunk_paths(path):
+        try:
+            with gzip.open(chunk, "rt", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+        except (EOFError, gzip.BadGzipFile, zlib.error, json.JSONDecodeError) as e:
+            print(f"⚠️ Morceau d'archive tronqué, lu partiellement : {chunk} ({e})")
+
+
+# Client de rejeu : mêmes méthodes que le client atproto utilisé par le collecteur.
+# Plusieurs réponses pour les mêmes paramètres sont rendues dans l'ordre d'enregistrement
+# (puis la dernière est répétée).
+class ReplayClient:
+    def __init__(self, path):
+        self.path = path
+        self._responses = {}
+        self._served = Counter()
+        self._lock = threading.Lock()
+        for record in iter_records(path):
+            key = (record["endpoint"], _params_key(record["params"]))
+            self._responses.setdefault(key, []).append(record)
+        self.app = SimpleNamespace(bsky=SimpleNamespace(
+            feed=SimpleNamespace(
+                search_posts=self._endpoint("search_posts"),
+                get_author_feed=self._endpoint("get_author_feed"),
+                get_post_thread=self._endpoint("get_post_thread"),
+            ),
+            actor=SimpleNamespace(get_profile=self._endpoint("get_profile")),
+        ))
+        self.com = SimpleNamespace(atproto=SimpleNamespace(identity=SimpleNamespace(
+            resolve_handle=self._endpoint("resolve_handle"),
+        )))
+
+    def __len__(self):
+        return sum(len(records) for records in self._responses.values())
+
+    # Nombre d'appels servis
+    @property
+    def calls(self):
+        return sum(self._served.values())
+
+    def _endpoint(self, endpoint):
+        def call(params):
+            return self.replay(endpoint, params)
+        return call
+
+    def replay(self, endpoint, params):
+        key = (endpoint, _params_key(params))
+        records = self._responses.get(key)
+        if not records:
+            raise LookupError(f"Aucune réponse enregistrée pour {endpoint} {_params_key(params)}")
+        with self._lock:
+            index = min(self._served[key], len(records) - 1)
+            self._served[key] += 1
+        inc("bluesky_responses_replayed_total", endpoint=endpoint)
+        return load_response(records[index])
+
+
+_replay_clients = {}
+
+
+# Client de rejeu partagé pour une archive (utilisé par bluesky_session.get_client)
+def get_replay_client(path=None):
+    path = path or BLUESKY_REPLAY_DIR
+    with _recorder_lock:
+        if path not in _replay_clients:
+            _replay_clients[path] = ReplayClient(path)
+            print(f"✅ Rejeu de {len(_replay_clients[path])} réponse(s) Bluesky depuis {path}")
+        return _replay_clients[path]
+
+
+# Pages de posts (source, PostBatch) d'une archive, normalisées comme à la collecte.
+# Les fils d'un compte reprennent le profil enregistré juste avant (get_profile).
+def iter_pages(path, sources=None):
+    from records import normalize_post_views, normalize_profile
+    from db import with_profile
+    profiles = {}
+    for record in iter_records(path):
+        endpoint = record["endpoint"]
+        if endpoint == "get_profile":
+            response = load_response(record)
+            profiles[record["params"].get("actor")] = normalize_profile(response)
+            continue
+        source = POST_ENDPOINTS.get(endpoint)
+        if source is None or (sources and source not in sources):
+            continue
+        response = load_response(record)
+        collected_at = datetime.fromisoformat(record["t"])
+        with timed("collector_normalization"):
+            if endpoint == "search_posts":
+                page = normalize_post_views(getattr(response, "posts", []) or [], collected_at)
+            elif endpoint == "get_author_feed":
+                page = normalize_post_views((item.post for item in response.feed), collected_at)
+                profile = profiles.get(record["params"].get("actor"))
+                if profile is not None:
+                    page = with_profile(profile, page)
+            else:
+                page = normalize_post_views([response.thread.post], collected_at)
+        if len(page):
+            yield source, page
+
+
+# Ré-insère les posts d'une archive dans les trois tables (lots de batch_rows posts par table)
+def reingest(path, sources=None, batch_rows=REPLAY_BATCH_ROWS):
+    from db import (
+        ingest_posts, SEARCH_POSTS_COLUMNS, USER_POSTS_COLUMNS, SINGLE_POSTS_COLUMNS,
+        POST_AUTHOR_COLUMNS, PROFILE_AUTHOR_COLUMNS,
+    )
+    from records import PostBatch
+    targets = {
+        "search": ("bluesky_search_posts", SEARCH_POSTS_COLUMNS, POST_AUTHOR_COLUMNS),
+        "user": ("bluesky_user_posts", USER_POSTS_COLUMNS, PROFILE_AUTHOR_COLUMNS),
+        "single": ("bluesky_single_posts", SINGLE_POSTS_COLUMNS, POST_AUTHOR_COLUMNS),
+    }
+    buffers = {source: [] for source in targets}
+    totals = {source: Counter() for source in targets}
+    start = time.perf_counter()
+
+    def flush(source):
+        if not buffers[source]:
+            return
+        table, columns, author_columns = targets[source]
+        result = ingest_posts(table, columns, PostBatch.concat(buffers[source]), author_columns)
+        totals[source].update({key: result[key] for key in ("inserted", "skipped", "rejected")})
+        buffers[source] = []
+
+    for source, page in iter_pages(path, sources):
+        buffers[source].append(page)
+        totals[source]["pages"] += 1
+        if sum(len(batch) for batch in buffers[source]) >= batch_rows:
+            flush(source)
+    for source in targets:
+        flush(source)
+
+    seconds = time.perf_counter() - start
+    for source, counts in totals.items():
+        if counts["pages"]:
+            print(f"✅ {source} : {counts['inserted']} post(s) inséré(s) depuis {counts['pages']} page(s) "
+                  f"({counts['skipped']} déjà présent(s), {counts['rejected']} rejeté(s)).")
+    print(f"✅ Archive rejouée en {seconds:.1f}s.")
+    return {source: dict(counts) for source, counts in totals.items() if counts["pages"]}
+
+
+# Contenu d'une archive : morceaux, taille et réponses par endpoint
+def archive_stats(path):
+    chunks = chunk_paths(path)
+    endpoints = Counter(record["endpoint"] for record in iter_records(path))
+    return {
+        "chunks": len(chunks),
+        "bytes": sum(os.path.getsize(chunk) for chunk in chunks),
+        "responses": sum(endpoints.values()),
+        "endpoints": dict(endpoints),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Archives des réponses de l'API Bluesky")
+    sub = parser.add_subparsers(dest="command", required=True)
+    reingest_parser = sub.add_parser("reingest", help="Ré-insère les posts d'une archive dans la base")
+    reingest_parser.add_argument("path")
+    reingest_parser.add_argument("--source", nargs="+", choices=list(POST_ENDPOINTS.values()))
+    reingest_parser.add_argument("--batch-rows", type=int, default=REPLAY_BATCH_ROWS)
+    stats_parser = sub.add_parser("stats", help="Contenu d'une archive")
+    stats_parser.add_argument("path")
+
+    args = parser.parse_args(argv)
+    if args.command == "reingest":
+        reingest(args.path, args.source, args.batch_rows)
+    else:
+        print(json.dumps(archive_stats(args.path), indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,8 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Query
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, List
+from datetime import datetime
 import psycopg
 from collector import (
     search_bluesky_posts,
@@ -8,10 +10,50 @@ from collector import (
     fetch_profile_and_posts,
     fetch_post_from_url
 )
-from db import insert_bluesky_search_posts,insert_bluesky_user_posts,insert_bluesky_single_post 
+from db import ingest_search_posts, ingest_user_posts, ingest_single_posts
+from db import open_pool, close_pool, pool_stats
+from micro_batcher import MicroBatcher
+from bert_finetune import predict_batch, MODEL_NAME as FAKE_NEWS_MODEL, MODEL_ID as FAKE_NEWS_MODEL_ID
+from analyse_des_sentiments import predict_sentiments, MODEL_NAME as EMOTION_MODEL
+from model_registry import warmup, model_stats
+from inference_pool import start_pool, stop_pool, get_pool, pool_stats as inference_pool_stats
+from prediction_cache import cache_stats
+from post_search import search_posts, SearchSchemaMissing
+from import_jobs import submit_job, get_job, list_jobs, cancel_job, start_workers, stop_workers
+from prediction_backfill import start_backfill_worker, stop_backfill_worker, backfill_status
+from near_duplicates import cluster_report, cluster_members
+from parquet_export import export_tables
+from embedding_store import add_claim, list_claims, similar_claims, similar_posts, embedding_stats
+from metrics import timed, inc, start_request_timings, server_timing_header, render
+import asyncio
+import os
 
 app = FastAPI()
 
+# Micro-batching des prédictions : les requêtes concurrentes sont regroupées en un seul lot
+PREDICT_MAX_BATCH_SIZE = int(os.getenv("PREDICT_MAX_BATCH_SIZE", "32"))
+PREDICT_MAX_WAIT_MS = float(os.getenv("PREDICT_MAX_WAIT_MS", "5"))
+
+# Chargement des modèles au démarrage du worker (MODEL_WARMUP=0 pour charger au premier appel)
+MODEL_WARMUP = os.getenv("MODEL_WARMUP", "1") == "1"
+
+fake_news_batcher = MicroBatcher(predict_batch, PREDICT_MAX_BATCH_SIZE, PREDICT_MAX_WAIT_MS)
+emotion_batcher = MicroBatcher(predict_sentiments, PREDICT_MAX_BATCH_SIZE, PREDICT_MAX_WAIT_MS)
+
+# Durée et compteur de chaque requête ; détail par étape dans l'en-tête Server-Timing
+# si le client envoie "X-Timing: 1"
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    timings = start_request_timings()
+    with timed("http_request"):
+        response = await call_next(request)
+    # Gabarit de la route (ex. /jobs/{job_id}) plutôt que le chemin brut, pour borner les labels
+    route = request.scope.get("route")
+    inc("http_requests_total", path=getattr(route, "path", "inconnu"), status=response.status_code)
+    if request.headers.get("x-timing") == "1":
+        response.headers["Server-Timing"] = server_timing_header(timings)
+    return response
+
 class SearchRequest(BaseModel):
     query: str
     limit: int = 100
@@ -24,43 +66,157 @@ class ProfileRequest(BaseModel):
 class TweetRequest(BaseModel):
     tweet_url: str
 
+class TextRequest(BaseModel):
+    text: str
+
+class ClaimRequest(BaseModel):
+    text: str
+    source: Optional[str] = None
+
+class SimilarRequest(BaseModel):
+    text: Optional[str] = None
+    post_uri: Optional[str] = None
+    k: int = 10
+
+# Workers des imports et du rattrapage des prédictions (arrêtés avant la fermeture du pool)
+@app.on_event("startup")
+def start_import_workers():
+    start_workers()
+    start_backfill_worker()
+
+@app.on_event("shutdown")
+def stop_import_workers():
+    stop_workers()
+    stop_backfill_worker()
+
+@app.on_event("startup")
+def start_db_pool():
+    open_pool()
+
+@app.on_event("shutdown")
+def stop_db_pool():
+    close_pool()
+
+# Pool de processus d'inférence (FAKE_NEWS_INFERENCE_WORKERS > 0) : le modèle fake news
+# est alors chargé dans les processus du pool, pas dans le worker de l'API
+@app.on_event("startup")
+async def start_batchers():
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, start_pool)
+    if MODEL_WARMUP:
+        models = [EMOTION_MODEL] if get_pool() else [FAKE_NEWS_MODEL, EMOTION_MODEL]
+        await loop.run_in_executor(None, warmup, models)
+    await fake_news_batcher.start()
+    await emotion_batcher.start()
+
+@app.on_event("shutdown")
+async def stop_batchers():
+    await fake_news_batcher.stop()
+    await emotion_batcher.stop()
+    stop_pool()
+
 @app.get("/")
 def read_root():
     return {"message": "Welcome to the Bluesky Import API"}
 
+@app.get("/db/pool")
+def get_db_pool():
+    return pool_stats()
+
+@app.get("/models")
+def get_models():
+    return {**model_stats(), "inference_pool": inference_pool_stats()}
+
+@app.get("/predictions/backfill")
+def get_prediction_backfill():
+    return backfill_status()
+
+# Clusters de quasi-doublons les plus gros (signal de campagne) et leurs posts
+@app.get("/clusters")
+def get_clusters(min_size: int = 2, limit: int = Query(50, le=500)):
+    return cluster_report(min_size, limit)
+
+@app.get("/clusters/{cluster_id}")
+def get_cluster(cluster_id: int, limit: int = Query(100, le=1000)):
+    members = cluster_members(cluster_id, limit)
+    if not members:
+        raise HTTPException(status_code=404, detail="Cluster introuvable")
+    return {"cluster_id": cluster_id, "posts": members}
+
+# Fausses informations connues et recherche par similarité (embeddings du modèle fake news) :
+# requête par texte libre ou par post_uri d'un post déjà encodé (rattrapage des prédictions)
+@app.post("/claims", status_code=201)
+def create_claim(data: ClaimRequest):
+    return add_claim(data.text, data.source)
+
+@app.get("/claims")
+def get_claims(limit: int = Query(100, le=1000)):
+    return list_claims(limit)
+
+@app.post("/similar/claims")
+def find_similar_claims(data: SimilarRequest):
+    try:
+        return similar_claims(data.text, data.post_uri, min(data.k, 100))
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/similar/posts")
+def find_similar_posts(data: SimilarRequest):
+    try:
+        return similar_posts(data.text, data.post_uri, min(data.k, 100))
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/embeddings")
+def get_embeddings():
+    return embedding_stats()
+
+@app.get("/predict/cache")
+def get_prediction_cache_stats():
+    return cache_stats()
+
+# Export Prometheus : compteurs et histogrammes + état du pool, du cache et des modèles
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    gauges = {f"db_pool_{k}": v for k, v in pool_stats().items()}
+    gauges.update({f"prediction_cache_{k}": v for k, v in cache_stats().items()})
+    gauges["process_rss_mb"] = model_stats()["process_rss_mb"]
+    for memory in inference_pool_stats().get("processes", []):
+        for key in ("rss_mb", "pss_mb", "shared_mb"):
+            if key in memory:
+                gauges.setdefault(f"inference_worker_{key}", []).append(({"worker": memory["worker"]}, memory[key]))
+    return render(gauges)
+
+@app.post("/predict/fake_news")
+async def predict_fake_news(data: TextRequest):
+    try:
+        label, probs = await fake_news_batcher.submit(data.text)
+        return {"text": data.text, "fake_news": label, "probabilities": [float(p) for p in probs]}
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/predict/emotion")
+async def predict_emotion(data: TextRequest):
+    try:
+        scores = await emotion_batcher.submit(data.text)
+        top = max(scores, key=lambda x: x["score"])
+        return {"text": data.text, "sentiment": top["label"], "scores": scores}
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Les imports collectent d'abord les posts (lots colonnaires), puis les écrivent en une
+# seule transaction : auteurs distincts upsertés une fois, posts insérés par COPY.
 @app.post("/import/search")
 def import_search(data: SearchRequest):
     try:
         posts = search_bluesky_posts(data.query, data.limit, data.lang)
-        inserted = 0
-        users_seen = set()
-        for post in posts:
-            # insérer user si pas déjà vu (pour limiter les requêtes, tu peux faire plus complexe)
-            user_tuple = (post['did'], post['handle'])
-            if user_tuple not in users_seen:
-                user_data = {k: post[k] for k in [
-                    'did','handle','displayname','bio','followerscount','followscount','postscount',
-                    'createdat_profile','indexedat_profile','viewer_muted','viewer_following',
-                    'viewer_blockedby','labels','collectedat'
-                ]}
-                insert_bluesky_search_posts(user_data)
-                users_seen.add(user_tuple)
-            # insérer tweet
-            post_data = {k: post[k] for k in [
-                'post_uri','post_cid','did','post_url','text','createdat_post','indexedat_post',
-                'embed','likecount','repostcount','replycount','collectedat'
-            ]}
-            for key in post_data:
-                if post_data[key] == "":
-                    post_data[key] = None
-
-            insert_bluesky_search_posts(post_data)
-            inserted += 1
-        return {"inserted": inserted}
+        return {"query": data.query, "collected": len(posts), **ingest_search_posts(posts)}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
-    
-
 
 @app.post("/import/profile")
 def import_profile(data: ProfileRequest):
@@ -69,23 +225,94 @@ def import_profile(data: ProfileRequest):
         if not handle:
             raise ValueError("URL de profil invalide")
         user, posts = fetch_profile_and_posts(handle, data.limit)
-        insert_bluesky_user_posts(user)
-        for post in posts:
-            insert_bluesky_user_posts(post)
-        return {"user": user["handle"], "posts_inserted": len(posts)}
+        return {"user": user["handle"], "collected": len(posts), **ingest_user_posts(user, posts)}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/import/tweet_url")
 def import_tweet_url(data: TweetRequest):
     try:
-        post = fetch_post_from_url(data.tweet_url)
-        for key in post:
-            if post[key] == "":
-                post[key] = None
-        insert_bluesky_single_post(post)
-        return {"tweet_uri": post["post_uri"], "inserted": True}
+        posts = fetch_post_from_url(data.tweet_url)
+        if not len(posts):
+            raise ValueError("Post introuvable ou illisible")
+        return {"tweet_uri": posts["post_uri"][0], **ingest_single_posts(posts)}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+# Imports asynchrones : le job est enregistré et son identifiant renvoyé immédiatement ;
+# GET /jobs/{job_id} donne la progression (pages, lignes insérées, erreurs, ETA).
+# Collecte incrémentale par défaut (reprise depuis les checkpoints).
+class JobOptions(BaseModel):
+    incremental: bool = True
+
+class SearchJobRequest(SearchRequest, JobOptions):
+    pass
 
+class ProfileJobRequest(ProfileRequest, JobOptions):
+    pass
+
+@app.post("/jobs/import/search", status_code=202)
+def submit_search_job(data: SearchJobRequest):
+    return submit_job("search", data.model_dump())
+
+@app.post("/jobs/import/profile", status_code=202)
+def submit_profile_job(data: ProfileJobRequest):
+    if not extract_handle_from_url(data.profile_url):
+        raise HTTPException(status_code=400, detail="URL de profil invalide")
+    return submit_job("profile", data.model_dump())
+
+@app.post("/jobs/import/tweet_url", status_code=202)
+def submit_tweet_url_job(data: TweetRequest):
+    return submit_job("tweet_url", data.model_dump())
+
+@app.get("/jobs")
+def get_jobs(limit: int = 50, status: Optional[str] = None):
+    return list_jobs(limit, status)
+
+@app.get("/jobs/{job_id}")
+def get_job_status(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job introuvable")
+    return job
+
+@app.post("/jobs/{job_id}/cancel")
+def cancel_import_job(job_id: str):
+    job = cancel_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job introuvable")
+    return job
+
+# Export Parquet des posts stockés (curseur côté serveur, mémoire constante) dans un nouveau
+# répertoire de PARQUET_EXPORT_DIR, partitionné par source et par mois (ou jour) de création
+class ExportRequest(BaseModel):
+    sources: List[str] = ["search", "user", "single"]
+    since: Optional[datetime] = None
+    until: Optional[datetime] = None
+    partition: str = "month"
+
+@app.post("/export/parquet")
+def export_parquet(data: ExportRequest):
+    try:
+        return export_tables(data.sources, data.since, data.until, data.partition)
+    except (ValueError, ImportError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Recherche dans les posts stockés : plein texte (syntaxe web : "guillemets", -exclusion, OR),
+# filtres handle / dates / label prédit, pagination par cursor (next_cursor de la page précédente).
+# Le label porte sur la version courante du modèle fake news, ou sur toute version pour les autres modèles.
+# 503 tant que la migration du schéma de recherche (python post_search.py migrate) n'a pas été faite.
+@app.get("/posts/search")
+def search_stored_posts(q: Optional[str] = None, source: List[str] = Query(["search"]),
+                        handle: Optional[str] = None, since: Optional[datetime] = None,
+                        until: Optional[datetime] = None, label: Optional[str] = None,
+                        model: str = FAKE_NEWS_MODEL, limit: int = 50, cursor: Optional[str] = None):
+    try:
+        return search_posts(q, source, handle=handle, since=since, until=until, label=label,
+                            model_name=model,
+                            model_version=FAKE_NEWS_MODEL_ID if model == FAKE_NEWS_MODEL else None,
+                            limit=limit, cursor=cursor)
+    except SearchSchemaMissing as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
@@ -0,0 +1,282 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from types import SimpleNamespace
+
+# Benchmark hors ligne de la chaîne collecte -> insertion -> score, sans réseau :
+# - un faux client atproto rejoue des pages synthétiques search_posts / get_author_feed ;
+# - la base est un Postgres local (--db-url) ou, à défaut, un substitut en mémoire ;
+# - un mini BERT initialisé aléatoirement remplace final_model_bert.
+# Résultats (posts/s, latences p50/p99 par étape) écrits en JSON pour comparer les runs.
+# --replay : les réponses enregistrées d'une archive (api_archive) remplacent les pages
+# synthétiques ; --query doit être une recherche présente dans l'archive.
+#
+#   python benchmark_pipeline.py --posts 5000 --output bench.json [--db-url postgresql://...]
+#   python benchmark_pipeline.py --replay archives/ --query "vaccin" --posts 5000
+
+os.environ.setdefault("PREDICTION_CACHE_DB", "0")
+
+
+# --- Faux client Bluesky ---
+
+def _synthetic_post(i, query="bench"):
+    author = SimpleNamespace(
+        did=f"did:plc:bench{i % 50}", handle=f"user{i % 50}.bsky.social", display_name=f"User {i % 50}",
+        description="Compte de test\nbenchmark", followers_count=i % 1000, follows_count=i % 300,
+        posts_count=i % 5000, created_at="2024-01-01T00:00:00.000Z", indexed_at="2024-01-01T00:00:00.000Z",
+        viewer=SimpleNamespace(muted=False, following=None, blocked_by=False), labels=[],
+    )
+    words = ["la", "france", "vaccin", "@journaliste", "http://exemple.com/article", "#info", "demain", "gratuit"]
+    text = " ".join(words[(i + k) % len(words)] for k in range(5 + i % 40))
+    record = SimpleNamespace(text=f"{query} {text}", created_at=f"2024-06-01T{i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}.000Z", embed=None)
+    return SimpleNamespace(
+        uri=f"at://{author.did}/app.bsky.feed.post/{query}{i}", cid=f"bafy{i}", record=record, author=author,
+        indexed_at="2024-06-01T00:00:00.000Z", like_count=i % 100, repost_count=i % 10, reply_count=i % 5,
+    )
+
+
+class _FakeFeed:
+    def __init__(self, total):
+        self.total = total
+        self.calls = 0
+
+    def _window(self, params):
+        self.calls += 1
+        start = int(params.get("cursor") or 0)
+        end = min(start + params["limit"], self.total)
+        return start, end, (str(end) if end < self.total else None)
+
+    def search_posts(self, params):
+        start, end, cursor = self._window(params)
+        return SimpleNamespace(posts=[_synthetic_post(i, params["q"]) for i in range(start, end)], cursor=cursor)
+
+    def get_author_feed(self, params):
+        start, end, cursor = self._window(params)
+        return SimpleNamespace(feed=[SimpleNamespace(post=_synthetic_post(i)) for i in range(start, end)], cursor=cursor)
+
+
+class FakeBlueskyClient:
+    def __init__(self, total):
+        self.feed = _FakeFeed(total)
+        self.app = SimpleNamespace(bsky=SimpleNamespace(feed=self.feed))
+
+
+# --- Substitut de base de données en mémoire ---
+
+class MemoryDatabase:
+    def __init__(self):
+        self.tables = {}
+
+    @contextmanager
+    def connection(self):
+        yield self
+
+    @contextmanager
+    def transaction(self):
+        yield self
+
+    def execute(self, *args):
+        return None
+
+    def bulk_insert_rows(self, conn, table, columns, rows, key="post_uri", update_columns=None):
+        stored = self.tables.setdefault(table, {})
+        key_index = columns.index(key)
+        inserted = 0
+        for row in rows:
+            if update_columns or row[key_index] not in stored:
+                stored[row[key_index]] = row
+                inserted += 1
+        return {"inserted": inserted, "skipped": len(rows) - inserted, "rejected": 0}
+
+
+# --- Mini BERT aléatoire ---
+
+def build_tiny_model(directory):
+    from transformers import BertConfig, BertForSequenceClassification, BertTokenizerFast
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + [chr(c) for c in range(ord("a"), ord("z") + 1)]
+    vocab += ["##" + chr(c) for c in range(ord("a"), ord("z") + 1)] + list("0123456789<>#@.:/'!?,")
+    vocab_file = os.path.join(directory, "vocab.txt")
+    with open(vocab_file, "w") as f:
+        f.write("\n".join(vocab))
+    tokenizer = BertTokenizerFast(vocab_file=vocab_file, do_lower_case=True)
+    config = BertConfig(vocab_size=len(vocab), hidden_size=64, num_hidden_layers=2, num_attention_heads=2,
+                        intermediate_size=128, num_labels=2, max_position_embeddings=512)
+    BertForSequenceClassification(config).save_pretrained(directory)
+    tokenizer.save_pretrained(directory)
+    return directory
+
+
+# --- Mesures ---
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def _stage_report(items, seconds, latencies_ms):
+    return {
+        "items": items,
+        "seconds": round(seconds, 4),
+        "posts_per_s": round(items / seconds, 1) if seconds else None,
+        "latency_p50_ms": round(statistics.median(latencies_ms), 3) if latencies_ms else None,
+        "latency_p99_ms": round(_percentile(latencies_ms, 0.99), 3) if latencies_ms else None,
+        "calls": len(latencies_ms),
+    }
+
+
+def _timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def run_benchmark(posts=2000, predict_posts=200, batch_size=32, db_url=None, model_dir=None,
+                  replay=None, query="bench"):
+    if db_url:
+        os.environ["DB_URL"] = db_url
+    else:
+        os.environ.setdefault("DB_URL", "postgresql://benchmark@localhost/inutilise")
+
+    import bluesky_session
+    import collector
+    import db
+    import bert_finetune
+    import near_duplicates
+
+    if replay:
+        import api_archive
+        client = api_archive.ReplayClient(replay)
+    else:
+        client = FakeBlueskyClient(posts)
+    bluesky_session._clients[bluesky_session.BLUESKY_IDENTIFIER] = client
+
+    memory_db = None
+    if not db_url:
+        memory_db = MemoryDatabase()
+        db.get_connection = memory_db.connection
+        db.bulk_insert_rows = memory_db.bulk_insert_rows
+        near_duplicates.NEAR_DUP_ENABLED = False
+
+    tmp = None
+    if model_dir is None:
+        tmp = tempfile.TemporaryDirectory()
+        model_dir = build_tiny_model(tmp.name)
+    bert_finetune.MODEL_PATH = model_dir
+
+    report = {"stages": {}}
+
+    # 1) Normalisation collecteur : pages synthétiques -> lots colonnaires (PostBatch)
+    pages, latencies = [], []
+    start = time.perf_counter()
+    iterator = collector.iter_search_pages(query, limit=posts)
+    while True:
+        page, elapsed = _timed(next, iterator, None)
+        if page is None:
+            break
+        pages.append(page)
+        latencies.append(elapsed)
+    report["stages"]["collector_normalization"] = _stage_report(
+        sum(len(p) for p in pages), time.perf_counter() - start, latencies)
+
+    # 2) Transposition colonnes -> lignes pour le COPY
+    latencies = []
+    start = time.perf_counter()
+    for page in pages:
+        _, elapsed = _timed(page.rows, db.SEARCH_POSTS_COLUMNS.values())
+        latencies.append(elapsed)
+    report["stages"]["batch_rows"] = _stage_report(
+        sum(len(p) for p in pages), time.perf_counter() - start, latencies)
+
+    # 3) Insertions db.py page par page
+    if db_url:
+        with db.get_connection() as conn:
+            conn.execute("DELETE FROM bluesky_search_posts WHERE post_uri = ANY(%s)",
+                         ([uri for page in pages for uri in page["post_uri"]],))
+    latencies = []
+    start = time.perf_counter()
+    for page in pages:
+        _, elapsed = _timed(db.insert_search_pages, [page])
+        latencies.append(elapsed)
+    report["stages"]["db_insert_search_pages"] = _stage_report(
+        sum(len(p) for p in pages), time.perf_counter() - start, latencies)
+
+    # 3b) Quasi-doublons : signature MinHash + recherche LSH (index en mémoire, sans base)
+    index = near_duplicates.LshIndex()
+    cleaned = bert_finetune.clean_tweets([text or "" for page in pages for text in page["text"]])
+    latencies = []
+    start = time.perf_counter()
+    for i, text in enumerate(cleaned):
+        sig, elapsed = _timed(near_duplicates.signature, text)
+        if sig is not None:
+            match, match_ms = _timed(index.match, sig)
+            elapsed += match_ms
+            if match is None:
+                index.add(i, sig)
+        latencies.append(elapsed)
+    report["stages"]["near_duplicate_match"] = _stage_report(
+        len(cleaned), time.perf_counter() - start, latencies)
+    report["near_duplicate_clusters"] = len(index)
+
+    # 4) predict_tweet texte par texte, puis predict_batch
+    texts = [text or "" for page in pages for text in page["text"]][:predict_posts]
+    bert_finetune.get_model(bert_finetune.MODEL_NAME)
+    latencies = []
+    start = time.perf_counter()
+    for text in texts:
+        _, elapsed = _timed(bert_finetune.predict_tweet, text, use_cache=False)
+        latencies.append(elapsed)
+    report["stages"]["predict_tweet"] = _stage_report(len(texts), time.perf_counter() - start, latencies)
+
+    latencies = []
+    start = time.perf_counter()
+    for i in range(0, len(texts), batch_size):
+        _, elapsed = _timed(bert_finetune.predict_batch, texts[i:i + batch_size], batch_size=batch_size, use_cache=False)
+        latencies.append(elapsed)
+    report["stages"]["predict_batch"] = _stage_report(len(texts), time.perf_counter() - start, latencies)
+
+    report["config"] = {
+        "posts": posts, "predict_posts": len(texts), "batch_size": batch_size,
+        "database": "postgres" if db_url else "memory", "api_calls": client.calls if replay else client.feed.calls,
+        "replay": replay,
+    }
+    report["environment"] = {
+        "python": platform.python_version(), "machine": platform.machine(),
+        "cpu_count": os.cpu_count(), "timestamp": datetime.utcnow().isoformat() + "Z",
+    }
+    if tmp is not None:
+        tmp.cleanup()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark hors ligne collecte -> insertion -> score")
+    parser.add_argument("--posts", type=int, default=2000, help="posts synthétiques à collecter et insérer")
+    parser.add_argument("--predict-posts", type=int, default=200, help="posts passés au modèle")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--db-url", help="Postgres local (tables existantes) ; substitut en mémoire sinon")
+    parser.add_argument("--model-dir", help="modèle à utiliser au lieu du mini BERT aléatoire")
+    parser.add_argument("--output", help="fichier JSON de résultats (stdout sinon)")
+    parser.add_argument("--replay", help="archive de réponses Bluesky à rejouer (api_archive)")
+    parser.add_argument("--query", default="bench", help="recherche rejouée (avec --replay)")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.posts, args.predict_posts, args.batch_size, args.db_url, args.model_dir,
+                           args.replay, args.query)
+    payload = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(payload)
+        print(f"✅ Résultats écrits dans {args.output}")
+    else:
+        print(payload)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
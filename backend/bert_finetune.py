@@ -1,130 +1,355 @@
-from transformers import AutoTokenizer, AutoModelForSequenceClassification
 import torch
 import re
+import sys
+import time
+import os
+import numpy as np
+from model_registry import register_model, get_model, model_stats
+import prediction_cache
+from inference_backends import load_backend, supports_embeddings
+from metrics import timed, observe, inc, BATCH_SIZE_BUCKETS
 
-# 1. Charger modèle et tokenizer
-model_path = "./final_model_bert"  # Chemin vers ton dossier local
-tokenizer = AutoTokenizer.from_pretrained(model_path)
-model = AutoModelForSequenceClassification.from_pretrained(model_path, trust_remote_code=True)
-model.eval()
+# --- 1. Configuration et chargement du modèle ---
 
-# 2. Fonction de prédiction
+# Chemin où vous avez sauvegardé votre modèle et tokenizer
+# ASSUREZ-VOUS QUE CE CHEMIN EST CORRECT !
+MODEL_PATH = "./final_model_bert"
+MODEL_NAME = "fake_news"
+# Version du modèle : identifie les prédictions en cache (à changer après un ré-entraînement)
+MODEL_VERSION = os.getenv("FAKE_NEWS_MODEL_VERSION", "final_model_bert")
+
+# Backend d'inférence : "torch" (fp32), "int8" (quantifié dynamiquement) ou "onnx" (onnxruntime)
+INFERENCE_BACKEND = os.getenv("FAKE_NEWS_BACKEND", "torch")
+# Identifiant des prédictions (cache, tables) : les backends quantifiés peuvent différer du fp32
+MODEL_ID = MODEL_VERSION if INFERENCE_BACKEND == "torch" else f"{MODEL_VERSION}/{INFERENCE_BACKEND}"
+# Embeddings disponibles avec ce backend (sinon : prédictions seules, via predict_batch)
+EMBEDDINGS_AVAILABLE = supports_embeddings(INFERENCE_BACKEND)
+
+# Définir le périphérique (GPU si disponible, sinon CPU ; int8 et onnx tournent sur CPU)
+if INFERENCE_BACKEND == "torch" and torch.cuda.is_available():
+    DEVICE = torch.device('cuda')
+else:
+    DEVICE = torch.device('cpu')
+
+# Labels du modèle fine-tuné (0 = faux, 1 = vrai)
+int_to_label = {0: 'Faux', 1: 'Vrai'} # Adaptez ceci à vos labels réels
+
+# Chargement du tokenizer et du modèle, appelé une seule fois par le registre
+# (au premier appel de prédiction ou pendant le warmup)
+def load_fake_news_model():
+    print(f"Utilisation du périphérique : {DEVICE} (backend {INFERENCE_BACKEND})")
+    try:
+        tokenizer, model = load_backend(INFERENCE_BACKEND, MODEL_PATH, DEVICE)
+    except Exception as e:
+        print(f"Erreur lors du chargement du modèle ou du tokenizer : {e}")
+        print("Vérifiez que le chemin MODEL_PATH est correct et que les fichiers existent.")
+        raise
+    if hasattr(model, "config"):
+        model.config.id2label = int_to_label
+    return tokenizer, model
+
+register_model(MODEL_NAME, load_fake_news_model)
+
+# Prédiction brute : renvoie uniquement l'identifiant de classe
 def predict(text):
-    inputs = tokenizer(text, return_tensors="pt", truncation=True, padding=True, max_length=128)
+    tokenizer, model = get_model(MODEL_NAME)
+    inputs = tokenizer(text, return_tensors="pt", truncation=True, padding=True, max_length=128).to(DEVICE)
     with torch.no_grad():
-        outputs = model(**inputs)
+        outputs = model(input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"])
         logits = outputs.logits
         prediction = torch.argmax(logits, dim=1).item()
     return prediction
 
-# 3. Exemple
-tweet = "La france est un pays d'Afrique."
-label = predict(tweet)
-print(f"Label prédit : {label}")
+# --- 2. Fonction de nettoyage de tweet (identique à celle utilisée pour l'entraînement) ---
+# Expressions compilées une fois ; "#mot" -> "<HASHTAG> mot" par une insertion littérale
+# (même résultat que la substitution avec groupe, sans modèle de remplacement à évaluer).
+# CLEANING_VERSION : à changer si le nettoyage change (invalide le cache de tokens).
+CLEANING_VERSION = "1"
+_replace_urls = re.compile(r"http\S+|www\S+").sub
+_replace_users = re.compile(r"@\w+").sub
+_replace_hashtags = re.compile(r"#(?=\w)").sub
+
+def clean_tweet(text):
+    return _replace_hashtags("<HASHTAG> ", _replace_users("<USER>", _replace_urls("<URL>", text))).strip()
 
+# Nettoyage d'une colonne entière de textes (même fonction : clés des caches identiques)
+def clean_tweets(texts):
+    return [clean_tweet(text) for text in texts]
 
+# Règle de décision commune : si les deux classes sont trop proches, on considère
+# le texte comme une opinion personnelle plutôt qu'une information vraie/fausse
+def label_from_probabilities(prob_array):
+    predicted_class_id = int(prob_array.argmax())
+    proba_diff = abs(prob_array[0] - prob_array[1])
+    if proba_diff < 0.15:
+        return "Opinion personnelle"
+    return int_to_label.get(predicted_class_id, f"Inconnu ({predicted_class_id})")
 
-# --- 1. Configuration et chargement du modèle ---
+# Probabilités par label, format des scores enregistrés dans post_predictions
+def probabilities_to_scores(prob_array):
+    return {int_to_label.get(i, f"label_{i}"): float(p) for i, p in enumerate(prob_array)}
 
-# Chemin où vous avez sauvegardé votre modèle et tokenizer
-# ASSUREZ-VOUS QUE CE CHEMIN EST CORRECT !
-MODEL_PATH = "./final_model_bert"
+# Format des résultats dans le cache de prédictions (JSON)
+def _to_cache(label, prob_array):
+    return {"label": label, "probabilities": [float(p) for p in prob_array]}
 
-# Définir le périphérique (GPU si disponible, sinon CPU)
-DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-print(f"Utilisation du périphérique : {DEVICE}")
-
-# Charger le tokenizer et le modèle
-try:
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH)
-    model = AutoModelForSequenceClassification.from_pretrained(MODEL_PATH).to(DEVICE)
-    model.eval() # Mettre le modèle en mode évaluation (désactive dropout, etc.)
-    print("Modèle et tokenizer chargés avec succès !")
-except Exception as e:
-    print(f"Erreur lors du chargement du modèle ou du tokenizer : {e}")
-    print("Vérifiez que le chemin MODEL_PATH est correct et que les fichiers existent.")
-    exit() # Quitter si le chargement échoue
-
-# Assurez-vous que le modèle a des mappings de labels si vous les avez sauvegardés
-# Si vous n'avez pas de config.json avec id2label, vous devrez les définir manuellement
-# basés sur votre mapping original.
-# Par exemple, si 0 correspond à 'négatif' et 1 à 'positif'
-if hasattr(model.config, 'id2label'):
-    model.config.id2label = {0: 'Faux', 1: 'Vrai'}
-    int_to_label = model.config.id2label
-    print("id2label du modèle :", model.config.id2label)
-else:
-    print("Attention : `id2label` non trouvé dans la configuration du modèle. Utilisation des labels par défaut (0, 1).")
-    # Remplacez ceci par vos vrais labels si vous les connaissez (ex: {0: 'non_rouge', 1: 'rouge'})
-    int_to_label = {0: 'Faux', 1: 'Vrai'} # Adaptez ceci à vos labels réels
+def _from_cache(value):
+    return value["label"], np.array(value["probabilities"], dtype=np.float32)
 
-# --- 2. Fonction de nettoyage de tweet (identique à celle utilisée pour l'entraînement) ---
-def clean_tweet(text):
-    text = re.sub(r"http\S+|www\S+", "<URL>", text)
-    text = re.sub(r"@\w+", "<USER>", text)
-    text = re.sub(r"#(\w+)", r"<HASHTAG> \1", text)
-    return text.strip()
+# Scores enregistrés (post_predictions) -> probabilités dans l'ordre des classes
+def _from_scores(label, scores):
+    return label, np.array([scores[int_to_label.get(i, f"label_{i}")] for i in range(len(scores))], dtype=np.float32)
 
 # --- 3. Fonction de prédiction ---
-def predict_tweet(text):
-    # Nettoyage du tweet
-    cleaned_text = clean_tweet(text)
+# Un texte = un lot d'un texte : même cache, même padding dynamique que predict_batch
+def predict_tweet(text, use_cache=True):
+    return predict_batch([text], use_cache=use_cache)[0]
+
+
+
+# --- 4. Prédiction par lots ---
+# Les textes sont triés par longueur (en tokens) puis regroupés : chaque lot n'est
+# complété (padding) que jusqu'au texte le plus long du lot au lieu de 128 tokens.
+# Les résultats sont renvoyés dans l'ordre d'origine, au même format que predict_tweet.
+# Seuls les textes absents du cache de prédictions passent par le modèle, et parmi eux un
+# seul par cluster de quasi-doublons (near_duplicates) ; un cluster dont le représentant est
+# déjà noté reprend ses scores.
+# post_uris (posts stockés) : les tokens sont lus dans le cache de tokens (token_cache)
+# au lieu d'être recalculés, et y sont ajoutés s'ils n'y sont pas encore.
+def predict_batch(texts, batch_size=32, max_length=128, use_cache=True, post_uris=None):
+    cleaned_texts = clean_tweets(texts)
+    if not cleaned_texts:
+        return []
+    if not use_cache:
+        encoded = _cached_token_ids(post_uris, cleaned_texts, max_length) if post_uris else None
+        return _predict_cleaned(cleaned_texts, batch_size, max_length, encoded)
 
-    # Tokenisation
-    encoding = tokenizer(
-        cleaned_text,
+    results = [None] * len(cleaned_texts)
+    for i, value in prediction_cache.get_many(MODEL_ID, cleaned_texts).items():
+        results[i] = _from_cache(value)
+    # Textes absents du cache, dédupliqués : chaque texte distinct n'est prédit qu'une fois
+    missing = {}
+    for i, result in enumerate(results):
+        if result is None:
+            missing.setdefault(cleaned_texts[i], []).append(i)
+    if missing:
+        missing_texts = list(missing)
+        computed = _predict_by_cluster(missing_texts, [post_uris[missing[text][0]] for text in missing_texts]
+                                       if post_uris else None, batch_size, max_length)
+        for text, result in zip(missing_texts, computed):
+            for i in missing[text]:
+                results[i] = result
+        prediction_cache.put_many(MODEL_ID, missing_texts, [_to_cache(*result) for result in computed])
+    return results
+
+
+def _cached_token_ids(post_uris, cleaned_texts, max_length):
+    from token_cache import get_token_cache
+    return get_token_cache(max_length).encode_posts(list(post_uris), cleaned_texts)
+
+
+# Prédictions + embeddings (moyenne de la dernière couche cachée sur les tokens, norme 1,
+# float16) calculés dans la même passe du modèle, sans passer par le cache de prédictions.
+# Renvoie (résultats au format de predict_batch, tableau (n, dimension)).
+# Backend sans embeddings (EMBEDDINGS_AVAILABLE faux) : ValueError, l'appelant passe par predict_batch.
+def predict_and_embed(texts, batch_size=32, max_length=128, post_uris=None):
+    if not EMBEDDINGS_AVAILABLE:
+        raise ValueError(f"Embeddings indisponibles avec le backend {INFERENCE_BACKEND} (utilisez torch ou int8)")
+    cleaned_texts = clean_tweets(texts)
+    if not cleaned_texts:
+        return [], None
+    encoded = _cached_token_ids(post_uris, cleaned_texts, max_length) if post_uris else None
+    results, embeddings = _predict_cleaned(cleaned_texts, batch_size, max_length, encoded, with_embeddings=True)
+    prediction_cache.put_many(MODEL_ID, cleaned_texts, [_to_cache(*result) for result in results])
+    return results, embeddings
+
+
+# Prédit des textes nettoyés distincts en réutilisant les scores des clusters de quasi-doublons
+def _predict_by_cluster(cleaned_texts, post_uris, batch_size, max_length):
+    from near_duplicates import known_cluster_predictions
+    known = known_cluster_predictions(cleaned_texts, MODEL_NAME, MODEL_ID)
+    results = [None] * len(cleaned_texts)
+    to_predict = []
+    first_of_cluster = {}
+    for i, found in enumerate(known):
+        if found is None:
+            to_predict.append(i)
+        elif found[1] is not None:
+            results[i] = _from_scores(found[1], found[2])
+        elif found[0] not in first_of_cluster:
+            first_of_cluster[found[0]] = i
+            to_predict.append(i)
+    if to_predict:
+        texts = [cleaned_texts[i] for i in to_predict]
+        encoded = _cached_token_ids([post_uris[i] for i in to_predict], texts, max_length) if post_uris else None
+        for i, result in zip(to_predict, _predict_cleaned(texts, batch_size, max_length, encoded)):
+            results[i] = result
+    for i, found in enumerate(known):
+        if results[i] is None:
+            results[i] = results[first_of_cluster[found[0]]]
+    reused = len(cleaned_texts) - len(to_predict)
+    if reused:
+        inc("predictions_reused_total", reused, model=MODEL_NAME)
+    return results
+
+
+# Pool de processus d'inférence s'il est démarré (inference_pool), sinon dans ce processus.
+# encoded : tokens déjà calculés (cache de tokens), sinon les textes sont tokenisés ici.
+def _predict_cleaned(cleaned_texts, batch_size=32, max_length=128, encoded=None, with_embeddings=False):
+    from inference_pool import get_pool
+    pool = get_pool()
+    if pool is not None:
+        return pool.predict_cleaned(cleaned_texts, batch_size, max_length, encoded, with_embeddings)
+    if encoded is not None:
+        return _predict_token_ids(encoded, batch_size, with_embeddings=with_embeddings)
+    return _predict_cleaned_batch(cleaned_texts, batch_size, max_length, with_embeddings=with_embeddings)
+
+
+# loaded : (tokenizer, modèle) à utiliser à la place du modèle du registre (comparaison de backends)
+def _predict_cleaned_batch(cleaned_texts, batch_size=32, max_length=128, loaded=None, with_embeddings=False):
+    tokenizer, _ = loaded or get_model(MODEL_NAME)
+
+    # Tokenisation de tous les textes en un seul appel, sans padding
+    encoded = tokenizer(
+        cleaned_texts,
         add_special_tokens=True,
-        max_length=128, # Utilisez la même MAX_LEN que pendant l'entraînement
-        return_attention_mask=True,
-        padding='max_length',
+        max_length=max_length,
         truncation=True,
-        return_tensors='pt'
-    )
+    )['input_ids']
+    return _predict_token_ids(encoded, batch_size, loaded, with_embeddings)
 
-    input_ids = encoding['input_ids'].to(DEVICE)
-    attention_mask = encoding['attention_mask'].to(DEVICE)
 
-    # Prédiction
-    with torch.no_grad(): # Pas besoin de calculer les gradients pour l'inférence
-        outputs = model(input_ids=input_ids, attention_mask=attention_mask)
-        logits = outputs.logits
-        probabilities = torch.softmax(logits, dim=1)
-        predicted_class_id = torch.argmax(probabilities, dim=1).item()
+# Prédiction à partir des tokens (listes ou tableaux d'identifiants, sans padding).
+# with_embeddings=True : renvoie (résultats, embeddings float16) au lieu des résultats seuls.
+def _predict_token_ids(encoded, batch_size=32, loaded=None, with_embeddings=False):
+    tokenizer, model = loaded or get_model(MODEL_NAME)
 
-    # Traduire l'ID de classe en label lisible
-    #predicted_label = int_to_label.get(predicted_class_id, f"Inconnu ({predicted_class_id})")
+    order = sorted(range(len(encoded)), key=lambda i: len(encoded[i]))
+    results = [None] * len(encoded)
+    embeddings = None
 
-    prob_array = probabilities[0].cpu().numpy()
-    proba_diff = abs(prob_array[0] - prob_array[1])
+    for start in range(0, len(order), batch_size):
+        indices = order[start:start + batch_size]
+        longest = max(len(encoded[i]) for i in indices)
 
-    if proba_diff < 0.15:
-        final_label = "Opinion personnelle"
-    else:
-        final_label = int_to_label.get(predicted_class_id, f"Inconnu ({predicted_class_id})")
+        # Padding dynamique jusqu'au texte le plus long du lot
+        input_ids = torch.full((len(indices), longest), tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(indices), longest), dtype=torch.long)
+        for row, i in enumerate(indices):
+            ids = encoded[i]
+            input_ids[row, :len(ids)] = torch.as_tensor(ids, dtype=torch.long)
+            attention_mask[row, :len(ids)] = 1
+
+        observe("inference_batch_size", len(indices), BATCH_SIZE_BUCKETS, model=MODEL_NAME)
+        with torch.no_grad(), timed(f"model_forward.{MODEL_NAME}"):
+            if with_embeddings:
+                outputs = model(input_ids=input_ids.to(DEVICE), attention_mask=attention_mask.to(DEVICE),
+                                output_hidden_states=True)
+            else:
+                outputs = model(input_ids=input_ids.to(DEVICE), attention_mask=attention_mask.to(DEVICE))
+            probabilities = torch.softmax(outputs.logits, dim=1).cpu().numpy()
+            if with_embeddings:
+                pooled = _mean_pool(outputs.hidden_states[-1], attention_mask.to(DEVICE)).cpu().numpy()
+                if embeddings is None:
+                    embeddings = np.empty((len(encoded), pooled.shape[1]), dtype=np.float16)
+                embeddings[indices] = pooled
+
+        for i, prob_array in zip(indices, probabilities):
+            results[i] = (label_from_probabilities(prob_array), prob_array)
+
+    if with_embeddings:
+        return results, embeddings
+    return results
+
+
+# Moyenne des états cachés sur les tokens réels (hors padding), normalisée (norme 1)
+def _mean_pool(hidden_states, attention_mask):
+    mask = attention_mask.unsqueeze(-1).to(hidden_states.dtype)
+    pooled = (hidden_states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+    return torch.nn.functional.normalize(pooled, dim=1)
+
+
+# Annote des pages de posts au fil de l'eau (ex. pages de collector.iter_search_pages) :
+# chaque page est prédite en lots puis renvoyée, sans accumuler les pages précédentes.
+# store=True enregistre aussi les prédictions dans post_predictions (version MODEL_ID).
+def predict_pages(pages, text_key="text", batch_size=32, store=False):
+    for page in pages:
+        if not len(page):
+            continue
+        results = predict_batch([text or "" for text in page[text_key]], batch_size=batch_size,
+                                post_uris=page["post_uri"].tolist())
+        page["fake_news"] = [label for label, _ in results]
+        page["fake_news_probabilities"] = np.stack([prob_array for _, prob_array in results])
+        if store:
+            from predictions import save_page_predictions
+            save_page_predictions(page, MODEL_NAME, MODEL_ID, page["fake_news"].tolist(),
+                                  [probabilities_to_scores(prob_array) for _, prob_array in results])
+        yield page
+
+
+# Comparaison du débit (textes/seconde) entre la boucle predict_tweet et predict_batch
+def benchmark_predict(texts, batch_size=32):
+    get_model(MODEL_NAME) # le temps de chargement n'est pas compté
+    start = time.perf_counter()
+    for text in texts:
+        predict_tweet(text, use_cache=False)
+    loop_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    predict_batch(texts, batch_size=batch_size, use_cache=False)
+    batch_seconds = time.perf_counter() - start
+
+    report = {
+        "textes": len(texts),
+        "batch_size": batch_size,
+        "boucle_textes_par_s": len(texts) / loop_seconds if loop_seconds else float("inf"),
+        "lots_textes_par_s": len(texts) / batch_seconds if batch_seconds else float("inf"),
+    }
+    report["acceleration"] = loop_seconds / batch_seconds if batch_seconds else float("inf")
+    print(f"Boucle predict_tweet : {report['boucle_textes_par_s']:.1f} textes/s")
+    print(f"predict_batch (batch_size={batch_size}) : {report['lots_textes_par_s']:.1f} textes/s")
+    print(f"Accélération : x{report['acceleration']:.2f}")
+    return report
 
-    return final_label, prob_array
 
+# Jeu de textes synthétiques de longueurs variées pour le benchmark
+def _sample_texts(n=512):
+    base = [
+        "La france est un pays d'Afrique.",
+        "Le gouvernement va rendre tout gratuit dès demain !",
+        "@user Regardez cette vidéo http://exemple.com #info",
+        "Selon plusieurs sources, le vaccin contiendrait une puce électronique permettant de suivre la population, "
+        "une affirmation déjà démentie à de nombreuses reprises par les autorités sanitaires.",
+    ]
+    return [base[i % len(base)] * (1 + i % 3) for i in range(n)]
 
-    # Retourner les résultats
-    #return predicted_label, probabilities[0].cpu().numpy()
 
+if __name__ == "__main__":
+    # python bert_finetune.py --benchmark [nombre_de_textes] [batch_size]
+    if len(sys.argv) > 1 and sys.argv[1] == "--benchmark":
+        n_texts = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+        batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 32
+        benchmark_predict(_sample_texts(n_texts), batch_size=batch_size)
+        sys.exit(0)
 
+    get_model(MODEL_NAME)
+    print("Modèle et tokenizer chargés avec succès !", model_stats()["models"][MODEL_NAME])
 
-# --- 5. Test interactif (optionnel) ---
-print("\n--- Mode de test interactif ---")
-print("Tapez 'quitter' pour sortir.")
+    # --- 5. Test interactif (optionnel) ---
+    print("\n--- Mode de test interactif ---")
+    print("Tapez 'quitter' pour sortir.")
 
-while True:
-    user_tweet = input("Entrez un tweet à analyser : ")
-    if user_tweet.lower() == 'quitter':
-        print("Fin du mode interactif.")
-        break
-    if not user_tweet.strip():
-        print("Veuillez entrer un tweet.")
-        continue
+    while True:
+        user_tweet = input("Entrez un tweet à analyser : ")
+        if user_tweet.lower() == 'quitter':
+            print("Fin du mode interactif.")
+            break
+        if not user_tweet.strip():
+            print("Veuillez entrer un tweet.")
+            continue
 
-    label, probs = predict_tweet(user_tweet)
-    print(f"  Prédiction : {label}")
-    print(f"  Probabilités : {probs}")
-    # for j, prob in enumerate(probs):
-    #     print(f"    {int_to_label.get(j, f'label_{j}')}: {prob:.4f}")
\ No newline at end of file
+        label, probs = predict_tweet(user_tweet)
+        print(f"  Prédiction : {label}")
+        print(f"  Probabilités : {probs}")
+        # for j, prob in enumerate(probs):
+        #     print(f"    {int_to_label.get(j, f'label_{j}')}: {prob:.4f}")
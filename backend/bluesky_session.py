@@ -0,0 +1,98 @@
+import os
+import threading
+from atproto import Client
+from dotenv import load_dotenv
+from metrics import timed, inc
+
+load_dotenv()
+
+BLUESKY_IDENTIFIER = os.getenv("BLUESKY_IDENTIFIER")
+BLUESKY_APP_PASSWORD = os.getenv("BLUESKY_APP_PASSWORD")
+BLUESKY_BASE_URL = os.getenv("BLUESKY_BASE_URL", "https://bsky.social")
+# Fichier où la session (access + refresh JWT) est conservée entre deux redémarrages
+BLUESKY_SESSION_FILE = os.getenv("BLUESKY_SESSION_FILE", ".bluesky_session")
+# Archive de réponses enregistrées à rejouer à la place de l'API (api_archive)
+BLUESKY_REPLAY_DIR = os.getenv("BLUESKY_REPLAY_DIR")
+
+# Un client authentifié par identifiant, partagé par les collecteurs et l'API.
+# Le client atproto rafraîchit lui-même l'access JWT avec le refresh JWT
+# (15 min avant expiration, sous verrou) : on ne refait jamais createSession
+# tant que la session sauvegardée reste valide.
+_clients = {}
+_lock = threading.Lock()
+
+
+def _session_path(identifier):
+    if identifier == BLUESKY_IDENTIFIER:
+        return BLUESKY_SESSION_FILE
+    return f"{BLUESKY_SESSION_FILE}.{identifier}"
+
+
+def _load_session_string(path):
+    try:
+        with open(path) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+# Appelé par atproto à chaque création / rafraîchissement de session
+def _save_session_callback(path):
+    def save(event, session):
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                f.write(session.encode())
+        except OSError as e:
+            print(f"⚠️ Impossible de sauvegarder la session Bluesky : {e}")
+    return save
+
+
+def _login(identifier, password):
+    inc("bluesky_logins_total")
+    with timed("bluesky_login"):
+        return _restore_or_create_session(identifier, password)
+
+
+def _restore_or_create_session(identifier, password):
+    path = _session_path(identifier)
+    client = Client(base_url=BLUESKY_BASE_URL)
+    client.on_session_change(_save_session_callback(path))
+
+    # 1) Réutilise la session sauvegardée si elle est encore valide
+    session_string = _load_session_string(path)
+    if session_string:
+        try:
+            client.login(session_string=session_string)
+            return client
+        except Exception as e:
+            print(f"⚠️ Session Bluesky sauvegardée inutilisable, nouvelle connexion : {e}")
+            client = Client(base_url=BLUESKY_BASE_URL)
+            client.on_session_change(_save_session_callback(path))
+
+    # 2) Sinon, connexion par mot de passe (createSession)
+    client.login(identifier, password)
+    return client
+
+
+# Renvoie le client authentifié partagé (connexion au premier appel uniquement).
+# BLUESKY_REPLAY_DIR : client de rejeu des réponses enregistrées (api_archive), sans connexion.
+def get_client(identifier=None, password=None):
+    if BLUESKY_REPLAY_DIR:
+        from api_archive import get_replay_client
+        return get_replay_client(BLUESKY_REPLAY_DIR)
+    identifier = identifier or BLUESKY_IDENTIFIER
+    password = password or BLUESKY_APP_PASSWORD
+    client = _clients.get(identifier)
+    if client is not None:
+        return client
+    with _lock:
+        if identifier not in _clients:
+            _clients[identifier] = _login(identifier, password)
+        return _clients[identifier]
+
+
+# Oublie le client en cache (ex. après une erreur d'authentification) pour forcer une reconnexion
+def reset_client(identifier=None):
+    with _lock:
+        _clients.pop(identifier or BLUESKY_IDENTIFIER, None)
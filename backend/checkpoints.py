@@ -0,0 +1,178 @@
+import numpy as np
+from collector import iter_search_cursor_pages, iter_author_feed_cursor_pages
+from records import to_datetime, to_datetime64
+
+# Collecte incrémentale : un point de reprise par (requête, langue) et par handle.
+# - newest_indexed_at / newest_post_uri : post le plus récent déjà collecté en entier
+#   (tout ce qui est plus ancien est en base) ;
+# - last_cursor / pending_* : rattrapage interrompu par la limite, repris au prochain
+#   appel à partir du cursor, jusqu'à rejoindre les données connues.
+# Les fils sont paginés du plus récent au plus ancien : on s'arrête dès qu'une page
+# rejoint les données connues, c'est-à-dire contient le post frontière (même URI) ou se
+# termine par un post indexé avant la frontière. La date d'indexation (fixée par le
+# serveur) est utilisée, pas createdAt (fixé par le client, antidatable). Les reposts et
+# posts épinglés (feed_reason) portent les dates du post d'origine : ils ne servent ni à
+# décider de l'arrêt ni à placer la frontière, et sont toujours transmis (ON CONFLICT).
+# Le point de reprise n'est enregistré qu'une fois toutes les pages consommées (donc
+# insérées) par l'appelant.
+
+CREATE_CHECKPOINTS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS collection_checkpoints (
+        source TEXT NOT NULL,
+        key TEXT NOT NULL,
+        newest_indexed_at TIMESTAMPTZ,
+        newest_post_uri TEXT,
+        pending_indexed_at TIMESTAMPTZ,
+        pending_post_uri TEXT,
+        last_cursor TEXT,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (source, key)
+    );
+    -- Tables créées avec l'ancienne frontière (created_at) : colonnes ajoutées, vides
+    ALTER TABLE collection_checkpoints
+        ADD COLUMN IF NOT EXISTS newest_indexed_at TIMESTAMPTZ,
+        ADD COLUMN IF NOT EXISTS pending_indexed_at TIMESTAMPTZ;
+"""
+
+_table_ready = False
+
+
+def _connection():
+    global _table_ready
+    from db import get_connection
+    if not _table_ready:
+        with get_connection() as conn:
+            conn.execute(CREATE_CHECKPOINTS_TABLE_SQL)
+        _table_ready = True
+    return get_connection()
+
+
+def search_key(query, lang=None):
+    return f"{query}|{lang or ''}"
+
+
+def load_checkpoint(source, key):
+    with _connection() as conn:
+        row = conn.execute(
+            "SELECT newest_indexed_at, newest_post_uri, pending_indexed_at, pending_post_uri, last_cursor "
+            "FROM collection_checkpoints WHERE source = %s AND key = %s",
+            (source, key),
+        ).fetchone()
+    if row is None:
+        return {"newest_indexed_at": None, "newest_post_uri": None,
+                "pending_indexed_at": None, "pending_post_uri": None, "last_cursor": None}
+    return dict(zip(
+        ["newest_indexed_at", "newest_post_uri", "pending_indexed_at", "pending_post_uri", "last_cursor"], row
+    ))
+
+
+def save_checkpoint(source, key, checkpoint):
+    with _connection() as conn:
+        conn.execute(
+            """
+            INSERT INTO collection_checkpoints (
+                source, key, newest_indexed_at, newest_post_uri,
+                pending_indexed_at, pending_post_uri, last_cursor, updated_at
+            )
+            VALUES (%s, %s, %s, %s, %s, %s, %s, now())
+            ON CONFLICT (source, key) DO UPDATE SET
+                newest_indexed_at = EXCLUDED.newest_indexed_at,
+                newest_post_uri = EXCLUDED.newest_post_uri,
+                pending_indexed_at = EXCLUDED.pending_indexed_at,
+                pending_post_uri = EXCLUDED.pending_post_uri,
+                last_cursor = EXCLUDED.last_cursor,
+                updated_at = now()
+            """,
+            (source, key, checkpoint["newest_indexed_at"], checkpoint["newest_post_uri"],
+             checkpoint["pending_indexed_at"], checkpoint["pending_post_uri"], checkpoint["last_cursor"]),
+        )
+
+
+# Posts à leur place dans l'ordre du fil (ni repost ni post épinglé)
+def _in_order_mask(page):
+    if "feed_reason" not in page:
+        return np.ones(len(page), dtype=bool)
+    return np.array([reason is None for reason in page["feed_reason"]], dtype=bool)
+
+
+# Posts déjà collectés d'une page : (masque du post frontière, masque des posts indexés
+# avant la frontière parmi les posts à leur place)
+def _known_masks(page, checkpoint, in_order):
+    frontier = np.zeros(len(page), dtype=bool)
+    if checkpoint["newest_post_uri"]:
+        frontier = page["post_uri"] == checkpoint["newest_post_uri"]
+    older = np.zeros(len(page), dtype=bool)
+    if checkpoint["newest_indexed_at"] is not None:
+        indexed_at = page["indexed_at_post"]
+        older = in_order & ~np.isnat(indexed_at) & (indexed_at <= to_datetime64(checkpoint["newest_indexed_at"]))
+    return frontier, older
+
+
+# La page rejoint les données connues : post frontière présent, ou dernier post à sa
+# place indexé avant la frontière (un post isolé hors d'ordre plus haut ne suffit pas)
+def _reached_known(frontier, older, in_order):
+    if frontier.any():
+        return True
+    positions = np.flatnonzero(in_order)
+    return bool(len(positions)) and bool(older[positions[-1]])
+
+
+# Parcourt les pages (page, cursor) en ne gardant que les posts nouveaux,
+# puis met à jour le point de reprise une fois toutes les pages consommées.
+def _iter_new_pages(source, key, cursor_pages):
+    checkpoint = load_checkpoint(source, key)
+    resuming = checkpoint["last_cursor"] is not None
+    head_indexed_at = to_datetime64(checkpoint["pending_indexed_at"]) if resuming else np.datetime64("NaT", "us")
+    head_post_uri = checkpoint["pending_post_uri"] if resuming else None
+
+    cursor = checkpoint["last_cursor"]
+    reached_known = False
+    exhausted = True
+    for page, next_cursor in cursor_pages(cursor):
+        cursor = next_cursor
+        in_order = _in_order_mask(page)
+        frontier, older = _known_masks(page, checkpoint, in_order)
+        reached_known = _reached_known(frontier, older, in_order)
+        new = ~(frontier | older)
+        # Tête : post à sa place le plus récemment indexé parmi les nouveaux
+        candidates = np.flatnonzero(new & in_order & ~np.isnat(page["indexed_at_post"]))
+        if len(candidates):
+            newest = candidates[np.argmax(page["indexed_at_post"][candidates])]
+            if np.isnat(head_indexed_at) or page["indexed_at_post"][newest] > head_indexed_at:
+                head_indexed_at = page["indexed_at_post"][newest]
+                head_post_uri = page["post_uri"][newest]
+        new_posts = page if new.all() else page.take(new)
+        if len(new_posts):
+            yield new_posts
+        if reached_known:
+            break
+        exhausted = not next_cursor
+
+    if head_post_uri is None:
+        return
+    head_indexed_at = to_datetime(head_indexed_at)
+    if reached_known or exhausted:
+        # Rattrapage complet : la tête devient la nouvelle frontière
+        checkpoint.update(newest_indexed_at=head_indexed_at, newest_post_uri=head_post_uri,
+                          pending_indexed_at=None, pending_post_uri=None, last_cursor=None)
+    else:
+        # Limite atteinte avant les données connues : on reprendra depuis ce cursor
+        checkpoint.update(pending_indexed_at=head_indexed_at, pending_post_uri=head_post_uri,
+                          last_cursor=cursor)
+    save_checkpoint(source, key, checkpoint)
+
+
+# Pages de posts de recherche non encore collectés pour (query, lang)
+def iter_new_search_pages(query, limit=100, lang=None):
+    return _iter_new_pages(
+        "search", search_key(query, lang),
+        lambda cursor: iter_search_cursor_pages(query, limit, lang, cursor=cursor),
+    )
+
+
+# Pages de posts du fil d'un auteur non encore collectés
+def iter_new_author_feed_pages(handle, limit=50):
+    return _iter_new_pages(
+        "profile", handle,
+        lambda cursor: iter_author_feed_cursor_pages(handle, limit, cursor=cursor),
+    )
@@ -1,72 +1,86 @@
 import os
-import json
-from datetime import datetime
+import numpy as np
 from urllib.parse import urlparse
-from atproto import Client
-from dotenv import load_dotenv
-import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from bluesky_session import get_client
+from records import PostBatch, normalize_post_views, normalize_profile, object_column
+from api_archive import record_response
+from metrics import timed, inc
 
-load_dotenv()
 
-BLUESKY_IDENTIFIER = os.getenv("BLUESKY_IDENTIFIER")
-BLUESKY_APP_PASSWORD = os.getenv("BLUESKY_APP_PASSWORD")
+# Appel instrumenté à l'API Bluesky (compteur + durée par endpoint) ; la réponse brute est
+# ajoutée à l'archive si l'enregistrement est actif (api_archive, BLUESKY_RECORD_DIR)
+def _call_api(endpoint, method, params):
+    inc("bluesky_api_calls_total", endpoint=endpoint)
+    with timed(f"bluesky_api.{endpoint}"):
+        response = method(params)
+    record_response(endpoint, params, response)
+    return response
 
 
-def search_bluesky_posts(query="Bluesky", limit=100, lang=None):
-    client = Client(base_url="https://bsky.social")
-    client.login(BLUESKY_IDENTIFIER, BLUESKY_APP_PASSWORD)
-    all_posts = []
-    cursor = None
-    while len(all_posts) < limit:
+# Version générateur de la recherche : renvoie (PostBatch de la page, cursor suivant)
+# dès que la page arrive, sans accumuler les résultats (mémoire constante).
+# cursor permet de reprendre une pagination interrompue.
+def iter_search_cursor_pages(query="Bluesky", limit=100, lang=None, cursor=None):
+    client = get_client()
+    collected = 0
+    while collected < limit:
         params = {
             "q": query,
-            "limit": min(100, limit - len(all_posts)),
+            "limit": min(100, limit - collected),
             "cursor": cursor
         }
         if lang:
             params["lang"] = lang
-        search_response = client.app.bsky.feed.search_posts(params)
+        search_response = _call_api("search_posts", client.app.bsky.feed.search_posts, params)
         batch = getattr(search_response, "posts", [])
         if not batch:
             break
-        for post_view in batch:
-            try:
-                record = post_view.record
-                author = post_view.author
-                viewer = getattr(author, 'viewer', None)
-                info = {
-                    'post_uri': post_view.uri,
-                    'post_url': f"https://bsky.app/profile/{author.handle}/post/{post_view.uri.split('/')[-1]}",
-                    'post_cid': post_view.cid,
-                    'text': getattr(record, 'text', '').replace('\n', ' ').strip(),
-                    'createdat_post': getattr(record, 'created_at', ''),
-                    'indexedat_post': getattr(post_view, 'indexed_at', ''),
-                    'embed': json.dumps(getattr(record, 'embed', {}) or {}, default=str),
-                    'likecount': getattr(post_view, 'like_count', 0),
-                    'repostcount': getattr(post_view, 'repost_count', 0),
-                    'replycount': getattr(post_view, 'reply_count', 0),
-                    'did': author.did,
-                    'handle': author.handle,
-                    'displayname': getattr(author, 'display_name', ''),
-                    'bio': author.description.replace('\n', ' ').strip() if hasattr(author, 'description') and isinstance(author.description, str) else '',
-                    'followerscount': getattr(author, 'followers_count', 0),
-                    'followscount': getattr(author, 'follows_count', 0),
-                    'postscount': getattr(author, 'posts_count', 0),
-                    'createdat_profile': getattr(author, 'created_at', ''),
-                    'indexedat_profile': getattr(author, 'indexed_at', ''),
-                    'viewer_muted': getattr(viewer, 'muted', None) if viewer else None,
-                    'viewer_following': getattr(viewer, 'following', None) if viewer else None,
-                    'viewer_blockedby': getattr(viewer, 'blocked_by', None) if viewer else None,
-                    'labels': json.dumps(getattr(author, 'labels', []) or []),
-                    'collectedat': datetime.utcnow().isoformat() + 'Z'
-                }
-                all_posts.append(info)
-            except Exception:
-                continue
+        inc("bluesky_pages_total", source="search")
+        with timed("collector_normalization"):
+            page = normalize_post_views(batch)
+        collected += len(page)
         cursor = getattr(search_response, "cursor", None)
+        yield page, cursor
         if not cursor:
             break
-    return all_posts
+
+def iter_search_pages(query="Bluesky", limit=100, lang=None):
+    for page, _ in iter_search_cursor_pages(query, limit, lang):
+        yield page
+
+def search_bluesky_posts(query="Bluesky", limit=100, lang=None):
+    return PostBatch.concat(iter_search_pages(query, limit, lang))
+
+# Lance plusieurs recherches en parallèle (au plus max_concurrency requêtes en vol).
+# queries : liste de dicts {"query": ..., "lang": ..., "limit": ...} (ou de simples chaînes).
+# Les posts sont dédupliqués par post_uri ; la colonne 'matched_queries' liste les requêtes qui les ont trouvés.
+def search_many_queries(queries, max_concurrency=8):
+    specs = [{"query": q} if isinstance(q, str) else q for q in queries]
+    batches = []
+    matched = {}
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = {
+            executor.submit(search_bluesky_posts, spec["query"], spec.get("limit", 100), spec.get("lang")): spec
+            for spec in specs
+        }
+        for future in as_completed(futures):
+            spec = futures[future]
+            try:
+                batch = future.result()
+            except Exception as e:
+                print(f"❌ Erreur lors de la recherche '{spec['query']}' : {e}")
+                continue
+            batches.append(batch)
+            for uri in batch["post_uri"]:
+                queries_for_uri = matched.setdefault(uri, [])
+                if spec["query"] not in queries_for_uri:
+                    queries_for_uri.append(spec["query"])
+    posts = PostBatch.concat(batches)
+    _, first = np.unique(posts["post_uri"].astype(str), return_index=True)
+    posts = posts.take(np.sort(first))
+    posts["matched_queries"] = object_column([matched[uri] for uri in posts["post_uri"]])
+    return posts
 
 def extract_handle_from_url(profile_url):
     path_parts = urlparse(profile_url).path.strip('/').split('/')
@@ -74,55 +88,53 @@ def extract_handle_from_url(profile_url):
         return path_parts[1]
     return None
 
-def fetch_profile_and_posts(handle, limit=50):
-    client = Client(base_url="https://bsky.social")
-    client.login(BLUESKY_IDENTIFIER, BLUESKY_APP_PASSWORD)
-    profile = client.app.bsky.actor.get_profile({'actor': handle})
-    user_data = {
-        'did': profile.did,
-        'handle': profile.handle,
-        'displayname': getattr(profile, 'display_name', ''),
-        'bio': profile.description.replace('\n', ' ').strip() if isinstance(profile.description, str) else '',
-        'followerscount': getattr(profile, 'followers_count', 0),
-        'followscount': getattr(profile, 'follows_count', 0),
-        'postscount': getattr(profile, 'posts_count', 0),
-        'createdat_profile': getattr(profile, 'created_at', ''),
-        'indexedat_profile': getattr(profile, 'indexed_at', ''),
-        'viewer_muted': getattr(profile, 'viewer', None) and getattr(profile.viewer, 'muted', None),
-        'viewer_following': getattr(profile, 'viewer', None) and getattr(profile.viewer, 'following', None),
-        'viewer_blockedby': getattr(profile, 'viewer', None) and getattr(profile.viewer, 'blocked_by', None),
-        'labels': json.dumps(getattr(profile, 'labels', []) or []),
-        'collectedat': datetime.utcnow().isoformat() + 'Z'
-    }
-    posts = []
-    cursor = None
-    while len(posts) < limit:
-        resp = client.app.bsky.feed.get_author_feed({
+def fetch_profile(handle):
+    client = get_client()
+    profile = _call_api("get_profile", client.app.bsky.actor.get_profile, {'actor': handle})
+    return normalize_profile(profile)
+
+# Raison d'apparition d'un élément du fil hors de l'ordre chronologique de ses propres posts :
+# "repost" (item.post est le post d'origine, avec ses dates d'origine), "pin" (post épinglé,
+# en tête du fil quel que soit son âge), None pour un post de l'auteur à sa place
+def _feed_reason(item):
+    reason = getattr(item, "reason", None)
+    if reason is None:
+        return None
+    return "pin" if "reasonpin" in str(getattr(reason, "py_type", "")).lower() else "repost"
+
+# Version générateur du fil d'un auteur : (PostBatch de la page, cursor suivant).
+# La colonne feed_reason marque les reposts et posts épinglés (_feed_reason).
+def iter_author_feed_cursor_pages(handle, limit=50, cursor=None):
+    client = get_client()
+    collected = 0
+    while collected < limit:
+        resp = _call_api("get_author_feed", client.app.bsky.feed.get_author_feed, {
             'actor': handle,
-            'limit': min(100, limit - len(posts)),
+            'limit': min(100, limit - collected),
             'cursor': cursor
         })
-        for item in resp.feed:
-            post = item.post
-            record = post.record
-            post_data = {
-                'post_uri': post.uri,
-                'post_cid': post.cid,
-                'did': profile.did,
-                'post_url': f"https://bsky.app/profile/{handle}/post/{post.uri.split('/')[-1]}",
-                'text': getattr(record, 'text', '').replace('\n', ' ').strip(),
-                'createdat_post': getattr(record, 'created_at', ''),
-                'indexedat_post': getattr(post, 'indexed_at', ''),
-                'embed': json.dumps(getattr(record, 'embed', {}) or {}, default=str),
-                'likecount': getattr(post, 'like_count', 0),
-                'repostcount': getattr(post, 'repost_count', 0),
-                'replycount': getattr(post, 'reply_count', 0),
-                'collectedat': datetime.utcnow().isoformat() + 'Z'
-            }
-            posts.append(post_data)
+        if not resp.feed:
+            break
+        inc("bluesky_pages_total", source="author_feed")
+        with timed("collector_normalization"):
+            page = normalize_post_views(item.post for item in resp.feed)
+            reasons = {}
+            for item in resp.feed:
+                reasons.setdefault(getattr(item.post, "uri", None), _feed_reason(item))
+            page["feed_reason"] = [reasons.get(uri) for uri in page["post_uri"]]
+        collected += len(page)
         cursor = getattr(resp, 'cursor', None)
+        yield page, cursor
         if not cursor:
             break
+
+def iter_author_feed_pages(handle, limit=50):
+    for page, _ in iter_author_feed_cursor_pages(handle, limit):
+        yield page
+
+def fetch_profile_and_posts(handle, limit=50):
+    user_data = fetch_profile(handle)
+    posts = PostBatch.concat(iter_author_feed_pages(handle, limit))
     return user_data, posts
 
 def extract_handle_and_post_id(post_url):
@@ -138,29 +150,13 @@ def extract_handle_and_post_id(post_url):
         return None, None
 
 def fetch_post_from_url(url):
-    client = Client(base_url="https://bsky.social")
-    client.login(BLUESKY_IDENTIFIER, BLUESKY_APP_PASSWORD)
+    client = get_client()
     handle, post_id = extract_handle_and_post_id(url)
     if not handle or not post_id:
         raise ValueError("❌ URL de post Bluesky invalide.")
-    resolved = client.com.atproto.identity.resolve_handle({'handle': handle})
+    resolved = _call_api("resolve_handle", client.com.atproto.identity.resolve_handle, {'handle': handle})
     did = resolved.did
     uri = f"at://{did}/app.bsky.feed.post/{post_id}"
-    post_thread = client.app.bsky.feed.get_post_thread({'uri': uri})
-    post = post_thread.thread.post
-    record = post.record
-    post_data = {
-        'post_uri': post.uri,
-        'post_cid': post.cid,
-        'did': did,
-        'post_url': url,
-        'text': getattr(record, 'text', '').replace('\n', ' ').strip(),
-        'createdat_post': getattr(record, 'created_at', ''),
-        'indexedat_post': getattr(post, 'indexed_at', ''),
-        'embed': json.dumps(getattr(record, 'embed', {}) or {}, default=str),
-        'likecount': getattr(post, 'like_count', 0),
-        'repostcount': getattr(post, 'repost_count', 0),
-        'replycount': getattr(post, 'reply_count', 0),
-        'collectedat': datetime.utcnow().isoformat() + 'Z'
-    }
-    return post_data
+    post_thread = _call_api("get_post_thread", client.app.bsky.feed.get_post_thread, {'uri': uri})
+    with timed("collector_normalization"):
+        return normalize_post_views([post_thread.thread.post])
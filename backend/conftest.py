@@ -0,0 +1,4 @@
+import os
+
+# db.py exige DB_URL à l'import ; les tests n'ouvrent aucune connexion (pool créé à la demande)
+os.environ.setdefault("DB_URL", "postgresql://tests@localhost/inutilise")
@@ -1,12 +1,19 @@
 import psycopg
-import pandas as pd
-from test_getall_data import (
-    search_bluesky_posts,
-    collect_user_posts_to_dataframe,
-    collect_single_post_to_dataframe
+import numpy as np
+import threading
+from psycopg_pool import ConnectionPool
+from collector import (
+    iter_search_pages,
+    fetch_profile,
+    iter_author_feed_pages,
+    fetch_post_from_url,
+    extract_handle_from_url
 )
+from checkpoints import iter_new_search_pages, iter_new_author_feed_pages
+from records import PROFILE_COLUMNS
 
 from dotenv import load_dotenv
+from metrics import timed, inc
 import os
 
 load_dotenv()
@@ -16,216 +23,301 @@ DB_URL = os.getenv("DB_URL")
 if not DB_URL:
     raise ValueError("DB_URL environment variable is not set. Please set it in your .env file.")
 
-# Fonction pour nettoyer les dates dans un DataFrame
-def clean_dataframe_dates(df: pd.DataFrame, date_cols: list):
-    # 1) Remplace toutes les chaînes vides par None
-    df = df.replace({'': None})
-    # 2) Tente de convertir en datetime, échoue → NaT
-    for col in date_cols:
-        if col in df.columns:
-            df[col] = pd.to_datetime(df[col], errors='coerce')
-    # 3) Remplace NaT par None
-    return df.where(pd.notnull(df), None)
-
-# Fonction pour insérer des posts de recherche Bluesky dans la base de données
-def insert_bluesky_search_posts(query: str, limit: int = 100, lang: str = None):
-    # 1) Collecte
-    df = search_bluesky_posts(query, limit=limit, lang=lang)
-    if df.empty:
-        print("⚠️ Aucun post search à insérer.")
-        return
+# Pool de connexions partagé par tout le processus (API, scripts, jobs)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))      # attente max d'une connexion (s)
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))   # fermeture des connexions inactives (s)
 
-    # 2) Mapping colonnes
-    column_map = {
-        "post_uri": "post_uri",
-        "post_url": "post_url",
-        "post_cid": "post_cid",
-        "text": "text",
-        "createdAt_post": "created_at_post",
-        "indexedAt_post": "indexed_at_post",
-        "embed": "embed",
-        "likeCount": "like_count",
-        "repostCount": "repost_count",
-        "replyCount": "reply_count",
-        "did": "did",
-        "handle": "handle",
-        "displayName": "display_name",
-        "followersCount": "followers_count",
-        "followsCount": "follows_count",
-        "postsCount": "posts_count",
-        "createdAt_profile": "created_at_profile",
-        "indexedAt_profile": "indexed_at_profile",
-        "viewer_muted": "viewer_muted",
-        "viewer_following": "viewer_following",
-        "viewer_blockedBy": "viewer_blocked_by",
-        "collectedAt": "collected_at",
-    }
-    df.rename(columns=column_map, inplace=True)
-
-    df = clean_dataframe_dates(df, [
-        "created_at_post", "indexed_at_post",
-        "created_at_profile", "indexed_at_profile",
-        "collected_at"
-    ])
-
-    # 3) Insertion SQL
-    sql = """
-        INSERT INTO bluesky_search_posts (
-            post_uri, post_url, post_cid, text,
-            created_at_post, indexed_at_post, embed,
-            like_count, repost_count, reply_count,
-            did, handle, display_name,
-            followers_count, follows_count, posts_count,
-            created_at_profile, indexed_at_profile,
-            viewer_muted, viewer_following, viewer_blocked_by,
-            collected_at
-        )
-        VALUES (
-            %(post_uri)s, %(post_url)s, %(post_cid)s, %(text)s,
-            %(created_at_post)s, %(indexed_at_post)s, %(embed)s,
-            %(like_count)s, %(repost_count)s, %(reply_count)s,
-            %(did)s, %(handle)s, %(display_name)s,
-            %(followers_count)s, %(follows_count)s, %(posts_count)s,
-            %(created_at_profile)s, %(indexed_at_profile)s,
-            %(viewer_muted)s, %(viewer_following)s, %(viewer_blocked_by)s,
-            %(collected_at)s
-        )
-        ON CONFLICT (post_uri) DO NOTHING;
-    """
-
-    # 4) Boucle d'insertion
-    with psycopg.connect(DB_URL) as conn:
+_pool = None
+_pool_lock = threading.Lock()
+
+# Ouvre le pool (au démarrage de l'app, ou au premier besoin pour les scripts).
+# Chaque connexion est vérifiée avant d'être prêtée : Neon coupe les connexions inactives.
+def open_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(
+                DB_URL,
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=DB_POOL_MAX_SIZE,
+                timeout=DB_POOL_TIMEOUT,
+                max_idle=DB_POOL_MAX_IDLE,
+                check=ConnectionPool.check_connection,
+                name="bluesky",
+                open=True,
+            )
+    return _pool
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+# Emprunte une connexion au pool : commit en sortie, rollback en cas d'exception.
+# timeout : attente max d'une connexion (défaut DB_POOL_TIMEOUT)
+def get_connection(timeout: float = None):
+    return open_pool().connection(timeout=timeout)
+
+# Taille du pool et temps d'attente cumulés (requests_wait_ms, requests_num, ...)
+def pool_stats():
+    if _pool is None:
+        return {"open": False}
+    return {"open": True, **_pool.get_stats()}
+
+# Colonnes insérées dans chaque table (dans l'ordre du COPY) -> colonne du schéma
+# canonique des lots (records.POST_SCHEMA) qui fournit la valeur
+SEARCH_POSTS_COLUMNS = {name: name for name in [
+    "post_uri", "post_url", "post_cid", "text",
+    "created_at_post", "indexed_at_post", "embed",
+    "like_count", "repost_count", "reply_count",
+    "did", "handle", "display_name",
+    "followers_count", "follows_count", "posts_count",
+    "created_at_profile", "indexed_at_profile",
+    "viewer_muted", "viewer_following", "viewer_blocked_by",
+    "collected_at",
+]}
+USER_POSTS_COLUMNS = {
+    "username": "handle",
+    "user_id": "did",
+    "bio": "bio",
+    "followers_count": "followers_count",
+    "follows_count": "follows_count",
+    "posts_count": "posts_count",
+    "profile_created_at": "created_at_profile",
+    "post_uri": "post_uri",
+    "post_url": "post_url",
+    "post_text": "text",
+    "post_created_at": "created_at_post",
+    "post_indexed_at": "indexed_at_post",
+    "like_count": "like_count",
+    "repost_count": "repost_count",
+    "reply_count": "reply_count",
+    "collected_at": "collected_at",
+}
+SINGLE_POSTS_COLUMNS = {
+    "username": "handle",
+    "user_id": "did",
+    "post_uri": "post_uri",
+    "post_cid": "post_cid",
+    "post_text": "text",
+    "post_created_at": "created_at_post",
+    "post_indexed_at": "indexed_at_post",
+    "like_count": "like_count",
+    "repost_count": "repost_count",
+    "reply_count": "reply_count",
+    "collected_at": "collected_at",
+}
+
+# Type Python des valeurs d'une colonne -> type déclaré au COPY. Le COPY texte ne transmet que
+# du texte : le type sert seulement à choisir l'encodeur une fois pour toutes au lieu de le
+# chercher pour chaque valeur (write_row représente l'essentiel du temps côté client).
+COPY_TYPES = {str: "text", int: "int8", bool: "bool", float: "float8"}
+
+# Types des colonnes d'un lot, ou None si une colonne mélange plusieurs types (encodeur par valeur)
+def _copy_types(rows):
+    types = []
+    for column in zip(*rows):
+        kinds = set(map(type, column))
+        kinds.discard(type(None))
+        if len(kinds) > 1 or not kinds <= COPY_TYPES.keys():
+            return None
+        types.append(COPY_TYPES[kinds.pop()] if kinds else "text")
+    return types
+
+# COPY d'un lot de lignes dans la table de staging, dans un savepoint (un seul par lot
+# tant que tout passe). En cas d'échec, le lot est coupé en deux jusqu'à isoler les
+# lignes fautives, qui sont rejetées sans perdre le reste du lot.
+def _copy_isolating_bad_rows(conn, cur, staging, columns, rows, offset, rejected, types=None):
+    try:
+        with conn.transaction():
+            with cur.copy(f"COPY {staging} ({', '.join(columns)}) FROM STDIN") as copy:
+                if types:
+                    copy.set_types(types)
+                for row in rows:
+                    copy.write_row(row)
+    except psycopg.Error as e:
+        if len(rows) == 1:
+            rejected.append((offset, str(e).splitlines()[0]))
+            return
+        middle = len(rows) // 2
+        _copy_isolating_bad_rows(conn, cur, staging, columns, rows[:middle], offset, rejected, types)
+        _copy_isolating_bad_rows(conn, cur, staging, columns, rows[middle:], offset + middle, rejected, types)
+
+# Insertion en masse : COPY ... FROM STDIN dans une table temporaire, puis fusion
+# dans la table cible avec INSERT ... ON CONFLICT (key) DO NOTHING, ou DO UPDATE des
+# colonnes update_columns si elles sont données (upsert).
+# Renvoie le nombre de lignes insérées (ou mises à jour), ignorées (déjà présentes) et rejetées.
+def _conflict_action(update_columns):
+    if not update_columns:
+        return "DO NOTHING"
+    return "DO UPDATE SET " + ", ".join(f"{column} = EXCLUDED.{column}" for column in update_columns)
+
+def bulk_insert_rows(conn, table: str, columns: list, rows: list, key: str = "post_uri", update_columns: list = None):
+    staging = f"staging_{table}"
+    rejected = []
+    with timed(f"db_insert.{table}"), conn.transaction():
         with conn.cursor() as cur:
-            for i, row in df.iterrows():
-                try:
-                    cur.execute(sql, row.to_dict())
-                except Exception as e:
-                    print(f"❌ Erreur insertion bluesky_search_posts ligne {i}: {e}")
-                    conn.rollback()
-        conn.commit()
-    print(f"✅ {len(df)} posts insérés dans bluesky_search_posts.")
+            cur.execute(f"DROP TABLE IF EXISTS {staging}")
+            cur.execute(
+                f"CREATE TEMP TABLE {staging} "
+                f"(LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) ON COMMIT DROP"
+            )
+            _copy_isolating_bad_rows(conn, cur, staging, columns, rows, 0, rejected, _copy_types(rows))
+            cur.execute(
+                f"INSERT INTO {table} ({', '.join(columns)}) "
+                f"SELECT {', '.join(columns)} FROM {staging} "
+                f"ON CONFLICT ({key}) {_conflict_action(update_columns)}"
+            )
+            inserted = cur.rowcount
+    for index, error in rejected:
+        print(f"❌ Erreur insertion {table} ligne {index}: {error}")
+    result = {
+        "inserted": inserted,
+        "skipped": len(rows) - len(rejected) - inserted,
+        "rejected": len(rejected),
+    }
+    for key, count in result.items():
+        inc("db_rows_total", count, table=table, result=key)
+    return result
+
+# Auteurs des posts collectés, un par DID (mis à jour à chaque import)
+CREATE_AUTHORS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS bluesky_authors (
+        did TEXT PRIMARY KEY,
+        handle TEXT,
+        display_name TEXT,
+        bio TEXT,
+        followers_count INTEGER,
+        follows_count INTEGER,
+        posts_count INTEGER,
+        created_at_profile TIMESTAMPTZ,
+        indexed_at_profile TIMESTAMPTZ,
+        labels TEXT,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+"""
+
+# Colonnes d'auteur connues selon la source : profil réduit des PostView
+# (recherche, fil, post unique) ou profil complet (get_profile)
+POST_AUTHOR_COLUMNS = ["did", "handle", "display_name", "created_at_profile", "labels"]
+PROFILE_AUTHOR_COLUMNS = [
+    "did", "handle", "display_name", "bio",
+    "followers_count", "follows_count", "posts_count",
+    "created_at_profile", "indexed_at_profile", "labels",
+]
+
+_authors_table_ready = False
+
+def _ensure_authors_table(conn):
+    global _authors_table_ready
+    if not _authors_table_ready:
+        conn.execute(CREATE_AUTHORS_TABLE_SQL)
+        _authors_table_ready = True
 
+# Upsert des auteurs distincts d'un lot (une ligne par DID) ; seules les colonnes
+# fournies par la source sont mises à jour, les autres gardent leur valeur.
+def upsert_authors(conn, posts, columns: list = POST_AUTHOR_COLUMNS):
+    if not len(posts):
+        return 0
+    _ensure_authors_table(conn)
+    _, first = np.unique(posts["did"].astype(str), return_index=True)
+    authors = posts.take(np.sort(first))
+    result = bulk_insert_rows(conn, "bluesky_authors", columns, authors.rows(columns),
+                              key="did", update_columns=columns[1:] + ["updated_at"])
+    return result["inserted"]
 
+# Ingestion d'un lot de posts déjà collectés (PostBatch) : auteurs distincts puis posts,
+# dans une seule transaction (tout ou rien, hors lignes rejetées). Le rattachement aux
+# clusters de quasi-doublons se fait plus tard, hors insertion (prediction_backfill).
+def ingest_posts(table: str, columns: dict, posts, author_columns: list = POST_AUTHOR_COLUMNS):
+    if not len(posts):
+        return {"inserted": 0, "skipped": 0, "rejected": 0, "authors": 0}
+    with get_connection() as conn, conn.transaction():
+        authors = upsert_authors(conn, posts, author_columns)
+        result = bulk_insert_rows(conn, table, list(columns), posts.rows(columns.values()))
+    return {**result, "authors": authors}
+
+def _print_ingest_summary(table, result):
+    print(
+        f"✅ {result['inserted']} post(s) inséré(s) dans {table} "
+        f"({result['skipped']} déjà présent(s), {result['rejected']} rejeté(s), "
+        f"{result['authors']} auteur(s) à jour)."
+    )
+    return result
+
+def ingest_search_posts(posts):
+    return _print_ingest_summary("bluesky_search_posts", ingest_posts("bluesky_search_posts", SEARCH_POSTS_COLUMNS, posts))
+
+# Les posts du fil d'un compte sont rattachés à son profil complet (did, handle, bio, compteurs)
+def with_profile(user_data: dict, posts):
+    return posts.assign(**{name: value for name, value in user_data.items() if name in PROFILE_COLUMNS})
+
+def ingest_user_posts(user_data: dict, posts):
+    return _print_ingest_summary("bluesky_user_posts", ingest_posts(
+        "bluesky_user_posts", USER_POSTS_COLUMNS, with_profile(user_data, posts), PROFILE_AUTHOR_COLUMNS))
+
+def ingest_single_posts(posts):
+    return _print_ingest_summary("bluesky_single_posts", ingest_posts("bluesky_single_posts", SINGLE_POSTS_COLUMNS, posts))
+
+# Insère des pages de posts (PostBatch) au fil de l'eau : chaque page est ingérée
+# (auteurs + posts) et validée avant de lire la suivante, la mémoire ne dépend donc
+# pas de la limite.
+def insert_pages(table: str, columns: dict, pages, author_columns: list = POST_AUTHOR_COLUMNS):
+    totals = {"inserted": 0, "skipped": 0, "rejected": 0, "authors": 0, "pages": 0}
+    for page in pages:
+        if not len(page):
+            continue
+        result = ingest_posts(table, columns, page, author_columns)
+        for key in ("inserted", "skipped", "rejected", "authors"):
+            totals[key] += result[key]
+        totals["pages"] += 1
+    print(
+        f"✅ {totals['inserted']} post(s) inséré(s) dans {table} en {totals['pages']} page(s) "
+        f"({totals['skipped']} déjà présent(s), {totals['rejected']} rejeté(s))."
+    )
+    return totals
+
+def insert_search_pages(pages):
+    return insert_pages("bluesky_search_posts", SEARCH_POSTS_COLUMNS, pages)
+
+def insert_user_pages(user_data: dict, pages):
+    return insert_pages("bluesky_user_posts", USER_POSTS_COLUMNS,
+                        (with_profile(user_data, page) for page in pages), PROFILE_AUTHOR_COLUMNS)
+
+def insert_single_pages(pages):
+    return insert_pages("bluesky_single_posts", SINGLE_POSTS_COLUMNS, pages)
+
+# Fonction pour insérer des posts de recherche Bluesky dans la base de données.
+# En mode incrémental, la pagination s'arrête dès qu'on rejoint les posts déjà collectés.
+def insert_bluesky_search_posts(query: str, limit: int = 100, lang: str = None, incremental: bool = True):
+    if incremental:
+        pages = iter_new_search_pages(query, limit=limit, lang=lang)
+    else:
+        pages = iter_search_pages(query, limit=limit, lang=lang)
+    return insert_search_pages(pages)
 
 
 ##### insertion des posts d'un compte 
-def insert_bluesky_user_posts(profile_url: str, limit: int = 100):
-    df = collect_user_posts_to_dataframe(profile_url, limit)
-    if df.empty:
-        print("⚠️ Aucun post user à insérer.")
+def insert_bluesky_user_posts(profile_url: str, limit: int = 100, incremental: bool = True):
+    handle = extract_handle_from_url(profile_url)
+    if not handle:
+        print("❌ Format de l’URL incorrect. Utilisez une URL de type https://bsky.social/profile/handle")
         return
-
-    column_map = {
-        "username": "username",
-        "user_id": "user_id",
-        "bio": "bio",
-        "followers_count": "followers_count",
-        "follows_count": "follows_count",
-        "posts_count": "posts_count",
-        "profile_created_at": "profile_created_at",
-        "post_uri": "post_uri",
-        "post_url": "post_url",
-        "post_text": "post_text",
-        "post_created_at": "post_created_at",
-        "post_indexed_at": "post_indexed_at",
-        "like_count": "like_count",
-        "repost_count": "repost_count",
-        "reply_count": "reply_count",
-        "collected_at": "collected_at",
-    }
-    df.rename(columns=column_map, inplace=True)
-
-    df = clean_dataframe_dates(df, [
-        "profile_created_at", "post_created_at",
-        "post_indexed_at", "collected_at"
-    ])
-
-    sql = """
-        INSERT INTO bluesky_user_posts (
-            username, user_id, bio,
-            followers_count, follows_count, posts_count,
-            profile_created_at,
-            post_uri, post_url, post_text,
-            post_created_at, post_indexed_at,
-            like_count, repost_count, reply_count,
-            collected_at
-        )
-        VALUES (
-            %(username)s, %(user_id)s, %(bio)s,
-            %(followers_count)s, %(follows_count)s, %(posts_count)s,
-            %(profile_created_at)s,
-            %(post_uri)s, %(post_url)s, %(post_text)s,
-            %(post_created_at)s, %(post_indexed_at)s,
-            %(like_count)s, %(repost_count)s, %(reply_count)s,
-            %(collected_at)s
-        )
-        ON CONFLICT (post_uri) DO NOTHING;
-    """
-    with psycopg.connect(DB_URL) as conn:
-        with conn.cursor() as cur:
-            for i, row in df.iterrows():
-                try:
-                    cur.execute(sql, row.to_dict())
-                except Exception as e:
-                    print(f"❌ Erreur insertion bluesky_user_posts ligne {i}: {e}")
-                    conn.rollback()
-        conn.commit()
-    print(f"✅ {len(df)} posts insérés dans bluesky_user_posts.")
+    user_data = fetch_profile(handle)
+    if incremental:
+        pages = iter_new_author_feed_pages(handle, limit)
+    else:
+        pages = iter_author_feed_pages(handle, limit)
+    return insert_user_pages(user_data, pages)
 
  
 #### insertion d'un tweet à la fois 
 def insert_bluesky_single_post(post_url: str):
-    df = collect_single_post_to_dataframe(post_url)
-    if df.empty:
-        print("⚠️ Aucun single post à insérer.")
-        return
-
-    column_map = {
-        "username": "username",
-        "user_id": "user_id",
-        "post_uri": "post_uri",
-        "post_cid": "post_cid",
-        "post_text": "post_text",
-        "post_created_at": "post_created_at",
-        "post_indexed_at": "post_indexed_at",
-        "like_count": "like_count",
-        "repost_count": "repost_count",
-        "reply_count": "reply_count",
-        "collected_at": "collected_at",
-    }
-    df.rename(columns=column_map, inplace=True)
-
-    df = clean_dataframe_dates(df, [
-        "post_created_at", "post_indexed_at", "collected_at"
-    ])
-
-    sql = """
-        INSERT INTO bluesky_single_posts (
-            username, user_id,
-            post_uri, post_cid, post_text,
-            post_created_at, post_indexed_at,
-            like_count, repost_count, reply_count,
-            collected_at
-        )
-        VALUES (
-            %(username)s, %(user_id)s,
-            %(post_uri)s, %(post_cid)s, %(post_text)s,
-            %(post_created_at)s, %(post_indexed_at)s,
-            %(like_count)s, %(repost_count)s, %(reply_count)s,
-            %(collected_at)s
-        )
-        ON CONFLICT (post_uri) DO NOTHING;
-    """
-    with psycopg.connect(DB_URL) as conn:
-        with conn.cursor() as cur:
-            for i, row in df.iterrows():
-                try:
-                    cur.execute(sql, row.to_dict())
-                except Exception as e:
-                    print(f"❌ Erreur insertion bluesky_single_posts ligne {i}: {e}")
-                    conn.rollback()
-        conn.commit()
-    print(f"✅ {len(df)} post(s) inséré(s) dans bluesky_single_posts.")
+    return insert_single_pages([fetch_post_from_url(post_url)])
 
 
 #insert_tweet = insert_bluesky_search_posts("political", limit=10, lang="en")
@@ -0,0 +1,614 @@
+import argparse
+import fcntl
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+from metrics import timed, inc
+
+# Embeddings des posts (encodeur du modèle fake news) et recherche des plus proches voisins :
+# "à quelles fausses informations connues ce post ressemble-t-il ?"
+# - l'embedding est la moyenne de la dernière couche cachée, calculée dans la même passe
+#   que la classification (bert_finetune.predict_and_embed), normalisée : produit scalaire = cosinus ;
+# - vecteurs : un fichier float16 append-only par version du modèle (EMBEDDING_STORE_DIR/<MODEL_ID>/
+#   vectors.f16, lu par mmap) ; la ligne de chaque post est dans post_embeddings ;
+# - index IVF (k-means sphérique) : centroïdes + lignes regroupées par liste ; une requête ne lit
+#   que les EMBEDDING_INDEX_NPROBE listes les plus proches, plus les lignes ajoutées depuis la
+#   construction (au plus EMBEDDING_INDEX_MAX_TAIL, parcourues exactement) : latence bornée ;
+# - sans index (ou petit volume) : parcours exact NumPy par blocs ;
+# - fausses informations connues : known_claims, embedding stocké dans la table (quelques
+#   milliers de lignes, comparées exactement en mémoire).
+# Les quasi-doublons rattachés à un cluster ne sont pas re-notés (near_duplicates) : l'embedding
+# du représentant les couvre.
+# Construction / reconstruction de l'index : python embedding_store.py index
+
+EMBEDDING_STORE_ENABLED = os.getenv("EMBEDDING_STORE_ENABLED", "1") == "1"
+EMBEDDING_STORE_DIR = os.getenv("EMBEDDING_STORE_DIR", "./embedding_store")
+# Listes de l'index parcourues par requête (compromis rappel / latence)
+EMBEDDING_INDEX_NPROBE = int(os.getenv("EMBEDDING_INDEX_NPROBE", "8"))
+# En dessous de ce nombre de vecteurs, pas d'index : le parcours exact est assez rapide
+EMBEDDING_INDEX_MIN_ROWS = int(os.getenv("EMBEDDING_INDEX_MIN_ROWS", "20000"))
+# Vecteurs ajoutés depuis la construction de l'index au-delà desquels il est reconstruit
+EMBEDDING_INDEX_MAX_TAIL = int(os.getenv("EMBEDDING_INDEX_MAX_TAIL", "50000"))
+SCAN_CHUNK_ROWS = 65536
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_PER_LIST = 64
+
+CREATE_EMBEDDING_TABLES_SQL = """
+    CREATE TABLE IF NOT EXISTS post_embeddings (
+        model_id TEXT NOT NULL,
+        post_uri TEXT NOT NULL,
+        row_id BIGINT NOT NULL,
+        embedded_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (model_id, post_uri)
+    );
+    CREATE INDEX IF NOT EXISTS post_embeddings_row_idx ON post_embeddings (model_id, row_id);
+    CREATE TABLE IF NOT EXISTS known_claims (
+        claim_id BIGSERIAL PRIMARY KEY,
+        text TEXT NOT NULL,
+        source TEXT,
+        model_id TEXT,
+        embedding BYTEA,
+        added_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+"""
+
+_table_ready = False
+_stores = {}
+_stores_lock = threading.Lock()
+_claims = None
+# Incrémenté à chaque ajout : un chargement commencé avant n'écrase pas l'invalidation
+_claims_generation = 0
+_claims_lock = threading.Lock()
+
+
+def _ensure_tables(conn):
+    global _table_ready
+    if not _table_ready:
+        conn.execute(CREATE_EMBEDDING_TABLES_SQL)
+        _table_ready = True
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+# Les k meilleurs (indice, score) parmi scores, triés par score décroissant
+def _top_k(ids, scores, k):
+    if len(scores) > k:
+        best = np.argpartition(-scores, k - 1)[:k]
+        ids, scores = ids[best], scores[best]
+    order = np.argsort(-scores, kind="stable")
+    return ids[order], scores[order]
+
+
+# Liste (centroïde le plus proche) de chaque vecteur, par blocs pour borner la mémoire
+def _assign(vectors, centroids):
+    assignment = np.empty(len(vectors), dtype=np.int32)
+    chunk_rows = max(1, min(SCAN_CHUNK_ROWS, (64 << 20) // (4 * len(centroids))))
+    for start in range(0, len(vectors), chunk_rows):
+        chunk = np.asarray(vectors[start:start + chunk_rows], dtype=np.float32)
+        assignment[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignment
+
+
+class IvfIndex:
+    def __init__(self, centroids, rows, offsets, rows_indexed):
+        self.centroids = centroids
+        self.rows = rows
+        self.offsets = offsets
+        self.rows_indexed = rows_indexed
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    # k-means sphérique sur un échantillon, puis affectation de toutes les lignes par blocs
+    @classmethod
+    def build(cls, vectors, nlist=None, seed=0):
+        n = len(vectors)
+        nlist = min(n, nlist or max(1, int(4 * np.sqrt(n))))
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(n, min(n, nlist * KMEANS_SAMPLE_PER_LIST), replace=False))
+        sample = vectors[sample_rows].astype(np.float32)
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(KMEANS_ITERATIONS):
+            assignment = _assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = np.bincount(assignment, minlength=nlist) == 0
+            # Liste vide : recentrée sur un point tiré au hasard
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            centroids = _normalize(sums)
+
+        assignment = _assign(vectors, centroids)
+        # Tri stable : dans chaque liste, lignes croissantes (lectures dans l'ordre du fichier)
+        rows = np.argsort(assignment, kind="stable").astype(np.int64)
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=nlist), out=offsets[1:])
+        return cls(centroids.astype(np.float32), rows, offsets, n)
+
+    def candidates(self, query, nprobe):
+        nprobe = min(nprobe, self.nlist)
+        lists = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        return np.sort(np.concatenate([self.rows[self.offsets[l]:self.offsets[l + 1]] for l in lists]))
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, "centroids.npy"), self.centroids)
+        np.save(os.path.join(tmp_path, "rows.npy"), self.rows)
+        np.save(os.path.join(tmp_path, "offsets.npy"), self.offsets)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({"rows_indexed": self.rows_indexed, "nlist": self.nlist}, f)
+        # Remplacement par renommages : un lecteur garde l'ancien index mappé jusqu'au rechargement
+        old_path = f"{path}.old"
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(path):
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        return cls(
+            np.load(os.path.join(path, "centroids.npy")),
+            np.load(os.path.join(path, "rows.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "offsets.npy")),
+            meta["rows_indexed"],
+        )
+
+
+# Vecteurs d'une version du modèle : fichier float16 (n, dimension) + index IVF éventuel
+class EmbeddingStore:
+    def __init__(self, model_id, directory=EMBEDDING_STORE_DIR):
+        self.model_id = model_id
+        self.directory = os.path.join(directory, model_id.replace("/", "_"))
+        self.vectors_path = os.path.join(self.directory, "vectors.f16")
+        self.meta_path = os.path.join(self.directory, "meta.json")
+        self.index_path = os.path.join(self.directory, "ivf")
+        self.dim = None
+        self._dimension()
+        self._vectors = None
+        self._index = None
+        self._index_mtime = None
+        self._lock = threading.Lock()
+
+    # Dimension des vecteurs : meta.json est relu tant qu'il n'existe pas (premier append fait
+    # par un autre processus, ou après la création de ce stockage)
+    def _dimension(self):
+        if self.dim is None and os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.dim = json.load(f)["dim"]
+        return self.dim
+
+    def __len__(self):
+        if self._dimension() is None or not os.path.exists(self.vectors_path):
+            return 0
+        return os.path.getsize(self.vectors_path) // (self.dim * 2)
+
+    # Vue mmap de toutes les lignes écrites (rouverte quand le fichier a grandi)
+    def vectors(self):
+        n = len(self)
+        with self._lock:
+            if self._vectors is None or len(self._vectors) != n:
+                self._vectors = np.memmap(self.vectors_path, dtype=np.float16, mode="r",
+                                          shape=(n, self.dim)) if n else np.empty((0, self.dim or 0), np.float16)
+            return self._vectors
+
+    # Verrou exclusif entre processus sur le stockage (vérification + ajout + enregistrement
+    # des lignes dans post_embeddings)
+    @contextmanager
+    def locked(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    # Ajoute des vecteurs en fin de fichier (verrou exclusif : plusieurs processus peuvent écrire)
+    # et renvoie le numéro de la première ligne écrite
+    def append(self, embeddings):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float16)
+        os.makedirs(self.directory, exist_ok=True)
+        if self._dimension() is None:
+            self.dim = int(embeddings.shape[1])
+            # Écrit puis renommé : un lecteur ne voit jamais un meta.json partiel
+            tmp_path = f"{self.meta_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"dim": self.dim, "model_id": self.model_id}, f)
+            os.replace(tmp_path, self.meta_path)
+        elif embeddings.shape[1] != self.dim:
+            raise ValueError(f"Dimension {embeddings.shape[1]} différente de celle du stockage ({self.dim})")
+        row_bytes = self.dim * 2
+        with open(self.vectors_path, "ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                size = f.seek(0, os.SEEK_END)
+                if size % row_bytes:
+                    # Ligne incomplète (écriture interrompue) : écartée
+                    f.truncate(size - size % row_bytes)
+                    size -= size % row_bytes
+                f.write(embeddings.tobytes())
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return size // row_bytes
+
+    def load_index(self):
+        meta = os.path.join(self.index_path, "meta.json")
+        if not os.path.exists(meta):
+            return None
+        mtime = os.path.getmtime(meta)
+        with self._lock:
+            if self._index is None or self._index_mtime != mtime:
+                self._index = IvfIndex.load(self.index_path)
+                self._index_mtime = mtime
+            return self._index
+
+    def build_index(self, nlist=None):
+        vectors = self.vectors()
+        if not len(vectors):
+            return None
+        start = time.perf_counter()
+        index = IvfIndex.build(vectors, nlist)
+        index.save(self.index_path)
+        print(f"✅ Index IVF : {index.rows_indexed} vecteur(s), {index.nlist} liste(s), "
+              f"construit en {time.perf_counter() - start:.1f}s")
+        return index
+
+    def index_is_stale(self):
+        n = len(self)
+        if n < EMBEDDING_INDEX_MIN_ROWS:
+            return False
+        index = self.load_index()
+        return index is None or n - index.rows_indexed > EMBEDDING_INDEX_MAX_TAIL
+
+    # Les k lignes les plus proches de query : [(ligne, cosinus), ...]
+    # exact=True (ou pas d'index, ou petit volume) : parcours complet
+    def search(self, query, k=10, nprobe=EMBEDDING_INDEX_NPROBE, exact=False):
+        vectors = self.vectors()
+        n = len(vectors)
+        if not n:
+            return []
+        query = _normalize(query)
+        index = None if exact or n < EMBEDDING_INDEX_MIN_ROWS else self.load_index()
+        parts = []
+        if index is None:
+            tail_start = 0
+        else:
+            rows = index.candidates(query, nprobe)
+            parts.append(self._score_rows(vectors, rows, query, k))
+            tail_start = index.rows_indexed
+        for start in range(tail_start, n, SCAN_CHUNK_ROWS):
+            chunk = np.asarray(vectors[start:start + SCAN_CHUNK_ROWS], dtype=np.float32)
+            parts.append(_top_k(np.arange(start, start + len(chunk)), chunk @ query, k))
+        ids = np.concatenate([part[0] for part in parts])
+        scores = np.concatenate([part[1] for part in parts])
+        ids, scores = _top_k(ids, scores, k)
+        return [(int(row), float(score)) for row, score in zip(ids, scores)]
+
+    @staticmethod
+    def _score_rows(vectors, rows, query, k):
+        ids, scores = [], []
+        for start in range(0, len(rows), SCAN_CHUNK_ROWS):
+            chunk_rows = rows[start:start + SCAN_CHUNK_ROWS]
+            best = _top_k(chunk_rows, np.asarray(vectors[chunk_rows], dtype=np.float32) @ query, k)
+            ids.append(best[0])
+            scores.append(best[1])
+        if not ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        return np.concatenate(ids), np.concatenate(scores)
+
+    def stats(self):
+        index = self.load_index()
+        return {
+            "model_id": self.model_id,
+            "directory": self.directory,
+            "dim": self._dimension(),
+            "rows": len(self),
+            "bytes": os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0,
+            "index": {"nlist": index.nlist, "rows_indexed": index.rows_indexed} if index else None,
+        }
+
+
+# Stockage de la version courante du modèle fake news
+def get_store(model_id=None):
+    if model_id is None:
+        from bert_finetune import MODEL_ID as model_id
+    with _stores_lock:
+        if model_id not in _stores:
+            _stores[model_id] = EmbeddingStore(model_id)
+        return _stores[model_id]
+
+
+# Enregistre les embeddings d'un lot de posts (déjà présents : ignorés). Vérification, ajout
+# au fichier et lignes de post_embeddings (validées) sous le verrou du stockage : deux
+# processus n'ajoutent jamais deux fois le même post
+def save_embeddings(post_uris, embeddings, model_id=None):
+    from db import get_connection
+    if not EMBEDDING_STORE_ENABLED or embeddings is None or not len(post_uris):
+        return 0
+    store = get_store(model_id)
+    with get_connection() as conn:
+        _ensure_tables(conn)
+        conn.commit()
+        with store.locked():
+            known = {uri for (uri,) in conn.execute(
+                "SELECT post_uri FROM post_embeddings WHERE model_id = %s AND post_uri = ANY(%s)",
+                (store.model_id, list(post_uris))).fetchall()}
+            keep = [i for i, uri in enumerate(post_uris) if uri not in known]
+            if not keep:
+                return 0
+            first_row = store.append(embeddings[keep])
+            conn.execute(
+                "INSERT INTO post_embeddings (model_id, post_uri, row_id) "
+                "SELECT %s, unnest(%s::text[]), unnest(%s::bigint[]) ON CONFLICT DO NOTHING",
+                (store.model_id, [post_uris[i] for i in keep], list(range(first_row, first_row + len(keep)))),
+            )
+            conn.commit()
+    inc("post_embeddings_total", len(keep))
+    return len(keep)
+
+
+def embed_texts(texts):
+    from bert_finetune import predict_and_embed
+    _, embeddings = predict_and_embed(texts)
+    return embeddings
+
+
+# Vecteur de requête : texte libre, ou embedding déjà stocké d'un post
+def _query_vector(text=None, post_uri=None):
+    from db import get_connection
+    if text:
+        return embed_texts([text])[0]
+    if not post_uri:
+        raise ValueError("Indiquez un texte ou un post_uri")
+    store = get_store()
+    with get_connection() as conn:
+        _ensure_tables(conn)
+        row = conn.execute("SELECT row_id FROM post_embeddings WHERE model_id = %s AND post_uri = %s",
+                           (store.model_id, post_uri)).fetchone()
+    if row is None:
+        raise LookupError(f"Pas d'embedding pour {post_uri}")
+    return np.asarray(store.vectors()[row[0]])
+
+
+def _post_texts(conn, post_uris):
+    from psycopg import sql
+    from post_search import SOURCES, _table_column
+    query = sql.SQL(" UNION ALL ").join(
+        sql.SQL("SELECT post_uri, {text} FROM {table} WHERE post_uri = ANY(%(uris)s)").format(
+            text=sql.Identifier(_table_column(source, "text")), table=sql.Identifier(table))
+        for source, (table, _) in SOURCES.items()
+    )
+    return dict(conn.execute(query, {"uris": list(post_uris)}).fetchall())
+
+
+# Posts les plus proches d'un texte ou d'un post stocké
+def similar_posts(text: str = None, post_uri: str = None, k: int = 10, exact: bool = False):
+    from db import get_connection
+    query = _query_vector(text, post_uri)
+    store = get_store()
+    with timed("embedding_search"):
+        # Une ligne de plus : le post de la requête se retrouve lui-même
+        found = store.search(query, k + 1 if post_uri else k, exact=exact)
+    if not found:
+        return []
+    with get_connection() as conn:
+        _ensure_tables(conn)
+        uris = dict(conn.execute(
+            "SELECT row_id, post_uri FROM post_embeddings WHERE model_id = %s AND row_id = ANY(%s)",
+            (store.model_id, [row for row, _ in found])).fetchall())
+        texts = _post_texts(conn, uris.values())
+    results = [
+        {"post_uri": uris[row], "similarity": round(score, 4), "text": texts.get(uris[row])}
+        for row, score in found
+        if row in uris and uris[row] != post_uri
+    ]
+    return results[:k]
+
+
+def add_claim(text: str, source: str = None):
+    from db import get_connection
+    from bert_finetune import MODEL_ID
+    global _claims, _claims_generation
+    embedding = embed_texts([text])[0].astype(np.float16)
+    with get_connection() as conn:
+        _ensure_tables(conn)
+        claim_id, added_at = conn.execute(
+            "INSERT INTO known_claims (text, source, model_id, embedding) VALUES (%s, %s, %s, %s) "
+            "RETURNING claim_id, added_at",
+            (text, source, MODEL_ID, embedding.tobytes()),
+        ).fetchone()
+    with _claims_lock:
+        _claims = None
+        _claims_generation += 1
+    return {"claim_id": claim_id, "text": text, "source": source, "added_at": added_at}
+
+
+def list_claims(limit: int = 100):
+    from db import get_connection
+    with get_connection() as conn:
+        _ensure_tables(conn)
+        cur = conn.execute(
+            "SELECT claim_id, text, source, added_at FROM known_claims ORDER BY claim_id DESC LIMIT %s", (limit,))
+        names = [column.name for column in cur.description]
+        return [dict(zip(names, row)) for row in cur.fetchall()]
+
+
+# Matrice des embeddings des fausses informations connues (en mémoire) ; celles encodées
+# par une autre version du modèle sont ré-encodées au chargement, hors verrou : les
+# recherches ne sont pas bloquées par l'inférence
+def _load_claims():
+    from db import get_connection
+    from bert_finetune import MODEL_ID
+    global _claims
+    with _claims_lock:
+        if _claims is not None:
+            return _claims
+        generation = _claims_generation
+    with get_connection() as conn:
+        _ensure_tables(conn)
+        rows = conn.execute(
+            "SELECT claim_id, text, source, model_id, embedding FROM known_claims ORDER BY claim_id"
+        ).fetchall()
+    stale = [i for i, row in enumerate(rows) if row[3] != MODEL_ID or row[4] is None]
+    if stale:
+        embeddings = embed_texts([rows[i][1] for i in stale]).astype(np.float16)
+        with get_connection() as conn:
+            for i, embedding in zip(stale, embeddings):
+                conn.execute("UPDATE known_claims SET model_id = %s, embedding = %s WHERE claim_id = %s",
+                             (MODEL_ID, embedding.tobytes(), rows[i][0]))
+                rows[i] = (*rows[i][:3], MODEL_ID, embedding.tobytes())
+    matrix = np.stack([np.frombuffer(row[4], dtype=np.float16) for row in rows]).astype(np.float32) \
+        if rows else None
+    claims = ([{"claim_id": row[0], "text": row[1], "source": row[2]} for row in rows], matrix)
+    with _claims_lock:
+        if _claims_generation == generation:
+            _claims = claims
+    return claims
+
+
+# Fausses informations connues les plus proches d'un texte ou d'un post stocké
+def similar_claims(text: str = None, post_uri: str = None, k: int = 5):
+    claims, matrix = _load_claims()
+    if matrix is None:
+        return []
+    query = _normalize(_query_vector(text, post_uri))
+    ids, scores = _top_k(np.arange(len(claims)), matrix @ query, k)
+    return [{**claims[i], "similarity": round(float(score), 4)} for i, score in zip(ids, scores)]
+
+
+def rebuild_index_if_stale():
+    store = get_store()
+    if store.index_is_stale():
+        store.build_index()
+
+
+def embedding_stats():
+    return get_store().stats()
+
+
+# Encode les posts stockés sans embedding pour la version courante (les prédictions de la même
+# passe sont enregistrées au passage), puis (re)construit l'index si besoin
+def build(sources=None, chunk_size=1024):
+    from psycopg import sql
+    from db import get_connection
+    from post_search import SOURCES
+    from predictions import save_predictions
+    from bert_finetune import predict_and_embed, probabilities_to_scores, MODEL_NAME, MODEL_ID
+    for source in sources or list(SOURCES):
+        table, columns = SOURCES[source]
+        text = next(column for column, canonical in columns.items() if canonical == "text")
+        query = sql.SQL(
+            "SELECT p.post_uri, p.{text} FROM {table} p WHERE p.post_uri > %s AND NOT EXISTS "
+            "(SELECT 1 FROM post_embeddings e WHERE e.model_id = %s AND e.post_uri = p.post_uri) "
+            "ORDER BY p.post_uri LIMIT %s"
+        ).format(text=sql.Identifier(text), table=sql.Identifier(table))
+        last_post_uri = ""
+        added = 0
+        start = time.perf_counter()
+        while True:
+            with get_connection() as conn:
+                _ensure_tables(conn)
+                rows = conn.execute(query, (last_post_uri, MODEL_ID, chunk_size)).fetchall()
+            if not rows:
+                break
+            post_uris = [uri for uri, _ in rows]
+            results, embeddings = predict_and_embed([text or "" for _, text in rows], post_uris=post_uris)
+            with get_connection() as conn:
+                save_predictions(conn, MODEL_NAME, MODEL_ID, post_uris, [label for label, _ in results],
+                                 [probabilities_to_scores(prob_array) for _, prob_array in results])
+            added += save_embeddings(post_uris, embeddings)
+            last_post_uri = post_uris[-1]
+        print(f"✅ {added} embedding(s) ajouté(s) pour {source} en {time.perf_counter() - start:.1f}s.")
+    rebuild_index_if_stale()
+
+
+# Latence (p50 / p99) et rappel@k de l'index IVF par rapport au parcours exact
+def benchmark(queries=100, k=10, nprobe=EMBEDDING_INDEX_NPROBE):
+    store = get_store()
+    vectors = store.vectors()
+    if store.load_index() is None:
+        store.build_index()
+    rng = np.random.default_rng(1)
+    rows = rng.choice(len(vectors), min(queries, len(vectors)), replace=False)
+    report = {"rows": len(vectors), "k": k, "nprobe": nprobe}
+    exact_results = {}
+    for exact in (True, False):
+        latencies = []
+        recall = []
+        for row in rows:
+            query = np.asarray(vectors[row], dtype=np.float32)
+            start = time.perf_counter()
+            found = store.search(query, k, nprobe, exact=exact)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if exact:
+                exact_results[row] = {r for r, _ in found}
+            else:
+                recall.append(len(exact_results[row] & {r for r, _ in found}) / max(1, len(exact_results[row])))
+        name = "exact" if exact else "ivf"
+        report[f"{name}_p50_ms"] = round(float(np.percentile(latencies, 50)), 2)
+        report[f"{name}_p99_ms"] = round(float(np.percentile(latencies, 99)), 2)
+        if recall:
+            report[f"recall_at_{k}"] = round(float(np.mean(recall)), 3)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Embeddings des posts et recherche de posts / fausses informations proches")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build_parser = sub.add_parser("build", help="Encode les posts stockés sans embedding")
+    build_parser.add_argument("--source", nargs="+", choices=["search", "user", "single"])
+    build_parser.add_argument("--chunk-size", type=int, default=1024)
+    index_parser = sub.add_parser("index", help="(Re)construit l'index IVF")
+    index_parser.add_argument("--nlist", type=int)
+    search_parser = sub.add_parser("search", help="Posts ou fausses informations proches d'un texte")
+    search_parser.add_argument("text")
+    search_parser.add_argument("--claims", action="store_true")
+    search_parser.add_argument("-k", type=int, default=10)
+    search_parser.add_argument("--exact", action="store_true")
+    claim_parser = sub.add_parser("add-claim", help="Ajoute une fausse information connue")
+    claim_parser.add_argument("text")
+    claim_parser.add_argument("--source")
+    bench_parser = sub.add_parser("bench", help="Latence et rappel de l'index IVF")
+    bench_parser.add_argument("--queries", type=int, default=100)
+    bench_parser.add_argument("--nprobe", type=int, default=EMBEDDING_INDEX_NPROBE)
+    sub.add_parser("stats", help="Taille du stockage et de l'index")
+
+    args = parser.parse_args(argv)
+    if args.command == "build":
+        build(args.source, args.chunk_size)
+    elif args.command == "index":
+        get_store().build_index(args.nlist)
+    elif args.command == "search":
+        if args.claims:
+            results = similar_claims(args.text, k=args.k)
+        else:
+            results = similar_posts(args.text, k=args.k, exact=args.exact)
+        for result in results:
+            print(f"{result['similarity']:.3f}  {result['text']}")
+        return
+    elif args.command == "add-claim":
+        print(add_claim(args.text, args.source))
+        return
+    elif args.command == "bench":
+        print(json.dumps(benchmark(args.queries, nprobe=args.nprobe), indent=2))
+        return
+    print(json.dumps(embedding_stats(), indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
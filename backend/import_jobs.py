@@ -0,0 +1,332 @@
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timezone
+from collector import (
+    iter_search_pages,
+    fetch_profile,
+    iter_author_feed_pages,
+    fetch_post_from_url,
+    extract_handle_from_url
+)
+from checkpoints import iter_new_search_pages, iter_new_author_feed_pages
+from db import (
+    get_connection,
+    ingest_posts,
+    with_profile,
+    SEARCH_POSTS_COLUMNS,
+    USER_POSTS_COLUMNS,
+    SINGLE_POSTS_COLUMNS,
+    POST_AUTHOR_COLUMNS,
+    PROFILE_AUTHOR_COLUMNS,
+)
+
+# Imports en tâche de fond : la requête HTTP enregistre un job dans la table import_jobs
+# et renvoie son identifiant ; un pool borné de threads (IMPORT_JOB_WORKERS par processus)
+# réclame les jobs en file (FOR UPDATE SKIP LOCKED, donc sans doublon entre processus),
+# collecte et insère page par page en mettant à jour la progression.
+# - annulation : drapeau cancel_requested, vérifié entre deux pages ;
+# - redémarrage : un job interrompu repasse en file (arrêt propre, ou heartbeat trop
+#   ancien) et est relancé ; la collecte incrémentale (checkpoints) et ON CONFLICT
+#   évitent les doublons ;
+# - progression : tous les compteurs (pages, lignes, auteurs) et started_at repartent de zéro
+#   à chaque tentative : ils décrivent la tentative en cours, base de l'ETA (attempts compte
+#   les tentatives).
+
+IMPORT_JOB_WORKERS = int(os.getenv("IMPORT_JOB_WORKERS", "2"))
+IMPORT_JOB_POLL_SECONDS = float(os.getenv("IMPORT_JOB_POLL_SECONDS", "5"))
+IMPORT_JOB_STALE_SECONDS = float(os.getenv("IMPORT_JOB_STALE_SECONDS", "300"))
+
+CREATE_JOBS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS import_jobs (
+        id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        params JSONB NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        target_rows INTEGER,
+        pages_fetched INTEGER NOT NULL DEFAULT 0,
+        rows_collected INTEGER NOT NULL DEFAULT 0,
+        rows_inserted INTEGER NOT NULL DEFAULT 0,
+        rows_skipped INTEGER NOT NULL DEFAULT 0,
+        rows_rejected INTEGER NOT NULL DEFAULT 0,
+        authors INTEGER NOT NULL DEFAULT 0,
+        errors JSONB NOT NULL DEFAULT '[]',
+        cancel_requested BOOLEAN NOT NULL DEFAULT false,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        worker TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        started_at TIMESTAMPTZ,
+        heartbeat_at TIMESTAMPTZ,
+        finished_at TIMESTAMPTZ
+    );
+    CREATE INDEX IF NOT EXISTS import_jobs_queued_idx ON import_jobs (created_at) WHERE status = 'queued';
+"""
+
+JOB_COLUMNS = [
+    "id", "kind", "params", "status", "target_rows",
+    "pages_fetched", "rows_collected", "rows_inserted", "rows_skipped", "rows_rejected", "authors",
+    "errors", "cancel_requested", "attempts", "worker",
+    "created_at", "started_at", "heartbeat_at", "finished_at",
+]
+
+_table_ready = False
+_table_lock = threading.Lock()
+_threads = []
+_stop = threading.Event()
+_wakeup = threading.Event()
+
+
+# Création de la table à la première utilisation ; le verrou (thread + advisory lock
+# Postgres) évite les CREATE TABLE concurrents des workers et des requêtes
+def _connection():
+    global _table_ready
+    with _table_lock:
+        if not _table_ready:
+            with get_connection() as conn:
+                conn.execute("SELECT pg_advisory_xact_lock(hashtext('import_jobs'))")
+                conn.execute(CREATE_JOBS_TABLE_SQL)
+            _table_ready = True
+    return get_connection()
+
+
+def _job_dict(row):
+    job = dict(zip(JOB_COLUMNS, row))
+    job["eta_seconds"] = _eta_seconds(job)
+    return job
+
+
+# Temps restant estimé d'après le débit de la tentative en cours (posts collectés / s)
+def _eta_seconds(job):
+    if job["status"] != "running" or not job["started_at"] or not job["target_rows"]:
+        return None
+    if job["rows_collected"] <= 0:
+        return None
+    elapsed = (datetime.now(timezone.utc) - job["started_at"]).total_seconds()
+    remaining = max(job["target_rows"] - job["rows_collected"], 0)
+    return round(elapsed * remaining / job["rows_collected"], 1)
+
+
+# --- Sources : (table, colonnes, colonnes d'auteur, pages PostBatch) par type de job ---
+
+def _search_source(params):
+    query, limit, lang = params["query"], params.get("limit", 100), params.get("lang")
+    if params.get("incremental", True):
+        pages = iter_new_search_pages(query, limit=limit, lang=lang)
+    else:
+        pages = iter_search_pages(query, limit=limit, lang=lang)
+    return "bluesky_search_posts", SEARCH_POSTS_COLUMNS, POST_AUTHOR_COLUMNS, pages
+
+
+def _profile_source(params):
+    handle = extract_handle_from_url(params["profile_url"])
+    if not handle:
+        raise ValueError("URL de profil invalide")
+    limit = params.get("limit", 50)
+    user_data = fetch_profile(handle)
+    if params.get("incremental", True):
+        pages = iter_new_author_feed_pages(handle, limit)
+    else:
+        pages = iter_author_feed_pages(handle, limit)
+    return ("bluesky_user_posts", USER_POSTS_COLUMNS, PROFILE_AUTHOR_COLUMNS,
+            (with_profile(user_data, page) for page in pages))
+
+
+def _tweet_url_source(params):
+    return "bluesky_single_posts", SINGLE_POSTS_COLUMNS, POST_AUTHOR_COLUMNS, iter([fetch_post_from_url(params["tweet_url"])])
+
+
+JOB_SOURCES = {
+    "search": (_search_source, lambda params: params.get("limit", 100)),
+    "profile": (_profile_source, lambda params: params.get("limit", 50)),
+    "tweet_url": (_tweet_url_source, lambda params: 1),
+}
+
+
+# --- File des jobs ---
+
+def submit_job(kind: str, params: dict):
+    from psycopg.types.json import Jsonb
+    if kind not in JOB_SOURCES:
+        raise ValueError(f"Type de job inconnu : {kind} (choix : {', '.join(JOB_SOURCES)})")
+    job_id = uuid.uuid4().hex
+    target_rows = JOB_SOURCES[kind][1](params)
+    with _connection() as conn:
+        row = conn.execute(
+            f"INSERT INTO import_jobs (id, kind, params, target_rows) VALUES (%s, %s, %s, %s) "
+            f"RETURNING {', '.join(JOB_COLUMNS)}",
+            (job_id, kind, Jsonb(params), target_rows),
+        ).fetchone()
+    _wakeup.set()
+    return _job_dict(row)
+
+
+def get_job(job_id: str):
+    with _connection() as conn:
+        row = conn.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM import_jobs WHERE id = %s", (job_id,)).fetchone()
+    return _job_dict(row) if row else None
+
+
+def list_jobs(limit: int = 50, status: str = None):
+    with _connection() as conn:
+        rows = conn.execute(
+            f"SELECT {', '.join(JOB_COLUMNS)} FROM import_jobs "
+            f"WHERE %(status)s::text IS NULL OR status = %(status)s "
+            f"ORDER BY created_at DESC LIMIT %(limit)s",
+            {"status": status, "limit": limit},
+        ).fetchall()
+    return [_job_dict(row) for row in rows]
+
+
+# Un job en file est annulé tout de suite ; un job en cours s'arrête après la page en cours
+def cancel_job(job_id: str):
+    with _connection() as conn:
+        row = conn.execute(
+            f"""
+            UPDATE import_jobs SET
+                cancel_requested = true,
+                status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END,
+                finished_at = CASE WHEN status = 'queued' THEN now() ELSE finished_at END
+            WHERE id = %s
+            RETURNING {', '.join(JOB_COLUMNS)}
+            """,
+            (job_id,),
+        ).fetchone()
+    return _job_dict(row) if row else None
+
+
+# Remet en file les jobs "running" dont le worker ne donne plus signe de vie
+def requeue_stale_jobs(stale_seconds: float = IMPORT_JOB_STALE_SECONDS):
+    with _connection() as conn:
+        cur = conn.execute(
+            "UPDATE import_jobs SET status = 'queued', worker = NULL "
+            "WHERE status = 'running' AND heartbeat_at < now() - make_interval(secs => %s)",
+            (stale_seconds,),
+        )
+        requeued = cur.rowcount
+    if requeued:
+        print(f"⚠️ {requeued} job(s) d'import interrompu(s) remis en file.")
+    return requeued
+
+
+def _worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+
+
+def _claim_next_job():
+    with _connection() as conn:
+        row = conn.execute(
+            f"""
+            UPDATE import_jobs SET
+                status = 'running', worker = %s, attempts = attempts + 1,
+                started_at = now(), heartbeat_at = now(),
+                pages_fetched = 0, rows_collected = 0, rows_inserted = 0, rows_skipped = 0,
+                rows_rejected = 0, authors = 0
+            WHERE id = (
+                SELECT id FROM import_jobs WHERE status = 'queued'
+                ORDER BY created_at LIMIT 1 FOR UPDATE SKIP LOCKED
+            )
+            RETURNING {', '.join(JOB_COLUMNS)}
+            """,
+            (_worker_name(),),
+        ).fetchone()
+    return _job_dict(row) if row else None
+
+
+# Progression après une page ; renvoie True si l'annulation a été demandée
+def _record_progress(job_id, collected, result):
+    with _connection() as conn:
+        row = conn.execute(
+            """
+            UPDATE import_jobs SET
+                pages_fetched = pages_fetched + 1,
+                rows_collected = rows_collected + %s,
+                rows_inserted = rows_inserted + %s,
+                rows_skipped = rows_skipped + %s,
+                rows_rejected = rows_rejected + %s,
+                authors = authors + %s,
+                heartbeat_at = now()
+            WHERE id = %s
+            RETURNING cancel_requested
+            """,
+            (collected, result["inserted"], result["skipped"], result["rejected"], result["authors"], job_id),
+        ).fetchone()
+    return bool(row and row[0])
+
+
+def _finish_job(job_id, status, error=None):
+    from psycopg.types.json import Jsonb
+    with _connection() as conn:
+        conn.execute(
+            """
+            UPDATE import_jobs SET
+                status = %(status)s,
+                worker = CASE WHEN %(status)s = 'queued' THEN NULL ELSE worker END,
+                finished_at = CASE WHEN %(status)s = 'queued' THEN NULL ELSE now() END,
+                errors = errors || %(errors)s
+            WHERE id = %(id)s
+            """,
+            {"status": status, "errors": Jsonb([error] if error else []), "id": job_id},
+        )
+
+
+def _run_job(job):
+    job_id = job["id"]
+    status = "succeeded"
+    try:
+        source, _ = JOB_SOURCES[job["kind"]]
+        table, columns, author_columns, pages = source(job["params"])
+        for page in pages:
+            result = ingest_posts(table, columns, page, author_columns)
+            if _record_progress(job_id, len(page), result):
+                status = "cancelled"
+                break
+            if _stop.is_set():
+                # Arrêt du worker : le job sera repris par un autre worker ou au redémarrage
+                status = "queued"
+                break
+        if hasattr(pages, "close"):
+            pages.close()
+    except Exception as e:
+        print(f"❌ Job d'import {job_id} en échec : {e}")
+        _finish_job(job_id, "failed", str(e))
+        return
+    _finish_job(job_id, status)
+    print(f"✅ Job d'import {job_id} ({job['kind']}) : {status}")
+
+
+def _worker_loop():
+    while not _stop.is_set():
+        try:
+            job = _claim_next_job()
+            if job is None:
+                requeue_stale_jobs()
+        except Exception as e:
+            print(f"⚠️ File des jobs d'import indisponible : {e}")
+            job = None
+        if job is None:
+            _wakeup.wait(IMPORT_JOB_POLL_SECONDS)
+            _wakeup.clear()
+            continue
+        _run_job(job)
+
+
+# Démarre le pool de workers du processus (IMPORT_JOB_WORKERS=0 : aucun worker ici)
+def start_workers(count: int = IMPORT_JOB_WORKERS):
+    if _threads or count <= 0:
+        return
+    _stop.clear()
+    for i in range(count):
+        thread = threading.Thread(target=_worker_loop, name=f"import-job-{i}", daemon=True)
+        thread.start()
+        _threads.append(thread)
+    print(f"✅ {count} worker(s) d'import démarré(s).")
+
+
+# Arrêt propre : les jobs en cours s'arrêtent après leur page et repassent en file
+def stop_workers(timeout: float = 30):
+    _stop.set()
+    _wakeup.set()
+    for thread in _threads:
+        thread.join(timeout)
+    _threads.clear()
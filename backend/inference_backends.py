@@ -0,0 +1,177 @@
+import argparse
+import os
+import sys
+import time
+import torch
+from transformers import AutoTokenizer, AutoModelForSequenceClassification
+
+# Backends d'inférence CPU pour le modèle fake news (final_model_bert) :
+# - "torch" : modèle fp32 d'origine ;
+# - "int8"  : quantification dynamique int8 des couches Linear (torch) ;
+# - "onnx"  : graphe ONNX exporté, exécuté par onnxruntime.
+# Chaque backend renvoie (tokenizer, modèle) ; le modèle s'appelle comme un modèle
+# transformers : model(input_ids=..., attention_mask=...).logits
+
+BACKENDS = ["torch", "int8", "onnx"]
+# Backends qui exposent les états cachés (embeddings) : le graphe ONNX exporté ne sort que les logits
+EMBEDDING_BACKENDS = ["torch", "int8"]
+ONNX_FILENAME = "model.onnx"
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+# Enveloppe une session onnxruntime pour l'utiliser comme un modèle transformers
+class OnnxSequenceClassifier:
+    def __init__(self, onnx_path, num_threads=None):
+        if onnxruntime is None:
+            raise ImportError("Veuillez installer onnxruntime : pip install onnxruntime")
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+
+    def eval(self):
+        return self
+
+    def __call__(self, input_ids, attention_mask):
+        logits = self.session.run(["logits"], {
+            "input_ids": input_ids.cpu().numpy(),
+            "attention_mask": attention_mask.cpu().numpy(),
+        })[0]
+        return _Outputs(torch.from_numpy(logits))
+
+
+class _Outputs:
+    def __init__(self, logits):
+        self.logits = logits
+
+
+def supports_embeddings(backend):
+    return backend in EMBEDDING_BACKENDS
+
+
+def load_backend(backend, model_path, device=torch.device("cpu")):
+    if backend not in BACKENDS:
+        raise ValueError(f"Backend inconnu : {backend} (choix : {', '.join(BACKENDS)})")
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    if backend == "onnx":
+        onnx_path = os.path.join(model_path, ONNX_FILENAME)
+        if not os.path.exists(onnx_path):
+            raise FileNotFoundError(
+                f"{onnx_path} introuvable : lancez d'abord `python inference_backends.py export`"
+            )
+        return tokenizer, OnnxSequenceClassifier(onnx_path, torch.get_num_threads())
+
+    model = AutoModelForSequenceClassification.from_pretrained(model_path)
+    model.eval()
+    if backend == "int8":
+        # La quantification dynamique ne s'exécute que sur CPU
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return tokenizer, model
+    return tokenizer, model.to(device)
+
+
+# Exporte le modèle fp32 en ONNX (axes batch et séquence dynamiques)
+def export_onnx(model_path, output_path=None, opset=17):
+    output_path = output_path or os.path.join(model_path, ONNX_FILENAME)
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = AutoModelForSequenceClassification.from_pretrained(model_path)
+    model.eval()
+    model.config.return_dict = False
+    sample = tokenizer(["exemple de texte"], return_tensors="pt")
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (sample["input_ids"], sample["attention_mask"]),
+            output_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["logits"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "logits": {0: "batch"},
+            },
+            opset_version=opset,
+            dynamo=False,
+        )
+    print(f"✅ Modèle exporté en ONNX : {output_path}")
+    return output_path
+
+
+# Textes du jeu de validation : une colonne d'un CSV (séparateur ';' comme nos exports)
+def load_texts(csv_path=None, text_column="text", sep=";", limit=None):
+    if csv_path is None:
+        from bert_finetune import _sample_texts
+        return _sample_texts(limit or 512)
+    import pandas as pd
+    df = pd.read_csv(csv_path, sep=sep)
+    texts = df[text_column].dropna().astype(str).tolist()
+    return texts[:limit] if limit else texts
+
+
+# Compare chaque backend au fp32 : accord des labels, latence par lot et débit
+def compare_backends(texts, backends=None, model_path=None, batch_size=32):
+    from bert_finetune import MODEL_PATH, clean_tweets, _predict_cleaned_batch
+    model_path = model_path or MODEL_PATH
+    backends = backends or BACKENDS
+    cleaned_texts = clean_tweets(texts)
+
+    reference = None
+    report = {}
+    for backend in ["torch"] + [b for b in backends if b != "torch"]:
+        try:
+            loaded = load_backend(backend, model_path)
+        except (ImportError, FileNotFoundError) as e:
+            print(f"⚠️ Backend {backend} ignoré : {e}")
+            continue
+        _predict_cleaned_batch(cleaned_texts[:batch_size], batch_size, loaded=loaded)  # préchauffage
+        latencies = []
+        results = []
+        start = time.perf_counter()
+        for i in range(0, len(cleaned_texts), batch_size):
+            batch_start = time.perf_counter()
+            results.extend(_predict_cleaned_batch(cleaned_texts[i:i + batch_size], batch_size, loaded=loaded))
+            latencies.append((time.perf_counter() - batch_start) * 1000)
+        total = time.perf_counter() - start
+        labels = [label for label, _ in results]
+        if reference is None:
+            reference = labels
+        latencies.sort()
+        report[backend] = {
+            "textes_par_s": round(len(texts) / total, 1) if total else None,
+            "latence_lot_p50_ms": round(latencies[len(latencies) // 2], 2),
+            "latence_lot_p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 2),
+            "accord_avec_fp32": round(sum(a == b for a, b in zip(labels, reference)) / len(labels), 4),
+        }
+        print(f"{backend:>6} : {report[backend]}")
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Backends d'inférence du modèle fake news")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = sub.add_parser("export", help="Exporte final_model_bert en ONNX")
+    export_parser.add_argument("--model-path", default="./final_model_bert")
+    export_parser.add_argument("--output")
+
+    compare_parser = sub.add_parser("compare", help="Parité des labels et débit par backend")
+    compare_parser.add_argument("--csv", help="Jeu de validation (CSV ';'), textes synthétiques sinon")
+    compare_parser.add_argument("--text-column", default="text")
+    compare_parser.add_argument("--limit", type=int)
+    compare_parser.add_argument("--batch-size", type=int, default=32)
+    compare_parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=BACKENDS)
+
+    args = parser.parse_args(argv)
+    if args.command == "export":
+        export_onnx(args.model_path, args.output)
+    else:
+        texts = load_texts(args.csv, args.text_column, limit=args.limit)
+        compare_backends(texts, args.backends, batch_size=args.batch_size)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,384 @@
+import argparse
+import json
+import mmap
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from transformers import AutoConfig, AutoTokenizer, AutoModelForSequenceClassification
+
+try:
+    from transformers.initialization import no_init_weights
+except ImportError:
+    from transformers.modeling_utils import no_init_weights
+
+# Pool de processus d'inférence CPU pour le modèle fake news : N processus, chacun avec
+# torch.set_num_threads(T) (par défaut cœurs / N), au lieu d'un seul processus qui
+# n'exploite pas tous les cœurs ou de N workers uvicorn qui dupliquent chacun les poids.
+# - les poids sont lus depuis model.safetensors par mmap (copie à l'écriture, jamais écrite
+#   en inférence) : les pages viennent du cache du système et sont partagées entre les
+#   processus au lieu d'être recopiées dans chacun ;
+# - un Pipe par processus (pas de multiprocessing.Queue, ni de thread d'alimentation ni
+#   de verrou partagé) : le lot de textes part en un message, le résultat revient en un
+#   message (labels + tableau de probabilités) ;
+# - un lot est réparti entre les processus par longueur de texte (chaque processus reçoit
+#   des textes courts et longs), puis réassemblé dans l'ordre d'origine.
+# FAKE_NEWS_INFERENCE_WORKERS=0 (défaut) : inférence dans le processus, sans pool.
+
+FAKE_NEWS_INFERENCE_WORKERS = int(os.getenv("FAKE_NEWS_INFERENCE_WORKERS", "0"))
+# Threads torch par processus (0 : cœurs disponibles / nombre de processus)
+FAKE_NEWS_INFERENCE_THREADS = int(os.getenv("FAKE_NEWS_INFERENCE_THREADS", "0"))
+INFERENCE_WORKER_START_TIMEOUT = float(os.getenv("INFERENCE_WORKER_START_TIMEOUT", "300"))
+
+SAFETENSORS_FILENAME = "model.safetensors"
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8,
+    "U8": torch.uint8, "BOOL": torch.bool,
+}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# Tenseurs d'un fichier safetensors sans copie : vues torch sur un mmap du fichier
+def load_safetensors_mmap(path):
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    header_size = int.from_bytes(buffer[:8], "little")
+    header = json.loads(buffer[8:8 + header_size])
+    header.pop("__metadata__", None)
+    tensors = {}
+    for name, info in header.items():
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        count = (end - start) // torch.empty(0, dtype=dtype).element_size()
+        if count:
+            tensor = torch.frombuffer(buffer, dtype=dtype, count=count, offset=8 + header_size + start)
+        else:
+            tensor = torch.empty(0, dtype=dtype)
+        tensors[name] = tensor.view(info["shape"])
+    return tensors
+
+
+# (tokenizer, modèle) dont les poids pointent sur le mmap : le modèle est construit sans
+# initialisation (mémoire jamais touchée), puis ses paramètres sont remplacés par les vues
+def load_mmap_model(model_path):
+    path = os.path.join(model_path, SAFETENSORS_FILENAME)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} introuvable : le pool d'inférence lit les poids au format safetensors")
+    config = AutoConfig.from_pretrained(model_path)
+    with no_init_weights():
+        model = AutoModelForSequenceClassification.from_config(config)
+    missing, _ = model.load_state_dict(load_safetensors_mmap(path), strict=False, assign=True)
+    if missing:
+        raise ValueError(f"Poids absents de {path} : {', '.join(missing)}")
+    model.eval()
+    return AutoTokenizer.from_pretrained(model_path), model
+
+
+# Mémoire d'un processus en Mo (par défaut le processus courant) : RSS, PSS (pages partagées
+# réparties entre processus), partagée et privée (Linux : /proc/<pid>/smaps_rollup, lisible
+# depuis le parent sans interrompre le processus). None hors Linux pour un autre processus.
+def process_memory(pid=None):
+    fields = {}
+    try:
+        with open(f"/proc/{pid or 'self'}/smaps_rollup") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if value.strip().endswith("kB"):
+                    fields[key] = int(value.split()[0]) / 1024
+    except OSError:
+        if pid is not None:
+            return None
+        import resource
+        return {"pid": os.getpid(), "rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+    return {
+        "pid": pid or os.getpid(),
+        "rss_mb": round(fields.get("Rss", 0), 1),
+        "pss_mb": round(fields.get("Pss", 0), 1),
+        "shared_mb": round(fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0), 1),
+        "private_mb": round(fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0), 1),
+    }
+
+
+def _worker_main(conn, model_path, backend, num_threads):
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+    from bert_finetune import _predict_cleaned_batch, _predict_token_ids
+    try:
+        if backend == "torch":
+            loaded = load_mmap_model(model_path)
+        else:
+            from inference_backends import load_backend
+            loaded = load_backend(backend, model_path)
+    except Exception as e:
+        conn.send(("error", repr(e)))
+        return
+    conn.send(("ok", process_memory()))
+    while True:
+        try:
+            command, payload = conn.recv()
+        except EOFError:
+            break
+        if command == "stop":
+            break
+        try:
+            texts, encoded, batch_size, max_length, with_embeddings = payload
+            if encoded is not None:
+                output = _predict_token_ids(encoded, batch_size, loaded=loaded, with_embeddings=with_embeddings)
+            else:
+                output = _predict_cleaned_batch(texts, batch_size, max_length, loaded=loaded,
+                                                with_embeddings=with_embeddings)
+            results, embeddings = output if with_embeddings else (output, None)
+            conn.send(("ok", ([label for label, _ in results],
+                              np.stack([prob_array for _, prob_array in results]), embeddings)))
+        except Exception as e:
+            conn.send(("error", repr(e)))
+
+
+class InferencePool:
+    def __init__(self, workers, threads_per_worker=None, model_path=None, backend=None):
+        from bert_finetune import MODEL_PATH, INFERENCE_BACKEND
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+        self.model_path = model_path or MODEL_PATH
+        self.backend = backend or INFERENCE_BACKEND
+        self._context = multiprocessing.get_context("spawn")
+        self._processes = [None] * workers
+        self._conns = [None] * workers
+        # Dernier relevé mémoire envoyé par chaque processus (au démarrage) : repli hors Linux
+        self._memory = [None] * workers
+        self._idle = queue.Queue()
+        # Processus utilisables (un processus qui n'a pas pu être relancé est retiré)
+        self._alive = workers
+        self._executor = None
+
+    def _spawn(self, index):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(child_conn, self.model_path, self.backend, self.threads_per_worker),
+            name=f"inference-{index}",
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        self._processes[index] = process
+        self._conns[index] = parent_conn
+
+    def _wait_ready(self, index):
+        conn = self._conns[index]
+        if not conn.poll(INFERENCE_WORKER_START_TIMEOUT):
+            raise RuntimeError(f"Processus d'inférence {index} : pas prêt après {INFERENCE_WORKER_START_TIMEOUT}s")
+        status, payload = conn.recv()
+        if status != "ok":
+            raise RuntimeError(f"Processus d'inférence {index} : {payload}")
+        self._memory[index] = payload
+        return payload
+
+    def start(self):
+        start = time.perf_counter()
+        for index in range(self.workers):
+            self._spawn(index)
+        for index in range(self.workers):
+            self._wait_ready(index)
+            self._idle.put(index)
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="inference-dispatch")
+        print(
+            f"✅ Pool d'inférence : {self.workers} processus x {self.threads_per_worker} thread(s) "
+            f"({self.backend}) prêt en {time.perf_counter() - start:.1f}s"
+        )
+        return self
+
+    def _next_idle(self):
+        while True:
+            if not self._alive:
+                raise RuntimeError("Aucun processus d'inférence disponible")
+            try:
+                return self._idle.get(timeout=1)
+            except queue.Empty:
+                pass
+
+    # Processus qui n'a pas pu être relancé : retiré du pool (sa place n'est plus proposée)
+    def _drop(self, index, error):
+        print(f"⚠️ Processus d'inférence {index} non relancé ({error!r}) : retiré du pool")
+        process = self._processes[index]
+        if process is not None and process.is_alive():
+            process.terminate()
+        self._processes[index] = None
+        self._conns[index] = None
+        self._memory[index] = None
+        self._alive -= 1
+
+    # Envoie une commande au premier processus libre et attend sa réponse.
+    # Un processus mort est relancé avant de rendre l'erreur à l'appelant ; s'il ne redémarre
+    # pas, sa place est retirée du pool au lieu d'être rendue.
+    def _call(self, command, payload=None):
+        index = self._next_idle()
+        try:
+            conn = self._conns[index]
+            conn.send((command, payload))
+            status, result = conn.recv()
+        except (EOFError, OSError) as e:
+            print(f"⚠️ Processus d'inférence {index} arrêté ({e!r}), redémarrage")
+            try:
+                self._spawn(index)
+                self._wait_ready(index)
+            except Exception as restart_error:
+                self._drop(index, restart_error)
+                raise RuntimeError(f"Processus d'inférence {index} arrêté pendant le calcul et non relancé")
+            self._idle.put(index)
+            raise RuntimeError(f"Processus d'inférence {index} arrêté pendant le calcul")
+        except BaseException:
+            self._idle.put(index)
+            raise
+        self._idle.put(index)
+        if status != "ok":
+            raise RuntimeError(f"Processus d'inférence {index} : {result}")
+        return result
+
+    # Même format que bert_finetune._predict_cleaned_batch : [(label, probabilités), ...]
+    # (et embeddings si with_embeddings=True)
+    # encoded : tokens déjà calculés (cache de tokens), envoyés à la place des textes
+    def predict_cleaned(self, cleaned_texts, batch_size=32, max_length=128, encoded=None, with_embeddings=False):
+        from inference_backends import supports_embeddings
+        if with_embeddings and not supports_embeddings(self.backend):
+            raise ValueError(f"Embeddings indisponibles avec le backend {self.backend} (utilisez torch ou int8)")
+        if not cleaned_texts:
+            return ([], None) if with_embeddings else []
+        order = sorted(range(len(cleaned_texts)), key=lambda i: len(cleaned_texts[i]))
+        parts = [order[k::self.workers] for k in range(self.workers)]
+        parts = [part for part in parts if part]
+        futures = [
+            self._executor.submit(self._call, "predict", (
+                None if encoded is not None else [cleaned_texts[i] for i in part],
+                [encoded[i] for i in part] if encoded is not None else None,
+                batch_size, max_length, with_embeddings,
+            ))
+            for part in parts
+        ]
+        results = [None] * len(cleaned_texts)
+        all_embeddings = None
+        for part, future in zip(parts, futures):
+            labels, probabilities, embeddings = future.result()
+            for i, label, prob_array in zip(part, labels, probabilities):
+                results[i] = (label, prob_array)
+            if embeddings is not None:
+                if all_embeddings is None:
+                    all_embeddings = np.empty((len(cleaned_texts), embeddings.shape[1]), dtype=embeddings.dtype)
+                all_embeddings[part] = embeddings
+        if with_embeddings:
+            return results, all_embeddings
+        return results
+
+    # Mémoire de chaque processus (RSS, PSS, partagée, privée), lue depuis le parent :
+    # aucun processus n'est réservé, les prédictions en cours ne sont ni attendues ni bloquées
+    def stats(self):
+        memory = []
+        for index, process in enumerate(self._processes):
+            current = process_memory(process.pid) if process is not None else None
+            memory.append({"worker": index, **(current or self._memory[index] or {})})
+        return {
+            "workers": self.workers,
+            "threads_per_worker": self.threads_per_worker,
+            "backend": self.backend,
+            "alive": self._alive,
+            "processes": memory,
+        }
+
+    def stop(self):
+        for conn in self._conns:
+            try:
+                conn.send(("stop", None))
+            except (OSError, AttributeError):
+                pass
+        for process in self._processes:
+            if process is not None:
+                process.join(10)
+                if process.is_alive():
+                    process.terminate()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+# Pool partagé par le processus (API, scripts) : démarré au lancement si configuré
+def start_pool(workers: int = FAKE_NEWS_INFERENCE_WORKERS, threads_per_worker: int = FAKE_NEWS_INFERENCE_THREADS):
+    global _pool
+    with _pool_lock:
+        if _pool is None and workers > 0:
+            _pool = InferencePool(workers, threads_per_worker or None).start()
+    return _pool
+
+
+def stop_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.stop()
+            _pool = None
+
+
+def get_pool():
+    return _pool
+
+
+def pool_stats():
+    if _pool is None:
+        return {"workers": 0}
+    return _pool.stats()
+
+
+# Débit (textes/s) en fonction du nombre de processus, et mémoire par processus
+def benchmark(worker_counts, n_texts=2048, batch_size=32, threads_per_worker=None):
+    from bert_finetune import clean_tweets, _sample_texts
+    cleaned_texts = clean_tweets(_sample_texts(n_texts))
+    report = {}
+    baseline = None
+    for workers in worker_counts:
+        pool = InferencePool(workers, threads_per_worker).start()
+        try:
+            pool.predict_cleaned(cleaned_texts[:batch_size * workers], batch_size)  # préchauffage
+            start = time.perf_counter()
+            pool.predict_cleaned(cleaned_texts, batch_size)
+            seconds = time.perf_counter() - start
+            stats = pool.stats()
+        finally:
+            pool.stop()
+        throughput = n_texts / seconds
+        baseline = baseline or throughput / workers
+        report[workers] = {
+            "textes_par_s": round(throughput, 1),
+            "efficacite": round(throughput / (baseline * workers), 2),
+            "threads_par_processus": stats["threads_per_worker"],
+            "processus": stats["processes"],
+        }
+        print(f"{workers:>3} processus : {report[workers]['textes_par_s']} textes/s "
+              f"(efficacité {report[workers]['efficacite']})")
+        for memory in stats["processes"]:
+            print(f"      worker {memory['worker']} : RSS {memory.get('rss_mb')} Mo, "
+                  f"PSS {memory.get('pss_mb')} Mo, partagé {memory.get('shared_mb')} Mo")
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pool de processus d'inférence du modèle fake news")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--threads", type=int, help="Threads torch par processus (défaut : cœurs / processus)")
+    parser.add_argument("--texts", type=int, default=2048)
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args(argv)
+    benchmark(args.workers, args.texts, args.batch_size, args.threads)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
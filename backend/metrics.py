@@ -0,0 +1,147 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Métriques internes exposées au format texte Prometheus (/metrics) :
+# - histogrammes de durée par étape (appels API Bluesky, login, nettoyage DataFrame,
+#   insertions, passes avant des modèles, requêtes HTTP) ;
+# - compteurs (appels API, pages, lignes insérées / ignorées / rejetées, ...) ;
+# - histogramme des tailles de lots d'inférence.
+# timed() alimente aussi le détail par requête (en-tête Server-Timing) quand il est actif.
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+HELP = {
+    "stage_duration_seconds": "Durée des étapes du pipeline",
+    "inference_batch_size": "Taille des lots envoyés aux modèles",
+    "bluesky_api_calls_total": "Appels à l'API Bluesky",
+    "bluesky_pages_total": "Pages de résultats reçues de l'API Bluesky",
+    "bluesky_logins_total": "Connexions (createSession ou import de session) à Bluesky",
+    "db_rows_total": "Lignes traitées par les insertions en masse",
+    "http_requests_total": "Requêtes HTTP traitées",
+    "predictions_backfilled_total": "Posts notés par le rattrapage des prédictions",
+    "predictions_reused_total": "Prédictions reprises d'un quasi-doublon déjà noté",
+    "near_duplicate_posts_total": "Posts rattachés à un cluster de quasi-doublons",
+    "post_embeddings_total": "Embeddings de posts ajoutés au stockage",
+    "parquet_rows_exported_total": "Lignes écrites dans les exports Parquet",
+    "bluesky_responses_recorded_total": "Réponses de l'API Bluesky ajoutées à l'archive",
+    "bluesky_responses_replayed_total": "Réponses de l'API Bluesky rejouées depuis une archive",
+}
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    with _lock:
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, buckets=DURATION_BUCKETS, **labels):
+    with _lock:
+        key = _key(name, labels)
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(histogram["buckets"]):
+            if value <= bound:
+                histogram["counts"][i] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+# Mesure la durée d'une étape : histogramme global + détail de la requête en cours
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe("stage_duration_seconds", elapsed, stage=stage)
+        timings = _request_timings.get()
+        if timings is not None:
+            with _lock:
+                timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+# Active le détail des durées pour la requête courante ; renvoie le dict à lire en fin de requête
+def start_request_timings():
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+
+# Ajoute au détail de la requête courante des durées mesurées ailleurs (ex. lot d'inférence
+# partagé par plusieurs requêtes, exécuté dans un autre thread)
+def add_request_timings(stages):
+    timings = _request_timings.get()
+    if timings is not None:
+        with _lock:
+            for stage, seconds in stages.items():
+                timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+# En-tête Server-Timing : "etape;dur=12.3, autre;dur=4.5" (durées en ms)
+def server_timing_header(timings):
+    return ", ".join(f"{stage.replace(' ', '_')};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+
+
+# Valeur de label échappée selon le format d'exposition (\\, \" et \n)
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + (list(extra.items()) if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in items) + "}"
+
+
+# Export au format texte Prometheus ; gauges : {nom: valeur} ajoutés tels quels, ou
+# {nom: [(labels, valeur), ...]} pour une même mesure par label (ex. par worker)
+def render(gauges=None):
+    lines = []
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: {**h, "counts": list(h["counts"])} for key, h in _histograms.items()}
+
+    seen = set()
+    for (name, labels), value in sorted(counters.items()):
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    for (name, labels), histogram in sorted(histograms.items()):
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+        for bound, count in zip(histogram["buckets"], histogram["counts"]):
+            lines.append(f"{name}_bucket{_format_labels(labels, {'le': bound})} {count}")
+        lines.append(f"{name}_bucket{_format_labels(labels, {'le': '+Inf'})} {histogram['count']}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']}")
+        lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+
+    for name, value in sorted((gauges or {}).items()):
+        samples = [
+            (labels, sample) for labels, sample in (value if isinstance(value, list) else [({}, value)])
+            if isinstance(sample, (int, float)) and not isinstance(sample, bool)
+        ]
+        if samples:
+            lines.append(f"# TYPE {name} gauge")
+        for labels, sample in samples:
+            lines.append(f"{name}{_format_labels(sorted(labels.items()))} {sample}")
+    return "\n".join(lines) + "\n"
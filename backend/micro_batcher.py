@@ -0,0 +1,89 @@
+import asyncio
+import contextvars
+from metrics import start_request_timings, add_request_timings
+
+
+# Regroupe les requêtes concurrentes dans une file asyncio : un worker en tâche de
+# fond forme des lots (taille max / attente max) et appelle predict_fn une seule fois
+# par lot dans un thread, pour ne pas bloquer la boucle d'événements avec torch.
+# predict_fn reçoit une liste de textes et renvoie une liste de résultats dans le même ordre.
+# Les durées des étapes mesurées dans predict_fn (timed) sont reportées sur chaque requête
+# du lot (Server-Timing). À l'arrêt, les requêtes en attente échouent au lieu de rester bloquées.
+class MicroBatcher:
+    def __init__(self, predict_fn, max_batch_size=32, max_wait_ms=5):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = None
+        self._worker = None
+        # Lot en cours de formation ou de prédiction : [(texte, future), ...]
+        self._batch = []
+
+    async def start(self):
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+            pending = self._batch
+            self._batch = []
+            while not self._queue.empty():
+                pending.append(self._queue.get_nowait())
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(RuntimeError("Service de prédiction arrêté"))
+
+    # Place un texte dans la file et attend son propre résultat
+    async def submit(self, text):
+        if self._worker is None:
+            await self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        result, timings = await future
+        add_request_timings(timings)
+        return result
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        self._batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(self._batch) < self.max_batch_size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                self._batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        return self._batch
+
+    # Exécuté dans le thread du lot, dans un contexte copié : durées propres à ce lot
+    def _predict_timed(self, texts):
+        timings = start_request_timings()
+        return self.predict_fn(texts), timings
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            texts = [text for text, _ in batch]
+            try:
+                results, timings = await loop.run_in_executor(
+                    None, contextvars.copy_context().run, self._predict_timed, texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                self._batch = []
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result((result, timings))
+            self._batch = []
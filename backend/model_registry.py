@@ -0,0 +1,74 @@
+import os
+import threading
+import time
+
+# Registre partagé des modèles : chaque modèle est chargé une seule fois par processus,
+# au premier appel de get_model() ou pendant warmup(), puis partagé entre l'API,
+# la CLI et les traitements par lots.
+
+_loaders = {}
+_models = {}
+_stats = {}
+_lock = threading.Lock()
+
+
+# Mémoire résidente du processus en Mo (Linux : /proc, sinon pic via resource)
+def _rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Enregistre la fonction de chargement d'un modèle (aucun chargement à ce stade)
+def register_model(name, loader):
+    with _lock:
+        _loaders[name] = loader
+
+
+def get_model(name):
+    model = _models.get(name)
+    if model is not None:
+        return model
+    with _lock:
+        if name in _models:
+            return _models[name]
+        if name not in _loaders:
+            raise KeyError(f"Modèle inconnu dans le registre : {name}")
+        rss_before = _rss_mb()
+        start = time.perf_counter()
+        model = _loaders[name]()
+        load_seconds = time.perf_counter() - start
+        _models[name] = model
+        _stats[name] = {
+            "load_seconds": round(load_seconds, 3),
+            "rss_mb": round(_rss_mb() - rss_before, 1),
+            "loaded_at": time.time(),
+        }
+        print(f"✅ Modèle '{name}' chargé en {load_seconds:.2f}s (+{_stats[name]['rss_mb']} Mo)")
+        return model
+
+
+# Charge à l'avance les modèles demandés (tous les modèles enregistrés par défaut)
+def warmup(names=None):
+    for name in names or list(_loaders):
+        get_model(name)
+    return model_stats()
+
+
+def is_loaded(name):
+    return name in _models
+
+
+# Temps de chargement et mémoire résidente ajoutée par modèle, plus la RSS totale
+def model_stats():
+    return {
+        "models": {
+            name: {**_stats.get(name, {}), "loaded": name in _models}
+            for name in _loaders
+        },
+        "process_rss_mb": round(_rss_mb(), 1),
+    }
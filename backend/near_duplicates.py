@@ -0,0 +1,522 @@
+import argparse
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from metrics import inc
+
+# Détection des quasi-doublons (variantes d'un même texte, typiques des campagnes
+# coordonnées) : signature MinHash du texte nettoyé (clean_tweets) + index LSH.
+# - signature : NEAR_DUP_PERMUTATIONS minimums de hachages des 5-grammes de caractères
+#   (texte en minuscules, espaces normalisés) ; la part de minimums égaux entre deux
+#   signatures estime la similarité de Jaccard des deux textes ;
+# - LSH : la signature est coupée en NEAR_DUP_BANDS bandes ; deux textes sont candidats
+#   s'ils partagent une bande (seuil ~0,5 avec 16 bandes de 4), puis confirmés si leur
+#   similarité estimée dépasse NEAR_DUP_THRESHOLD ;
+# - un texte proche d'un cluster dont le représentant est déjà noté n'est pas re-noté : les
+#   prédictions (predict_batch, donc /predict, predict_pages et le rattrapage) reprennent les
+#   scores du représentant (known_cluster_predictions) ;
+# - le rattachement des posts stockés (post_clusters) se fait hors du chemin d'insertion,
+#   au début de chaque passage du rattrapage des prédictions (build) ;
+# - la taille des clusters (text_clusters.size) sert de signal de campagne (/clusters).
+# L'index est en mémoire (tableaux NumPy triés par bande + petit dict des ajouts récents),
+# chargé depuis text_clusters au premier usage puis complété au fil des insertions.
+# Synchronisation entre processus par identifiant de transaction (created_xid) plutôt que par
+# cluster_id : tout cluster dont la transaction est antérieure à l'horizon
+# pg_snapshot_xmin(pg_current_snapshot()) est terminé, donc déjà lu ; seuls les clusters des
+# transactions encore ouvertes à la dernière lecture sont relus. Un cluster_id attribué tôt
+# mais validé tard n'est donc jamais perdu.
+# Le verrou de l'index ne couvre que le calcul (rapprochement et ajout à l'index) : lecture
+# des nouveaux clusters, attribution des identifiants et écritures se font hors verrou.
+# Identifiants : réserve du processus, complétée par nextval selon les besoins du lot ; les
+# identifiants non utilisés restent dans la réserve pour les lots suivants.
+
+NEAR_DUP_ENABLED = os.getenv("NEAR_DUP_ENABLED", "1") == "1"
+NEAR_DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", "0.8"))
+# Textes nettoyés plus courts : pas de regroupement ("merci !", "lol"... se ressemblent tous)
+NEAR_DUP_MIN_CHARS = int(os.getenv("NEAR_DUP_MIN_CHARS", "30"))
+NEAR_DUP_SHINGLE = 5
+NEAR_DUP_PERMUTATIONS = 64
+NEAR_DUP_BANDS = 16
+NEAR_DUP_ROWS = NEAR_DUP_PERMUTATIONS // NEAR_DUP_BANDS
+# Attente max de l'enregistrement d'un cluster créé par un autre thread du processus (s)
+NEAR_DUP_COMMIT_WAIT = float(os.getenv("NEAR_DUP_COMMIT_WAIT", "30"))
+# Attente max d'une connexion pour la recherche des prédictions des clusters (s) : au-delà,
+# les textes passent par le modèle
+NEAR_DUP_LOOKUP_TIMEOUT = float(os.getenv("NEAR_DUP_LOOKUP_TIMEOUT", "0.5"))
+
+# Graine fixe : les signatures doivent être identiques dans tous les processus et entre les runs
+_rng = np.random.default_rng(20240611)
+_MULTIPLIERS = _rng.integers(1, 2 ** 63, NEAR_DUP_PERMUTATIONS, dtype=np.uint64) | np.uint64(1)
+_OFFSETS = _rng.integers(0, 2 ** 63, NEAR_DUP_PERMUTATIONS, dtype=np.uint64)
+_SHINGLE_POWERS = np.array([31 ** i for i in range(NEAR_DUP_SHINGLE)][::-1], dtype=np.uint64)
+_BAND_MIX = _rng.integers(1, 2 ** 63, NEAR_DUP_ROWS, dtype=np.uint64) | np.uint64(1)
+
+CREATE_CLUSTERS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS text_clusters (
+        cluster_id BIGSERIAL PRIMARY KEY,
+        representative_uri TEXT NOT NULL,
+        representative_text TEXT,
+        signature BYTEA NOT NULL,
+        size INTEGER NOT NULL DEFAULT 0,
+        first_seen_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        last_seen_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        created_xid XID8 DEFAULT pg_current_xact_id()
+    );
+    -- Tables créées avant created_xid : colonne ajoutée sans réécriture (anciennes lignes à NULL,
+    -- lues au chargement complet de l'index)
+    ALTER TABLE text_clusters ADD COLUMN IF NOT EXISTS created_xid XID8;
+    ALTER TABLE text_clusters ALTER COLUMN created_xid SET DEFAULT pg_current_xact_id();
+    CREATE INDEX IF NOT EXISTS text_clusters_size_idx ON text_clusters (size DESC) WHERE size > 1;
+    CREATE INDEX IF NOT EXISTS text_clusters_xid_idx ON text_clusters (created_xid);
+    CREATE TABLE IF NOT EXISTS post_clusters (
+        post_uri TEXT PRIMARY KEY,
+        cluster_id BIGINT NOT NULL,
+        similarity REAL NOT NULL,
+        linked_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS post_clusters_cluster_idx ON post_clusters (cluster_id);
+"""
+
+_table_ready = False
+_index = None
+_index_lock = threading.Lock()
+# Clusters créés par un thread du processus, pas encore enregistrés : cluster_id -> _PendingCluster
+_pending_clusters = {}
+# Identifiants de cluster réservés (nextval) et pas encore utilisés
+_free_ids = []
+_free_ids_lock = threading.Lock()
+
+
+def _normalize(text):
+    return " ".join((text or "").lower().split())
+
+
+# Signature MinHash (uint32) d'un texte nettoyé ; None si le texte est trop court
+def signature(cleaned_text):
+    text = _normalize(cleaned_text)
+    if len(text) < NEAR_DUP_MIN_CHARS:
+        return None
+    data = np.frombuffer(text.encode("utf-8"), dtype=np.uint8).astype(np.uint64)
+    shingles = np.unique(sliding_window_view(data, NEAR_DUP_SHINGLE) @ _SHINGLE_POWERS)
+    # Famille multiply-shift : (a * x + b) mod 2^64, 32 bits de poids fort
+    hashed = (shingles[:, None] * _MULTIPLIERS + _OFFSETS) >> np.uint64(32)
+    return hashed.min(axis=0).astype(np.uint32)
+
+
+def _band_keys(sig):
+    bands = sig.reshape(NEAR_DUP_BANDS, NEAR_DUP_ROWS).astype(np.uint64)
+    return (bands * _BAND_MIX).sum(axis=1)
+
+
+class LshIndex:
+    # Au-delà de MERGE_EVERY ajouts, les clés récentes sont fusionnées dans les tableaux triés
+    MERGE_EVERY = 4096
+
+    def __init__(self):
+        self.cluster_ids = np.empty(0, dtype=np.int64)
+        self.signatures = np.empty((0, NEAR_DUP_PERMUTATIONS), dtype=np.uint32)
+        self.size = 0
+        # Horizon de la dernière lecture (None : rien lu), clusters relus à la prochaine lecture
+        # (transactions ouvertes à l'horizon) et clusters créés ici pas encore relus
+        self.horizon = None
+        self.recent = {}
+        self.local_ids = set()
+        # Par bande : clés triées + position (ligne de signatures) correspondante
+        self._keys = [np.empty(0, dtype=np.uint64) for _ in range(NEAR_DUP_BANDS)]
+        self._rows = [np.empty(0, dtype=np.int64) for _ in range(NEAR_DUP_BANDS)]
+        self._pending = [{} for _ in range(NEAR_DUP_BANDS)]
+        self._pending_rows = []
+
+    def __len__(self):
+        return self.size
+
+    def add(self, cluster_id, sig):
+        if self.size == len(self.cluster_ids):
+            capacity = max(1024, 2 * self.size)
+            self.cluster_ids = np.resize(self.cluster_ids, capacity)
+            signatures = np.empty((capacity, NEAR_DUP_PERMUTATIONS), dtype=np.uint32)
+            signatures[:self.size] = self.signatures[:self.size]
+            self.signatures = signatures
+        row = self.size
+        self.cluster_ids[row] = cluster_id
+        self.signatures[row] = sig
+        self.size += 1
+        for band, key in enumerate(_band_keys(sig).tolist()):
+            self._pending[band].setdefault(key, []).append(row)
+        self._pending_rows.append(row)
+        if len(self._pending_rows) >= self.MERGE_EVERY:
+            self._merge()
+
+    def _merge(self):
+        if not self._pending_rows:
+            return
+        rows = np.array(self._pending_rows, dtype=np.int64)
+        keys = np.stack([_band_keys(self.signatures[row]) for row in rows])
+        for band in range(NEAR_DUP_BANDS):
+            merged_keys = np.concatenate([self._keys[band], keys[:, band]])
+            merged_rows = np.concatenate([self._rows[band], rows])
+            order = np.argsort(merged_keys, kind="stable")
+            self._keys[band] = merged_keys[order]
+            self._rows[band] = merged_rows[order]
+            self._pending[band].clear()
+        self._pending_rows = []
+
+    # Meilleur cluster (cluster_id, similarité) au-dessus du seuil, sinon None
+    def match(self, sig, threshold=NEAR_DUP_THRESHOLD):
+        candidates = set()
+        for band, key in enumerate(_band_keys(sig).tolist()):
+            keys = self._keys[band]
+            start = np.searchsorted(keys, key, side="left")
+            end = np.searchsorted(keys, key, side="right")
+            candidates.update(self._rows[band][start:end].tolist())
+            candidates.update(self._pending[band].get(key, ()))
+        if not candidates:
+            return None
+        rows = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        scores = np.count_nonzero(self.signatures[rows] == sig, axis=1) / NEAR_DUP_PERMUTATIONS
+        best = int(scores.argmax())
+        if scores[best] < threshold:
+            return None
+        return int(self.cluster_ids[rows[best]]), float(scores[best])
+
+
+def _ensure_tables(conn):
+    global _table_ready
+    if not _table_ready:
+        conn.execute(CREATE_CLUSTERS_TABLE_SQL)
+        _table_ready = True
+
+
+class _PendingCluster:
+    def __init__(self):
+        self.done = threading.Event()
+        self.ok = False
+
+
+# Lit (hors verrou) les clusters que l'index n'a pas encore vus : tous au premier chargement,
+# sinon ceux des transactions non terminées à la lecture précédente (created_xid >= horizon).
+# L'horizon est lu avant les lignes : toute transaction antérieure est visible dans la lecture.
+def _fetch_clusters(conn, horizon):
+    new_horizon = conn.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint").fetchone()[0]
+    if horizon is None:
+        rows = conn.execute(
+            "SELECT cluster_id, signature, created_xid::text::bigint FROM text_clusters ORDER BY cluster_id"
+        ).fetchall()
+    else:
+        rows = conn.execute(
+            "SELECT cluster_id, signature, created_xid::text::bigint FROM text_clusters "
+            "WHERE created_xid >= %s::text::xid8 ORDER BY cluster_id",
+            (horizon,),
+        ).fetchall()
+    return rows, new_horizon
+
+
+# Ajoute (sous verrou) les clusters lus à l'index. Une ligne antérieure à l'horizon courant a
+# déjà été lue par la lecture qui a fixé cet horizon ; les lignes de transactions encore
+# ouvertes (>= nouvel horizon) sont retenues dans recent pour ne pas être ajoutées deux fois.
+def _apply_clusters(index, rows, new_horizon):
+    for cluster_id, sig, xid in rows:
+        if xid is not None and index.horizon is not None and xid < index.horizon:
+            continue
+        if cluster_id in index.recent:
+            continue
+        if cluster_id in index.local_ids:
+            index.local_ids.discard(cluster_id)
+        else:
+            index.add(cluster_id, np.frombuffer(sig, dtype=np.uint32))
+        if xid is not None:
+            index.recent[cluster_id] = xid
+    index.horizon = new_horizon if index.horizon is None else max(index.horizon, new_horizon)
+    index.recent = {cluster_id: xid for cluster_id, xid in index.recent.items() if xid >= index.horizon}
+
+
+# Attend l'enregistrement des clusters créés par d'autres threads auxquels ce lot est rattaché
+# (la mise à jour de leur taille doit trouver leur ligne)
+def _wait_for_clusters(pending):
+    for cluster_id, entry in pending.items():
+        if not entry.done.wait(NEAR_DUP_COMMIT_WAIT) or not entry.ok:
+            raise RuntimeError(f"Cluster {cluster_id} non enregistré par le thread qui l'a créé")
+
+
+def _write_assignments(conn, new_clusters, links):
+    with conn.transaction():
+        if new_clusters:
+            with conn.cursor() as cur:
+                cur.executemany(
+                    "INSERT INTO text_clusters (cluster_id, representative_uri, representative_text, signature) "
+                    "VALUES (%s, %s, %s, %s)",
+                    new_clusters,
+                )
+        if links:
+            linked = conn.execute(
+                "INSERT INTO post_clusters (post_uri, cluster_id, similarity) "
+                "SELECT * FROM unnest(%s::text[], %s::bigint[], %s::real[]) "
+                "ON CONFLICT (post_uri) DO NOTHING RETURNING cluster_id",
+                ([uri for uri, _, _ in links], [c for _, c, _ in links], [s for _, _, s in links]),
+            ).fetchall()
+            sizes = Counter(cluster_id for cluster_id, in linked)
+            if sizes:
+                conn.execute(
+                    "UPDATE text_clusters c SET size = c.size + s.added, last_seen_at = now() "
+                    "FROM unnest(%s::bigint[], %s::int[]) AS s(cluster_id, added) "
+                    "WHERE c.cluster_id = s.cluster_id",
+                    (list(sizes), list(sizes.values())),
+                )
+
+
+# count identifiants de cluster : pris dans la réserve, complétés par nextval (hors verrou)
+def _take_ids(conn, count):
+    with _free_ids_lock:
+        ids = _free_ids[len(_free_ids) - min(count, len(_free_ids)):]
+        del _free_ids[len(_free_ids) - len(ids):]
+    if len(ids) < count:
+        ids += [cluster_id for cluster_id, in conn.execute(
+            "SELECT nextval(pg_get_serial_sequence('text_clusters', 'cluster_id')) "
+            "FROM generate_series(1, %s)", (count - len(ids),)
+        ).fetchall()]
+    return ids
+
+
+def _release_ids(ids):
+    with _free_ids_lock:
+        _free_ids.extend(ids)
+
+
+# Index à jour des clusters enregistrés (lecture hors verrou), verrou tenu pendant le bloc
+@contextmanager
+def _locked_index(conn):
+    global _index
+    while True:
+        index = _index
+        rows, new_horizon = _fetch_clusters(conn, index.horizon if index is not None else None)
+        with _index_lock:
+            if _index is not index:
+                continue  # index rechargé entre-temps : nouvelle lecture
+            if index is None:
+                index = _index = LshIndex()
+            _apply_clusters(index, rows, new_horizon)
+            yield index
+            return
+
+
+# Rattache chaque post à un cluster (existant, ou nouveau dont il est le représentant).
+# Renvoie la liste des cluster_id (None pour les textes trop courts).
+# Exact dans un processus (le rapprochement est sérialisé, les clusters créés par un thread
+# sont visibles des autres avant même d'être enregistrés) ; approché entre processus : deux
+# processus peuvent créer au même moment deux clusters pour deux variantes d'un même texte.
+# Valide la transaction en cours de conn : les écritures ont leur propre transaction, validée
+# avant que les autres threads ne rattachent des posts aux clusters créés ici.
+def assign_clusters(conn, post_uris, cleaned_texts):
+    global _index
+    _ensure_tables(conn)
+    signatures = [signature(text) for text in cleaned_texts]
+    pending = [i for i, sig in enumerate(signatures) if sig is not None]
+    # Au plus un nouveau cluster par post ; les identifiants non utilisés sont rendus
+    reserved = _take_ids(conn, len(pending))
+    new_ids = iter(reserved)
+
+    assignments = [None] * len(post_uris)
+    links = []
+    new_clusters = []
+    created = {}
+    waiting = {}
+    with _locked_index(conn) as index:
+        for i in pending:
+            match = index.match(signatures[i])
+            if match is None:
+                cluster_id = next(new_ids)
+                index.add(cluster_id, signatures[i])
+                index.local_ids.add(cluster_id)
+                created[cluster_id] = _pending_clusters[cluster_id] = _PendingCluster()
+                new_clusters.append((cluster_id, post_uris[i], cleaned_texts[i], signatures[i].tobytes()))
+                match = (cluster_id, 1.0)
+            elif match[0] in _pending_clusters and match[0] not in created:
+                waiting[match[0]] = _pending_clusters[match[0]]
+            assignments[i] = match[0]
+            links.append((post_uris[i], match[0], match[1]))
+    _release_ids(reserved[len(new_clusters):])
+
+    try:
+        conn.commit()
+        _wait_for_clusters(waiting)
+        _write_assignments(conn, new_clusters, links)
+    except Exception:
+        with _index_lock:
+            # L'index contient des clusters non enregistrés : rechargé au prochain appel
+            if _index is index:
+                _index = None
+            for cluster_id, entry in created.items():
+                _pending_clusters.pop(cluster_id, None)
+                entry.done.set()
+        raise
+    with _index_lock:
+        for cluster_id, entry in created.items():
+            _pending_clusters.pop(cluster_id, None)
+            entry.ok = True
+            entry.done.set()
+    matched = len(links) - len(new_clusters)
+    inc("near_duplicate_posts_total", matched, result="matched")
+    inc("near_duplicate_posts_total", len(new_clusters), result="new_cluster")
+    return assignments
+
+
+# Cluster existant le plus proche de chaque texte nettoyé (sans créer de cluster ni
+# rattacher de post) : cluster_id ou None
+def match_clusters(conn, cleaned_texts):
+    _ensure_tables(conn)
+    signatures = [signature(text) for text in cleaned_texts]
+    if all(sig is None for sig in signatures):
+        return [None] * len(signatures)
+    with _locked_index(conn) as index:
+        matches = [index.match(sig) if sig is not None else None for sig in signatures]
+    return [match[0] if match else None for match in matches]
+
+
+# Prédictions déjà enregistrées pour les clusters de textes nettoyés : par texte,
+# (cluster_id, label, scores) — label et scores à None si le représentant n'est pas encore
+# noté pour cette version — ou None hors cluster. Base indisponible : aucun cluster connu.
+def known_cluster_predictions(cleaned_texts, model_name, model_version):
+    if not NEAR_DUP_ENABLED or not cleaned_texts:
+        return [None] * len(cleaned_texts)
+    from db import get_connection
+    from predictions import ensure_predictions_table
+    try:
+        with get_connection(timeout=NEAR_DUP_LOOKUP_TIMEOUT) as conn:
+            cluster_ids = match_clusters(conn, cleaned_texts)
+            wanted = sorted({cluster_id for cluster_id in cluster_ids if cluster_id is not None})
+            known = {}
+            if wanted:
+                ensure_predictions_table(conn)
+                known = {cluster_id: (label, scores) for cluster_id, label, scores in conn.execute(
+                    "SELECT c.cluster_id, pr.label, pr.scores FROM text_clusters c "
+                    "JOIN post_predictions pr ON pr.post_uri = c.representative_uri "
+                    "AND pr.model_name = %s AND pr.model_version = %s "
+                    "WHERE c.cluster_id = ANY(%s)",
+                    (model_name, model_version, wanted),
+                ).fetchall()}
+    except Exception as e:
+        print(f"⚠️ Prédictions des quasi-doublons ignorées : {e}")
+        return [None] * len(cleaned_texts)
+    return [None if cluster_id is None else (cluster_id, *known.get(cluster_id, (None, None)))
+            for cluster_id in cluster_ids]
+
+
+# Prédiction déjà connue pour le cluster de chaque post : {post_uri: (cluster_id, label, scores)}
+# (label/scores à None si le représentant n'est pas encore noté pour cette version)
+def cluster_predictions(conn, post_uris, model_name, model_version):
+    from predictions import ensure_predictions_table
+    _ensure_tables(conn)
+    ensure_predictions_table(conn)
+    rows = conn.execute(
+        """
+        SELECT pc.post_uri, pc.cluster_id, pr.label, pr.scores
+        FROM post_clusters pc
+        JOIN text_clusters c ON c.cluster_id = pc.cluster_id
+        LEFT JOIN post_predictions pr ON pr.post_uri = c.representative_uri
+            AND pr.model_name = %s AND pr.model_version = %s
+        WHERE pc.post_uri = ANY(%s)
+        """,
+        (model_name, model_version, list(post_uris)),
+    ).fetchall()
+    return {post_uri: (cluster_id, label, scores) for post_uri, cluster_id, label, scores in rows}
+
+
+# Plus gros clusters (signal de campagne) et répartition des tailles
+def cluster_report(min_size: int = 2, limit: int = 50):
+    from db import get_connection
+    with get_connection() as conn:
+        _ensure_tables(conn)
+        cur = conn.execute(
+            "SELECT cluster_id, size, representative_uri, representative_text, first_seen_at, last_seen_at "
+            "FROM text_clusters WHERE size >= %s ORDER BY size DESC LIMIT %s",
+            (max(min_size, 2), limit),
+        )
+        names = [column.name for column in cur.description]
+        clusters = [dict(zip(names, row)) for row in cur.fetchall()]
+        distribution = conn.execute(
+            """
+            SELECT CASE WHEN size = 1 THEN '1' WHEN size < 5 THEN '2-4' WHEN size < 20 THEN '5-19'
+                        WHEN size < 100 THEN '20-99' ELSE '100+' END AS bucket,
+                   count(*), sum(size)
+            FROM text_clusters GROUP BY 1 ORDER BY min(size)
+            """
+        ).fetchall()
+    return {
+        "clusters": clusters,
+        "size_distribution": [
+            {"size": bucket, "clusters": count, "posts": int(posts or 0)} for bucket, count, posts in distribution
+        ],
+    }
+
+
+def cluster_members(cluster_id: int, limit: int = 100):
+    from db import get_connection
+    with get_connection() as conn:
+        _ensure_tables(conn)
+        rows = conn.execute(
+            "SELECT post_uri, similarity, linked_at FROM post_clusters WHERE cluster_id = %s "
+            "ORDER BY linked_at LIMIT %s",
+            (cluster_id, limit),
+        ).fetchall()
+    return [{"post_uri": uri, "similarity": round(score, 3), "linked_at": linked_at} for uri, score, linked_at in rows]
+
+
+# Regroupe les posts stockés pas encore rattachés (parcours par clé des trois tables) ;
+# s'arrête entre deux tranches quand stop_event est levé
+def build(sources=None, chunk_size=2048, stop_event=None):
+    from psycopg import sql
+    from db import get_connection
+    from post_search import SOURCES
+    from bert_finetune import clean_tweets
+    for source in sources or list(SOURCES):
+        table, columns = SOURCES[source]
+        text = next(column for column, canonical in columns.items() if canonical == "text")
+        query = sql.SQL(
+            "SELECT p.post_uri, p.{text} FROM {table} p "
+            "WHERE p.post_uri > %s AND NOT EXISTS (SELECT 1 FROM post_clusters pc WHERE pc.post_uri = p.post_uri) "
+            "ORDER BY p.post_uri LIMIT %s"
+        ).format(text=sql.Identifier(text), table=sql.Identifier(table))
+        last_post_uri = ""
+        linked = 0
+        start = time.perf_counter()
+        while not (stop_event and stop_event.is_set()):
+            with get_connection() as conn:
+                _ensure_tables(conn)
+                rows = conn.execute(query, (last_post_uri, chunk_size)).fetchall()
+                if not rows:
+                    break
+                assignments = assign_clusters(conn, [uri for uri, _ in rows],
+                                              clean_tweets([text or "" for _, text in rows]))
+            linked += sum(cluster_id is not None for cluster_id in assignments)
+            last_post_uri = rows[-1][0]
+        print(f"✅ {linked} post(s) de {source} rattaché(s) à un cluster en {time.perf_counter() - start:.1f}s.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Quasi-doublons : clusters de variantes d'un même texte")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build_parser = sub.add_parser("build", help="Regroupe les posts stockés pas encore rattachés")
+    build_parser.add_argument("--source", nargs="+", choices=["search", "user", "single"])
+    build_parser.add_argument("--chunk-size", type=int, default=2048)
+    report_parser = sub.add_parser("report", help="Plus gros clusters")
+    report_parser.add_argument("--min-size", type=int, default=2)
+    report_parser.add_argument("--limit", type=int, default=20)
+
+    args = parser.parse_args(argv)
+    if args.command == "build":
+        build(args.source, args.chunk_size)
+    else:
+        report = cluster_report(args.min_size, args.limit)
+        for bucket in report["size_distribution"]:
+            print(f"taille {bucket['size']:>6} : {bucket['clusters']} cluster(s), {bucket['posts']} post(s)")
+        for cluster in report["clusters"]:
+            print(f"#{cluster['cluster_id']} x{cluster['size']}  {(cluster['representative_text'] or '')[:100]}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,292 @@
+import argparse
+import json
+import os
+import sys
+import time
+from collections import OrderedDict, Counter
+from datetime import datetime
+import numpy as np
+import psycopg
+from psycopg import sql
+from db import DB_URL, with_profile
+from post_search import SOURCES
+from records import POST_SCHEMA
+from metrics import timed, inc
+
+# Export Parquet des posts, en flux et à mémoire constante :
+# - depuis les trois tables : curseur côté serveur (DECLARE / FETCH par EXPORT_FETCH_ROWS
+#   lignes, connexion dédiée hors pool), tri par date de création ;
+# - ou directement depuis le collecteur (pages de recherche / fil d'un compte), sans passer
+#   par la base.
+# Colonnes typées au schéma canonique (records.POST_SCHEMA) quelle que soit la table ; les
+# colonnes absentes d'une table sont nulles. Fichiers partitionnés façon Hive :
+#   <répertoire>/source=search/created_month=2024-05/part-00000.parquet
+# Chaque partition accumule jusqu'à PARQUET_ROW_GROUP_ROWS lignes avant d'écrire un row group.
+# Mémoire bornée : les lignes arrivent triées par date, donc la partition d'une source est écrite
+# dès qu'un lot de cette source ne la contient plus ; au-delà de PARQUET_MAX_BUFFERED_ROWS lignes
+# en attente (toutes partitions), la plus grosse est écrite. Au-delà de PARQUET_MAX_OPEN_FILES
+# partitions ouvertes, la moins récente est fermée.
+# Un fichier n'apparaît sous son nom final qu'une fois complet ; _manifest.json liste le résultat.
+
+PARQUET_EXPORT_DIR = os.getenv("PARQUET_EXPORT_DIR", "./exports")
+PARQUET_ROW_GROUP_ROWS = int(os.getenv("PARQUET_ROW_GROUP_ROWS", "100000"))
+PARQUET_COMPRESSION = os.getenv("PARQUET_COMPRESSION", "zstd")
+PARQUET_MAX_OPEN_FILES = int(os.getenv("PARQUET_MAX_OPEN_FILES", "16"))
+PARQUET_MAX_BUFFERED_ROWS = int(os.getenv("PARQUET_MAX_BUFFERED_ROWS", "200000"))
+EXPORT_FETCH_ROWS = int(os.getenv("EXPORT_FETCH_ROWS", "10000"))
+PARTITIONS = {"month": ("created_month", "datetime64[M]"), "day": ("created_day", "datetime64[D]"), "none": None}
+# Partition des posts sans date de création (convention Hive)
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("Veuillez installer pyarrow : pip install pyarrow")
+
+
+def arrow_schema():
+    _require_pyarrow()
+    types = {
+        "text": pa.string(),
+        "int": pa.int64(),
+        "bool": pa.bool_(),
+        "timestamp": pa.timestamp("us", tz="UTC"),
+    }
+    return pa.schema([(name, types[kind]) for name, kind in POST_SCHEMA.items()])
+
+
+# Lignes (tuples) d'un FETCH -> RecordBatch au schéma canonique
+def _rows_to_batch(schema, names, rows):
+    values = dict(zip(names, zip(*rows)))
+    return pa.RecordBatch.from_arrays([
+        pa.array(values[field.name], type=field.type) if field.name in values else pa.nulls(len(rows), field.type)
+        for field in schema
+    ], schema=schema)
+
+
+# Page du collecteur (PostBatch, colonnes NumPy) -> RecordBatch au schéma canonique
+def _post_batch_to_batch(schema, page):
+    arrays = []
+    for field in schema:
+        if field.name in page:
+            arrays.append(pa.array(page[field.name], type=field.type, from_pandas=True))
+        else:
+            arrays.append(pa.nulls(len(page), field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class PartitionedParquetWriter:
+    def __init__(self, directory, partition="month", row_group_rows=PARQUET_ROW_GROUP_ROWS,
+                 compression=PARQUET_COMPRESSION, max_open_files=PARQUET_MAX_OPEN_FILES,
+                 max_buffered_rows=PARQUET_MAX_BUFFERED_ROWS):
+        _require_pyarrow()
+        if partition not in PARTITIONS:
+            raise ValueError(f"Partition inconnue : {partition} (choix : {', '.join(PARTITIONS)})")
+        self.directory = directory
+        self.partition = PARTITIONS[partition]
+        self.row_group_rows = row_group_rows
+        self.compression = compression
+        self.max_open_files = max_open_files
+        self.max_buffered_rows = max_buffered_rows
+        self.schema = arrow_schema()
+        self._buffers = {}
+        self._buffered_rows = Counter()
+        self._writers = OrderedDict()
+        self._parts = Counter()
+        self.files = []
+        self.rows = 0
+        self._start = time.perf_counter()
+
+    def _keys(self, batch):
+        if self.partition is None:
+            return np.zeros(batch.num_rows, dtype=object), [None]
+        created = batch.column("created_at_post").to_numpy(zero_copy_only=False)
+        created = created.astype("datetime64[us]").astype(self.partition[1])
+        labels = np.where(np.isnat(created), NULL_PARTITION, np.datetime_as_string(created))
+        return np.unique(labels, return_inverse=True)[::-1]
+
+    # Ajoute un lot à sa source ; chaque partition écrit un row group dès qu'elle est pleine
+    def write(self, source, batch):
+        if not batch.num_rows:
+            return
+        inverse, labels = self._keys(batch)
+        # Partitions de la source absentes de ce lot : terminées (lignes triées par date)
+        for key in [key for key in self._buffers if key[0] == source and key[1] not in labels]:
+            self._flush(key)
+        for i, label in enumerate(labels):
+            rows = batch if len(labels) == 1 else batch.take(pa.array(np.flatnonzero(inverse == i)))
+            key = (source, label)
+            self._buffers.setdefault(key, []).append(rows)
+            self._buffered_rows[key] += rows.num_rows
+            if self._buffered_rows[key] >= self.row_group_rows:
+                self._flush(key)
+        while sum(self._buffered_rows.values()) > self.max_buffered_rows:
+            self._flush(self._buffered_rows.most_common(1)[0][0])
+        self.rows += batch.num_rows
+        inc("parquet_rows_exported_total", batch.num_rows, source=source)
+
+    def _open(self, key):
+        if key in self._writers:
+            self._writers.move_to_end(key)
+            return self._writers[key][0]
+        if len(self._writers) >= self.max_open_files:
+            self._close(next(iter(self._writers)))
+        source, label = key
+        directory = os.path.join(self.directory, f"source={source}")
+        if self.partition is not None:
+            directory = os.path.join(directory, f"{self.partition[0]}={label}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"part-{self._parts[key]:05d}.parquet")
+        self._parts[key] += 1
+        writer = pq.ParquetWriter(f"{path}.tmp", self.schema, compression=self.compression)
+        self._writers[key] = (writer, path)
+        return writer
+
+    def _flush(self, key):
+        buffered = self._buffers.pop(key, None)
+        self._buffered_rows.pop(key, None)
+        if not buffered:
+            return
+        table = pa.Table.from_batches(buffered, schema=self.schema)
+        with timed("parquet_write"):
+            self._open(key).write_table(table, row_group_size=self.row_group_rows)
+
+    def _close(self, key):
+        self._flush(key)
+        writer, path = self._writers.pop(key)
+        writer.close()
+        os.rename(f"{path}.tmp", path)
+        self.files.append({"path": os.path.relpath(path, self.directory), "bytes": os.path.getsize(path)})
+
+    # Écrit les restes des partitions, ferme les fichiers et le manifeste ; renvoie le manifeste
+    def close(self):
+        for key in list(self._buffers):
+            self._flush(key)
+        for key in list(self._writers):
+            self._close(key)
+        manifest = {
+            "directory": self.directory,
+            "rows": self.rows,
+            "bytes": sum(f["bytes"] for f in self.files),
+            "files": sorted(self.files, key=lambda f: f["path"]),
+            "seconds": round(time.perf_counter() - self._start, 2),
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, "_manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+        print(f"✅ {manifest['rows']} ligne(s) exportée(s) en {len(self.files)} fichier(s) Parquet "
+              f"({manifest['bytes'] / 1e6:.1f} Mo) dans {self.directory} en {manifest['seconds']}s.")
+        return manifest
+
+
+# Répertoire d'un export : un instantané par exécution (pas de doublons entre deux exports)
+def _run_directory(name):
+    return os.path.join(PARQUET_EXPORT_DIR, f"{name}-{datetime.now():%Y%m%d-%H%M%S}")
+
+
+def _export_query(source, since, until):
+    table, columns = SOURCES[source]
+    created = sql.Identifier(next(column for column, canonical in columns.items() if canonical == "created_at_post"))
+    conditions = [sql.SQL("TRUE")]
+    params = {}
+    if since:
+        conditions.append(sql.SQL("{} >= %(since)s").format(created))
+        params["since"] = since
+    if until:
+        conditions.append(sql.SQL("{} < %(until)s").format(created))
+        params["until"] = until
+    query = sql.SQL("SELECT {select} FROM {table} WHERE {conditions} ORDER BY {created}, post_uri").format(
+        select=sql.SQL(", ").join(
+            sql.SQL("{} AS {}").format(sql.Identifier(column), sql.Identifier(canonical))
+            for column, canonical in columns.items()
+        ),
+        table=sql.Identifier(table),
+        conditions=sql.SQL(" AND ").join(conditions),
+        created=created,
+    )
+    return query, params
+
+
+# Exporte les posts stockés (par défaut : les trois tables)
+def export_tables(sources=None, since: datetime = None, until: datetime = None, partition: str = "month",
+                  directory: str = None, fetch_rows: int = EXPORT_FETCH_ROWS):
+    sources = list(sources or SOURCES)
+    unknown = [source for source in sources if source not in SOURCES]
+    if unknown:
+        raise ValueError(f"Source inconnue : {', '.join(unknown)} (choix : {', '.join(SOURCES)})")
+    writer = PartitionedParquetWriter(directory or _run_directory("posts"), partition)
+    # Connexion dédiée : un export long ne garde pas une connexion du pool
+    with psycopg.connect(DB_URL) as conn:
+        for source in sources:
+            query, params = _export_query(source, since, until)
+            with conn.cursor(name=f"parquet_export_{source}") as cur:
+                cur.itersize = fetch_rows
+                cur.execute(query, params)
+                names = [column.name for column in cur.description]
+                while True:
+                    with timed("parquet_fetch"):
+                        rows = cur.fetchmany(fetch_rows)
+                    if not rows:
+                        break
+                    writer.write(source, _rows_to_batch(writer.schema, names, rows))
+    return writer.close()
+
+
+# Exporte des pages du collecteur (PostBatch) au fil de l'eau
+def export_pages(pages, source: str, partition: str = "month", directory: str = None):
+    writer = PartitionedParquetWriter(directory or _run_directory(source), partition)
+    for page in pages:
+        if len(page):
+            writer.write(source, _post_batch_to_batch(writer.schema, page))
+    return writer.close()
+
+
+def export_search(query: str, limit: int = 100, lang: str = None, partition: str = "month", directory: str = None):
+    from collector import iter_search_pages
+    return export_pages(iter_search_pages(query, limit, lang), "search", partition, directory)
+
+
+def export_profile(profile_url: str, limit: int = 100, partition: str = "month", directory: str = None):
+    from collector import extract_handle_from_url, fetch_profile, iter_author_feed_pages
+    handle = extract_handle_from_url(profile_url)
+    if not handle:
+        raise ValueError("URL de profil invalide")
+    user_data = fetch_profile(handle)
+    pages = (with_profile(user_data, page) for page in iter_author_feed_pages(handle, limit))
+    return export_pages(pages, "user", partition, directory)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export Parquet des posts (tables ou collecte directe)")
+    parser.add_argument("--out", help="Répertoire de l'export (défaut : un nouveau répertoire dans PARQUET_EXPORT_DIR)")
+    parser.add_argument("--partition", default="month", choices=list(PARTITIONS))
+    sub = parser.add_subparsers(dest="command", required=True)
+    tables_parser = sub.add_parser("tables", help="Posts stockés (curseur côté serveur)")
+    tables_parser.add_argument("--source", nargs="+", choices=list(SOURCES))
+    tables_parser.add_argument("--since", type=datetime.fromisoformat)
+    tables_parser.add_argument("--until", type=datetime.fromisoformat)
+    search_parser = sub.add_parser("search", help="Recherche Bluesky, sans passer par la base")
+    search_parser.add_argument("query")
+    search_parser.add_argument("--limit", type=int, default=100)
+    search_parser.add_argument("--lang")
+    profile_parser = sub.add_parser("profile", help="Fil d'un compte, sans passer par la base")
+    profile_parser.add_argument("profile_url")
+    profile_parser.add_argument("--limit", type=int, default=100)
+
+    args = parser.parse_args(argv)
+    if args.command == "tables":
+        export_tables(args.source, args.since, args.until, args.partition, args.out)
+    elif args.command == "search":
+        export_search(args.query, args.limit, args.lang, args.partition, args.out)
+    else:
+        export_profile(args.profile_url, args.limit, args.partition, args.out)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
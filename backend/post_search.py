@@ -0,0 +1,385 @@
+import argparse
+import base64
+import json
+import sys
+from datetime import datetime
+import psycopg
+from psycopg import sql
+from db import (
+    DB_URL,
+    get_connection,
+    SEARCH_POSTS_COLUMNS,
+    USER_POSTS_COLUMNS,
+    SINGLE_POSTS_COLUMNS,
+)
+from predictions import ensure_predictions_table
+
+# Lecture des posts stockés : recherche plein texte + filtres (handle, dates, label prédit),
+# triée du plus récent au plus ancien avec pagination par clé (created_at, post_uri)
+# au lieu d'OFFSET : chaque page est une descente d'index, quelle que soit sa position.
+# - text_search : colonne tsvector ordinaire, remplie par un trigger à chaque écriture, index GIN ;
+# - index B-tree (created_at DESC, post_uri DESC) et (handle, created_at DESC, post_uri DESC).
+# Configuration 'simple' (sans racinisation) : les posts mélangent français et anglais.
+# Le schéma est une migration explicite, jamais lancée par une requête HTTP :
+#   python post_search.py migrate
+# Sans réécriture de table ni blocage prolongé des écritures : colonne nullable sans défaut
+# (catalogue seulement), trigger, remplissage des lignes existantes par lots validés un à un,
+# puis index CREATE INDEX CONCURRENTLY. Relançable : chaque étape déjà faite est sautée.
+# La recherche vérifie seulement que le schéma est en place (SearchSchemaMissing sinon).
+
+TEXT_SEARCH_CONFIG = "simple"
+SEARCH_MAX_LIMIT = 200
+# Recherche plein texte en deux temps (l'estimation de sélectivité des tsquery est trop
+# grossière pour que le planificateur choisisse seul entre les deux index) :
+# 1) termes fréquents : parcours de l'index par date, limité aux SEARCH_RECENT_WINDOW posts
+#    les plus récents (arrêt dès que la page est pleine) ;
+# 2) sinon (terme rare) : correspondances via l'index GIN, puis tri.
+# Décidé par source : la fenêtre d'une table très active ne couvre que peu de temps, son
+# résultat n'est retenu que si cette table remplit seule la page ; les pages des sources sont
+# ensuite fusionnées par (created_at, post_uri).
+# Les posts sans date de création viennent après tous les autres (triés par post_uri).
+SEARCH_RECENT_WINDOW = 20000
+# Lignes existantes remplies par transaction pendant la migration
+SEARCH_BACKFILL_ROWS = 5000
+# Attente max des verrous de la migration (ALTER / trigger) : échoue plutôt que de bloquer
+# les écritures derrière une longue transaction
+SEARCH_MIGRATION_LOCK_TIMEOUT = "5s"
+
+# Source -> (table, colonnes de la table -> colonnes canoniques) ; mêmes correspondances que l'insertion
+SOURCES = {
+    "search": ("bluesky_search_posts", SEARCH_POSTS_COLUMNS),
+    "user": ("bluesky_user_posts", USER_POSTS_COLUMNS),
+    "single": ("bluesky_single_posts", SINGLE_POSTS_COLUMNS),
+}
+RESULT_COLUMNS = [
+    "post_uri", "post_url", "text", "handle", "did",
+    "created_at_post", "like_count", "repost_count", "reply_count",
+]
+
+# Sources dont le schéma de recherche a été vérifié (ou migré) dans ce processus
+_schema_ready = set()
+
+
+class SearchSchemaMissing(RuntimeError):
+    pass
+
+
+def _table_column(source, name):
+    _, columns = SOURCES[source]
+    for table_column, canonical in columns.items():
+        if canonical == name:
+            return table_column
+    return None
+
+
+def _index_names(table):
+    return [f"{table}_text_search_idx", f"{table}_created_idx", f"{table}_handle_created_idx"]
+
+
+def _index_statements(source):
+    table, _ = SOURCES[source]
+    created = sql.Identifier(_table_column(source, "created_at_post"))
+    handle = sql.Identifier(_table_column(source, "handle"))
+    text_index, created_index, handle_index = (sql.Identifier(name) for name in _index_names(table))
+    table = sql.Identifier(table)
+    return [
+        sql.SQL("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} USING GIN (text_search)").format(text_index, table),
+        sql.SQL("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} ({} DESC, post_uri DESC)").format(
+            created_index, table, created),
+        sql.SQL("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} ({}, {} DESC, post_uri DESC)").format(
+            handle_index, table, handle, created),
+    ]
+
+
+# None si la colonne n'existe pas, sinon attgenerated ('s' : colonne générée, '' : ordinaire)
+def _column_kind(conn, table, column):
+    row = conn.execute(
+        "SELECT attgenerated FROM pg_attribute WHERE attrelid = %s::regclass AND attname = %s AND NOT attisdropped",
+        (table, column),
+    ).fetchone()
+    return row[0] if row else None
+
+
+# Colonne text_search + trigger qui la calcule à l'insertion et à chaque modification du texte.
+# Une colonne générée (ancienne version du schéma) devient ordinaire : DROP EXPRESSION garde
+# les valeurs sans réécrire la table.
+def _add_text_search_column(conn, source):
+    table, _ = SOURCES[source]
+    function = sql.Identifier(f"{table}_text_search_update")
+    trigger = f"{table}_text_search_trigger"
+    with conn.transaction():
+        conn.execute(sql.SQL("SET LOCAL lock_timeout = {}").format(sql.Literal(SEARCH_MIGRATION_LOCK_TIMEOUT)))
+        kind = _column_kind(conn, table, "text_search")
+        if kind is None:
+            conn.execute(sql.SQL("ALTER TABLE {} ADD COLUMN text_search tsvector").format(sql.Identifier(table)))
+        elif kind:
+            conn.execute(sql.SQL("ALTER TABLE {} ALTER COLUMN text_search DROP EXPRESSION").format(sql.Identifier(table)))
+        conn.execute(sql.SQL(
+            "CREATE OR REPLACE FUNCTION {function}() RETURNS trigger LANGUAGE plpgsql AS $$ BEGIN "
+            "NEW.text_search := to_tsvector({config}::regconfig, coalesce(NEW.{text}, '')); "
+            "RETURN NEW; END $$"
+        ).format(function=function, config=sql.Literal(TEXT_SEARCH_CONFIG),
+                 text=sql.Identifier(_table_column(source, "text"))))
+        exists = conn.execute(
+            "SELECT 1 FROM pg_trigger WHERE tgrelid = %s::regclass AND tgname = %s", (table, trigger)
+        ).fetchone()
+        if not exists:
+            conn.execute(sql.SQL(
+                "CREATE TRIGGER {trigger} BEFORE INSERT OR UPDATE OF {text} ON {table} "
+                "FOR EACH ROW EXECUTE FUNCTION {function}()"
+            ).format(trigger=sql.Identifier(trigger), text=sql.Identifier(_table_column(source, "text")),
+                     table=sql.Identifier(table), function=function))
+
+
+# Remplit text_search des lignes existantes par tranches de post_uri (clé primaire), une
+# transaction courte par tranche ; les lignes écrites entre-temps passent par le trigger
+def _backfill_text_search(conn, source, batch_rows=SEARCH_BACKFILL_ROWS):
+    table, _ = SOURCES[source]
+    upper = sql.SQL(
+        "SELECT max(post_uri) FROM (SELECT post_uri FROM {table} WHERE post_uri > %s "
+        "ORDER BY post_uri LIMIT %s) batch"
+    ).format(table=sql.Identifier(table))
+    update = sql.SQL(
+        "UPDATE {table} SET text_search = to_tsvector({config}::regconfig, coalesce({text}, '')) "
+        "WHERE post_uri > %s AND post_uri <= %s AND text_search IS NULL"
+    ).format(table=sql.Identifier(table), config=sql.Literal(TEXT_SEARCH_CONFIG),
+             text=sql.Identifier(_table_column(source, "text")))
+    after, filled = "", 0
+    while True:
+        last = conn.execute(upper, (after, batch_rows)).fetchone()[0]
+        if last is None:
+            break
+        filled += conn.execute(update, (after, last)).rowcount
+        after = last
+    return filled
+
+
+# Index invalides laissés par un CREATE INDEX CONCURRENTLY interrompu : supprimés pour être
+# reconstruits (IF NOT EXISTS les considérerait comme présents)
+def _drop_invalid_indexes(conn, table):
+    invalid = conn.execute(
+        "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE i.indrelid = %s::regclass AND NOT i.indisvalid AND c.relname = ANY(%s)",
+        (table, _index_names(table)),
+    ).fetchall()
+    for (name,) in invalid:
+        conn.execute(sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(sql.Identifier(name)))
+
+
+# Migration des trois tables (connexion dédiée en autocommit, hors pool : CONCURRENTLY
+# ne peut pas s'exécuter dans une transaction)
+def migrate_search_schema(batch_rows=SEARCH_BACKFILL_ROWS):
+    with psycopg.connect(DB_URL, autocommit=True) as conn:
+        for source in SOURCES:
+            table, _ = SOURCES[source]
+            _add_text_search_column(conn, source)
+            filled = _backfill_text_search(conn, source, batch_rows)
+            _drop_invalid_indexes(conn, table)
+            for statement in _index_statements(source):
+                conn.execute(statement)
+            print(f"✅ {table} : text_search en place ({filled} ligne(s) remplie(s)), index de recherche construits.")
+            _schema_ready.add(source)
+        ensure_predictions_table(conn)
+
+
+# Vérifie (une fois par processus) que la migration a été faite pour les sources demandées :
+# colonne text_search, trigger et index valides. Lecture du catalogue seulement.
+def check_search_schema(sources):
+    unchecked = [source for source in sources if source not in _schema_ready]
+    if not unchecked:
+        return
+    missing = []
+    with get_connection() as conn:
+        for source in unchecked:
+            table, _ = SOURCES[source]
+            ready = conn.execute(
+                "SELECT EXISTS (SELECT 1 FROM pg_attribute WHERE attrelid = %(table)s::regclass "
+                "AND attname = 'text_search' AND NOT attisdropped) "
+                "AND EXISTS (SELECT 1 FROM pg_trigger WHERE tgrelid = %(table)s::regclass AND tgname = %(trigger)s) "
+                "AND (SELECT count(*) FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE i.indrelid = %(table)s::regclass AND i.indisvalid AND c.relname = ANY(%(indexes)s)) = 3",
+                {"table": table, "trigger": f"{table}_text_search_trigger", "indexes": _index_names(table)},
+            ).fetchone()[0]
+            if ready:
+                _schema_ready.add(source)
+            else:
+                missing.append(table)
+    if missing:
+        raise SearchSchemaMissing(
+            f"Schéma de recherche absent pour {', '.join(missing)} : lancer python post_search.py migrate")
+
+
+def encode_cursor(created_at, post_uri):
+    payload = json.dumps([created_at.isoformat() if created_at else None, post_uri])
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, post_uri = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return (datetime.fromisoformat(created_at) if created_at else None), post_uri
+    except Exception:
+        raise ValueError("Cursor de pagination invalide")
+
+
+# Sous-requête d'une table : filtres présents uniquement (plan adapté à chaque combinaison),
+# tri et limite identiques à la requête globale. strategy : "recent" ou "matches" (voir plus haut)
+def _source_query(source, filters, limit, strategy="recent"):
+    table, _ = SOURCES[source]
+    created = sql.Identifier("p", _table_column(source, "created_at_post"))
+    handle = sql.Identifier("p", _table_column(source, "handle"))
+
+    select = []
+    for name in RESULT_COLUMNS:
+        column = _table_column(source, name)
+        value = sql.Identifier("p", column) if column else sql.NULL
+        select.append(sql.SQL("{} AS {}").format(value, sql.Identifier(name)))
+    select.append(sql.SQL("{} AS source").format(sql.Literal(source)))
+
+    # Posts datés, puis posts sans date (filters["undated"]) : deux parcours de l'index
+    conditions = [sql.SQL("{} IS NULL" if filters.get("undated") else "{} IS NOT NULL").format(created)]
+    text_match = sql.SQL("text_search @@ websearch_to_tsquery({}::regconfig, %(q)s)").format(
+        sql.Literal(TEXT_SEARCH_CONFIG))
+    if filters.get("q") and strategy == "matches":
+        conditions.append(sql.SQL("p.") + text_match)
+    if filters.get("handle"):
+        conditions.append(sql.SQL("{} = %(handle)s").format(handle))
+    if filters.get("since"):
+        conditions.append(sql.SQL("{} >= %(since)s").format(created))
+    if filters.get("until"):
+        conditions.append(sql.SQL("{} < %(until)s").format(created))
+    if filters.get("label"):
+        version = sql.SQL(" AND pr.model_version = %(model_version)s") if filters.get("model_version") else sql.SQL("")
+        conditions.append(sql.SQL(
+            "EXISTS (SELECT 1 FROM post_predictions pr WHERE pr.post_uri = p.post_uri "
+            "AND pr.model_name = %(model_name)s{version} AND pr.label = %(label)s)"
+        ).format(version=version))
+    if filters.get("undated"):
+        if filters.get("cursor_post_uri"):
+            conditions.append(sql.SQL("p.post_uri < %(cursor_post_uri)s"))
+    elif filters.get("cursor_created_at"):
+        conditions.append(sql.SQL("({}, p.post_uri) < (%(cursor_created_at)s, %(cursor_post_uri)s)").format(created))
+
+    if filters.get("q") and strategy == "recent":
+        return sql.SQL(
+            "SELECT * FROM ("
+            "SELECT {select}, p.text_search FROM {table} p WHERE {conditions} "
+            "ORDER BY {created} DESC, p.post_uri DESC LIMIT {window}"
+            ") recent WHERE recent.{text_match} ORDER BY created_at_post DESC, post_uri DESC LIMIT {limit}"
+        ).format(
+            select=sql.SQL(", ").join(select),
+            table=sql.Identifier(table),
+            conditions=sql.SQL(" AND ").join(conditions),
+            created=created,
+            window=sql.Literal(SEARCH_RECENT_WINDOW),
+            text_match=text_match,
+            limit=sql.Literal(limit),
+        )
+    if filters.get("q"):
+        # Correspondances matérialisées d'abord : force le passage par l'index GIN
+        return sql.SQL(
+            "WITH matches AS MATERIALIZED (SELECT {select} FROM {table} p WHERE {conditions}) "
+            "SELECT * FROM matches ORDER BY created_at_post DESC, post_uri DESC LIMIT {limit}"
+        ).format(
+            select=sql.SQL(", ").join(select),
+            table=sql.Identifier(table),
+            conditions=sql.SQL(" AND ").join(conditions),
+            limit=sql.Literal(limit),
+        )
+    return sql.SQL(
+        "SELECT {select} FROM {table} p WHERE {conditions} "
+        "ORDER BY {created} DESC, p.post_uri DESC LIMIT {limit}"
+    ).format(
+        select=sql.SQL(", ").join(select),
+        table=sql.Identifier(table),
+        conditions=sql.SQL(" AND ").join(conditions),
+        created=created,
+        limit=sql.Literal(limit),
+    )
+
+
+def _fetch(source, filters, limit, strategy):
+    with get_connection() as conn:
+        cur = conn.execute(_source_query(source, filters, limit, strategy), filters)
+        names = [column.name for column in cur.description if column.name != "text_search"]
+        return [dict(zip(names, row)) for row in cur.fetchall()]
+
+
+# Les limit premières lignes de chaque source, fusionnées. Fenêtre récente retenue pour une
+# source seulement si elle y trouve limit lignes : les correspondances plus anciennes que la
+# fenêtre sont alors toutes derrière la page. Sinon correspondances via l'index GIN.
+def _fetch_sources(sources, filters, limit):
+    rows = []
+    for source in sources:
+        found = _fetch(source, filters, limit, "recent")
+        if filters.get("q") and len(found) < limit:
+            found = _fetch(source, filters, limit, "matches")
+        rows.extend(found)
+    rows.sort(key=lambda row: (row["created_at_post"], row["post_uri"]), reverse=True)
+    return rows[:limit]
+
+
+# Recherche dans une ou plusieurs sources ("search", "user", "single").
+# Renvoie {"items": [...], "next_cursor": ...} ; next_cursor est None sur la dernière page.
+def search_posts(q: str = None, sources=("search",), handle: str = None, since: datetime = None,
+                 until: datetime = None, label: str = None, model_name: str = "fake_news",
+                 model_version: str = None, limit: int = 50, cursor: str = None):
+    sources = list(sources) or list(SOURCES)
+    unknown = [source for source in sources if source not in SOURCES]
+    if unknown:
+        raise ValueError(f"Source inconnue : {', '.join(unknown)} (choix : {', '.join(SOURCES)})")
+    limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+    check_search_schema(sources)
+
+    filters = {"q": q, "handle": handle, "since": since, "until": until, "label": label,
+               "model_name": model_name, "model_version": model_version}
+    undated = False
+    if cursor:
+        filters["cursor_created_at"], filters["cursor_post_uri"] = decode_cursor(cursor)
+        undated = filters["cursor_created_at"] is None
+
+    # Une ligne de plus que la page pour savoir s'il existe une page suivante
+    rows = [] if undated else _fetch_sources(sources, filters, limit + 1)
+    if len(rows) <= limit and not since and not until:
+        # Posts datés épuisés : suite avec les posts sans date (exclus par since / until)
+        undated_filters = {**filters, "undated": True}
+        if not undated:
+            undated_filters["cursor_post_uri"] = None
+        rows += _fetch_sources(sources, undated_filters, limit + 1 - len(rows))
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["created_at_post"], rows[-1]["post_uri"])
+    return {"items": rows, "next_cursor": next_cursor}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recherche dans les posts stockés")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = sub.add_parser("migrate", help="Ajoute text_search (trigger + remplissage) et les index de recherche")
+    migrate_parser.add_argument("--batch-rows", type=int, default=SEARCH_BACKFILL_ROWS,
+                                help="Lignes existantes remplies par transaction")
+
+    query_parser = sub.add_parser("query", help="Recherche plein texte")
+    query_parser.add_argument("q", nargs="?")
+    query_parser.add_argument("--source", nargs="+", default=["search"], choices=list(SOURCES))
+    query_parser.add_argument("--handle")
+    query_parser.add_argument("--label")
+    query_parser.add_argument("--limit", type=int, default=20)
+    query_parser.add_argument("--cursor")
+
+    args = parser.parse_args(argv)
+    if args.command == "migrate":
+        migrate_search_schema(args.batch_rows)
+    else:
+        page = search_posts(args.q, args.source, handle=args.handle, label=args.label,
+                            limit=args.limit, cursor=args.cursor)
+        for item in page["items"]:
+            print(f"{item['created_at_post']}  @{item['handle']}  {item['text']}")
+        print(f"next_cursor : {page['next_cursor']}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,283 @@
+import argparse
+import os
+import sys
+import threading
+from psycopg import sql
+from db import get_connection
+from post_search import SOURCES
+from predictions import ensure_predictions_table, save_predictions
+from near_duplicates import cluster_predictions, build as build_clusters, NEAR_DUP_ENABLED
+from embedding_store import save_embeddings, rebuild_index_if_stale, EMBEDDING_STORE_ENABLED
+from bert_finetune import (
+    predict_batch,
+    predict_and_embed,
+    probabilities_to_scores,
+    EMBEDDINGS_AVAILABLE,
+    MODEL_NAME as FAKE_NEWS_MODEL,
+    MODEL_ID as FAKE_NEWS_MODEL_ID,
+)
+from analyse_des_sentiments import (
+    predict_sentiments,
+    scores_by_label,
+    MODEL_NAME as EMOTION_MODEL,
+    MODEL_VERSION as EMOTION_MODEL_VERSION,
+)
+from metrics import timed, inc
+
+# Rattrapage des prédictions : note les posts des trois tables qui n'ont pas encore de
+# prédiction pour la version courante d'un modèle, et les enregistre dans post_predictions.
+# - parcours par clé (post_uri croissant) en tranches de PREDICTION_BACKFILL_CHUNK_SIZE ;
+# - chaque tranche est notée en lots, puis prédictions + position sont validées dans la
+#   même transaction : une interruption reprend exactement après la dernière tranche ;
+# - la position est propre à (modèle, version, source) : une nouvelle version du modèle
+#   (FAKE_NEWS_MODEL_VERSION, EMOTION_MODEL_VERSION, backend) repart du début et re-note tout ;
+# - quasi-doublons (near_duplicates) : chaque passage rattache d'abord les nouveaux posts à
+#   leurs clusters (hors du chemin d'insertion) ; un post dont le cluster est déjà noté reprend
+#   les scores du représentant, et un seul post par cluster est noté dans une tranche ;
+# - en fin de parcours la position est remise à zéro : le passage suivant ne note que les
+#   posts arrivés entre-temps (les posts déjà notés sont écartés par l'index de post_predictions).
+
+PREDICTION_BACKFILL_CHUNK_SIZE = int(os.getenv("PREDICTION_BACKFILL_CHUNK_SIZE", "256"))
+# Worker intégré à l'API (désactivé par défaut : l'inférence partage alors le CPU des requêtes)
+PREDICTION_BACKFILL_WORKER = os.getenv("PREDICTION_BACKFILL_WORKER", "0") == "1"
+PREDICTION_BACKFILL_POLL_SECONDS = float(os.getenv("PREDICTION_BACKFILL_POLL_SECONDS", "300"))
+
+
+# Tokens du modèle fake news lus dans le cache de tokens (token_cache) par post_uri ;
+# les embeddings de la même passe sont ajoutés au stockage (embedding_store) si le backend
+# sait les produire (pas onnx) ; sinon prédictions seules
+def _score_fake_news(post_uris, texts):
+    if EMBEDDING_STORE_ENABLED and EMBEDDINGS_AVAILABLE:
+        results, embeddings = predict_and_embed(texts, post_uris=post_uris)
+        save_embeddings(post_uris, embeddings)
+    else:
+        results = predict_batch(texts, post_uris=post_uris)
+    return [label for label, _ in results], [probabilities_to_scores(prob_array) for _, prob_array in results]
+
+
+def _score_emotions(post_uris, texts):
+    all_scores = predict_sentiments(texts)
+    labels = [max(scores, key=lambda x: x["score"])["label"] for scores in all_scores]
+    return labels, [scores_by_label(scores) for scores in all_scores]
+
+
+# Modèle -> (version courante, fonction (post_uris, textes) -> (labels, scores))
+SCORERS = {
+    FAKE_NEWS_MODEL: (FAKE_NEWS_MODEL_ID, _score_fake_news),
+    EMOTION_MODEL: (EMOTION_MODEL_VERSION, _score_emotions),
+}
+
+CREATE_BACKFILL_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS prediction_backfill_checkpoints (
+        model_name TEXT NOT NULL,
+        model_version TEXT NOT NULL,
+        source TEXT NOT NULL,
+        last_post_uri TEXT,
+        scored INTEGER NOT NULL DEFAULT 0,
+        passes INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (model_name, model_version, source)
+    );
+"""
+
+_table_ready = False
+_stop = threading.Event()
+_thread = None
+
+
+def _connection():
+    global _table_ready
+    if not _table_ready:
+        with get_connection() as conn:
+            conn.execute(CREATE_BACKFILL_TABLE_SQL)
+            ensure_predictions_table(conn)
+        _table_ready = True
+    return get_connection()
+
+
+def _load_position(model_name, model_version, source):
+    with _connection() as conn:
+        row = conn.execute(
+            "SELECT last_post_uri FROM prediction_backfill_checkpoints "
+            "WHERE model_name = %s AND model_version = %s AND source = %s",
+            (model_name, model_version, source),
+        ).fetchone()
+    return row[0] if row else None
+
+
+# last_post_uri=None et finished=True : parcours terminé, le suivant repart du début
+def _save_position(conn, model_name, model_version, source, last_post_uri, scored, finished=False):
+    conn.execute(
+        """
+        INSERT INTO prediction_backfill_checkpoints
+            (model_name, model_version, source, last_post_uri, scored, passes, updated_at)
+        VALUES (%s, %s, %s, %s, %s, %s, now())
+        ON CONFLICT (model_name, model_version, source) DO UPDATE SET
+            last_post_uri = EXCLUDED.last_post_uri,
+            scored = prediction_backfill_checkpoints.scored + EXCLUDED.scored,
+            passes = prediction_backfill_checkpoints.passes + EXCLUDED.passes,
+            updated_at = now()
+        """,
+        (model_name, model_version, source, last_post_uri, scored, 1 if finished else 0),
+    )
+
+
+# Prochaine tranche de posts sans prédiction pour (modèle, version), après last_post_uri
+def _next_chunk(source, model_name, model_version, last_post_uri, chunk_size):
+    table, columns = SOURCES[source]
+    text = next(column for column, canonical in columns.items() if canonical == "text")
+    query = sql.SQL(
+        "SELECT p.post_uri, p.{text} FROM {table} p "
+        "WHERE p.post_uri > %(after)s AND NOT EXISTS ("
+        "SELECT 1 FROM post_predictions pr WHERE pr.post_uri = p.post_uri "
+        "AND pr.model_name = %(model_name)s AND pr.model_version = %(model_version)s) "
+        "ORDER BY p.post_uri LIMIT %(limit)s"
+    ).format(text=sql.Identifier(text), table=sql.Identifier(table))
+    with _connection() as conn:
+        return conn.execute(query, {
+            "after": last_post_uri or "", "model_name": model_name,
+            "model_version": model_version, "limit": chunk_size,
+        }).fetchall()
+
+
+# Note une tranche : scores du cluster si le représentant est déjà noté, sinon un seul
+# passage par le modèle par cluster (les autres membres reprennent ses scores)
+def _score_chunk(model_name, model_version, score, post_uris, texts):
+    with _connection() as conn:
+        known = cluster_predictions(conn, post_uris, model_name, model_version)
+    labels = [None] * len(post_uris)
+    scores = [None] * len(post_uris)
+    to_score = []
+    cluster_rows = {}
+    for i, post_uri in enumerate(post_uris):
+        cluster_id, label, post_scores = known.get(post_uri, (None, None, None))
+        if label is not None:
+            labels[i], scores[i] = label, post_scores
+        elif cluster_id is None:
+            to_score.append(i)
+        else:
+            if cluster_id not in cluster_rows:
+                to_score.append(i)
+            cluster_rows.setdefault(cluster_id, []).append(i)
+    if to_score:
+        computed_labels, computed_scores = score([post_uris[i] for i in to_score], [texts[i] for i in to_score])
+        for i, label, post_scores in zip(to_score, computed_labels, computed_scores):
+            labels[i], scores[i] = label, post_scores
+    for rows in cluster_rows.values():
+        for i in rows[1:]:
+            labels[i], scores[i] = labels[rows[0]], scores[rows[0]]
+    reused = len(post_uris) - len(to_score)
+    if reused:
+        inc("predictions_reused_total", reused, model=model_name)
+    return labels, scores
+
+
+# Note les posts d'une source pour un modèle ; s'arrête en fin de table, après max_chunks
+# tranches, ou quand stop_event est levé. Renvoie le nombre de posts notés.
+def backfill_source(source: str, model_name: str, chunk_size: int = PREDICTION_BACKFILL_CHUNK_SIZE,
+                    max_chunks: int = None, stop_event: threading.Event = None):
+    model_version, score = SCORERS[model_name]
+    last_post_uri = _load_position(model_name, model_version, source)
+    scored = 0
+    chunks = 0
+    while not (stop_event and stop_event.is_set()) and (max_chunks is None or chunks < max_chunks):
+        rows = _next_chunk(source, model_name, model_version, last_post_uri, chunk_size)
+        if not rows:
+            with _connection() as conn:
+                _save_position(conn, model_name, model_version, source, None, 0, finished=True)
+            break
+        post_uris = [post_uri for post_uri, _ in rows]
+        with timed(f"prediction_backfill.{model_name}"):
+            labels, scores = _score_chunk(model_name, model_version, score, post_uris,
+                                          [text or "" for _, text in rows])
+        with _connection() as conn, conn.transaction():
+            save_predictions(conn, model_name, model_version, post_uris, labels, scores)
+            _save_position(conn, model_name, model_version, source, post_uris[-1], len(rows))
+        last_post_uri = post_uris[-1]
+        scored += len(rows)
+        chunks += 1
+        inc("predictions_backfilled_total", len(rows), model=model_name, source=source)
+    return scored
+
+
+# Rattrapage de plusieurs modèles sur plusieurs sources (par défaut : tous)
+def run_backfill(models: list = None, sources: list = None, chunk_size: int = PREDICTION_BACKFILL_CHUNK_SIZE,
+                 max_chunks: int = None, stop_event: threading.Event = None):
+    if NEAR_DUP_ENABLED:
+        build_clusters(sources, stop_event=stop_event)
+    totals = {}
+    for model_name in models or list(SCORERS):
+        if model_name not in SCORERS:
+            raise ValueError(f"Modèle inconnu : {model_name} (choix : {', '.join(SCORERS)})")
+        for source in sources or list(SOURCES):
+            count = backfill_source(source, model_name, chunk_size, max_chunks, stop_event)
+            totals[f"{model_name}/{source}"] = count
+            print(f"✅ {count} post(s) noté(s) par {model_name} ({SCORERS[model_name][0]}) dans {source}.")
+    return totals
+
+
+# Positions et nombre de posts notés pour chaque (modèle, version, source)
+def backfill_status():
+    with _connection() as conn:
+        cur = conn.execute(
+            "SELECT model_name, model_version, source, last_post_uri, scored, passes, updated_at "
+            "FROM prediction_backfill_checkpoints ORDER BY model_name, model_version, source"
+        )
+        names = [column.name for column in cur.description]
+        rows = [dict(zip(names, row)) for row in cur.fetchall()]
+    for row in rows:
+        row["current_version"] = SCORERS.get(row["model_name"], (None,))[0] == row["model_version"]
+    return rows
+
+
+def _worker_loop():
+    while not _stop.is_set():
+        try:
+            run_backfill(stop_event=_stop)
+            if EMBEDDING_STORE_ENABLED:
+                rebuild_index_if_stale()
+        except Exception as e:
+            print(f"⚠️ Rattrapage des prédictions interrompu : {e}")
+        _stop.wait(PREDICTION_BACKFILL_POLL_SECONDS)
+
+
+def start_backfill_worker():
+    global _thread
+    if _thread is not None or not PREDICTION_BACKFILL_WORKER:
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_worker_loop, name="prediction-backfill", daemon=True)
+    _thread.start()
+    print("✅ Worker de rattrapage des prédictions démarré.")
+
+
+# Arrêt après la tranche en cours (déjà validée avec sa position)
+def stop_backfill_worker(timeout: float = 60):
+    global _thread
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout)
+        _thread = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rattrapage des prédictions des posts stockés")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run_parser = sub.add_parser("run", help="Note les posts sans prédiction pour la version courante")
+    run_parser.add_argument("--model", nargs="+", choices=list(SCORERS))
+    run_parser.add_argument("--source", nargs="+", choices=list(SOURCES))
+    run_parser.add_argument("--chunk-size", type=int, default=PREDICTION_BACKFILL_CHUNK_SIZE)
+    run_parser.add_argument("--max-chunks", type=int)
+    sub.add_parser("status", help="Positions du rattrapage")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        run_backfill(args.model, args.source, args.chunk_size, args.max_chunks)
+    else:
+        for row in backfill_status():
+            print(f"{row['model_name']} {row['model_version']} {row['source']} : {row['scored']} noté(s), "
+                  f"{row['passes']} passage(s) terminé(s), position {row['last_post_uri'] or 'début'}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
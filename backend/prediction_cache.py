@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Cache des prédictions adressé par contenu : clé = sha256(identifiant du modèle + texte tel
+# que le modèle le reçoit). Deux niveaux : un LRU en mémoire (borné en octets) puis,
+# en option, une table Postgres partagée entre les processus. Les valeurs doivent être
+# sérialisables en JSON.
+# Taille d'une entrée (approximative) : clé + JSON compact de la valeur + surcoût fixe des
+# objets Python ; les entrées les moins récemment lues sont évincées au-delà du budget.
+
+PREDICTION_CACHE_MAX_MB = float(os.getenv("PREDICTION_CACHE_MAX_MB", "64"))
+# Surcoût par entrée (objets Python de la clé, de la valeur et du LRU), en octets
+ENTRY_OVERHEAD_BYTES = 400
+# Niveau Postgres désactivé par défaut (un aller-retour par appel), PREDICTION_CACHE_DB=1 pour l'activer
+PREDICTION_CACHE_DB = os.getenv("PREDICTION_CACHE_DB", "0") == "1"
+# Attente max d'une connexion pour le cache (s) : au-delà, la prédiction continue sans lui
+PREDICTION_CACHE_DB_TIMEOUT = float(os.getenv("PREDICTION_CACHE_DB_TIMEOUT", "0.5"))
+# Après une erreur, le niveau Postgres est ignoré pendant ce délai (s) : mémoire seule
+PREDICTION_CACHE_DB_RETRY = float(os.getenv("PREDICTION_CACHE_DB_RETRY", "60"))
+
+CREATE_CACHE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS prediction_cache (
+        cache_key TEXT PRIMARY KEY,
+        model_id TEXT NOT NULL,
+        result JSONB NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+"""
+
+_memory = OrderedDict()
+# Taille estimée de chaque entrée et total (octets)
+_sizes = {}
+_memory_bytes = 0
+_lock = threading.Lock()
+_stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "evictions": 0, "db_errors": 0}
+_table_ready = False
+_db_retry_at = 0.0
+
+
+def cache_key(model_id: str, text: str):
+    return hashlib.sha256(f"{model_id}\0{text}".encode("utf-8")).hexdigest()
+
+
+def _ensure_table(conn):
+    global _table_ready
+    if not _table_ready:
+        conn.execute(CREATE_CACHE_TABLE_SQL)
+        _table_ready = True
+
+
+def _entry_bytes(key, value):
+    return len(key) + len(json.dumps(value, separators=(",", ":"))) + ENTRY_OVERHEAD_BYTES
+
+
+def _remember(key, value):
+    global _memory_bytes
+    size = _entry_bytes(key, value)
+    _memory_bytes += size - _sizes.get(key, 0)
+    _sizes[key] = size
+    _memory[key] = value
+    _memory.move_to_end(key)
+    budget = PREDICTION_CACHE_MAX_MB * 1024 * 1024
+    while _memory_bytes > budget and len(_memory) > 1:
+        evicted, _ = _memory.popitem(last=False)
+        _memory_bytes -= _sizes.pop(evicted)
+        _stats["evictions"] += 1
+
+
+def _db_available():
+    return PREDICTION_CACHE_DB and time.monotonic() >= _db_retry_at
+
+
+def _db_failed(e):
+    global _db_retry_at
+    _db_retry_at = time.monotonic() + PREDICTION_CACHE_DB_RETRY
+    _stats["db_errors"] += 1
+    print(f"⚠️ Cache de prédictions Postgres indisponible, mémoire seule pendant {PREDICTION_CACHE_DB_RETRY:.0f}s : {e}")
+
+
+def _db_get_many(keys):
+    from db import get_connection
+    try:
+        with get_connection(PREDICTION_CACHE_DB_TIMEOUT) as conn:
+            _ensure_table(conn)
+            rows = conn.execute(
+                "SELECT cache_key, result FROM prediction_cache WHERE cache_key = ANY(%s)",
+                (list(keys),),
+            ).fetchall()
+        return dict(rows)
+    except Exception as e:
+        _db_failed(e)
+        return {}
+
+
+def _db_put_many(model_id, items):
+    from db import get_connection
+    from psycopg.types.json import Jsonb
+    try:
+        with get_connection(PREDICTION_CACHE_DB_TIMEOUT) as conn:
+            _ensure_table(conn)
+            with conn.cursor() as cur:
+                cur.executemany(
+                    "INSERT INTO prediction_cache (cache_key, model_id, result) VALUES (%s, %s, %s) "
+                    "ON CONFLICT (cache_key) DO NOTHING",
+                    [(key, model_id, Jsonb(value)) for key, value in items.items()],
+                )
+    except Exception as e:
+        _db_failed(e)
+
+
+# Renvoie {index: valeur} pour les textes déjà en cache (mémoire puis Postgres)
+def get_many(model_id: str, texts: list):
+    keys = [cache_key(model_id, text) for text in texts]
+    found = {}
+    missing = {}
+    with _lock:
+        for i, key in enumerate(keys):
+            if key in _memory:
+                _memory.move_to_end(key)
+                found[i] = _memory[key]
+                _stats["memory_hits"] += 1
+            else:
+                missing.setdefault(key, []).append(i)
+    if missing and _db_available():
+        from_db = _db_get_many(missing)
+        with _lock:
+            for key, value in from_db.items():
+                _remember(key, value)
+                for i in missing.pop(key):
+                    found[i] = value
+                    _stats["db_hits"] += 1
+    with _lock:
+        _stats["misses"] += sum(len(indices) for indices in missing.values())
+    return found
+
+
+# Enregistre les résultats calculés (listes alignées textes / valeurs)
+def put_many(model_id: str, texts: list, values: list):
+    items = {cache_key(model_id, text): value for text, value in zip(texts, values)}
+    with _lock:
+        for key, value in items.items():
+            _remember(key, value)
+    if items and _db_available():
+        _db_put_many(model_id, items)
+
+
+def get(model_id: str, text: str):
+    return get_many(model_id, [text]).get(0)
+
+
+def put(model_id: str, text: str, value):
+    put_many(model_id, [text], [value])
+
+
+# Taux de succès du cache (part des prédictions évitées)
+def cache_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats["memory_entries"] = len(_memory)
+        stats["memory_mb"] = round(_memory_bytes / (1024 * 1024), 2)
+    lookups = stats["memory_hits"] + stats["db_hits"] + stats["misses"]
+    stats["hit_rate"] = round((stats["memory_hits"] + stats["db_hits"]) / lookups, 4) if lookups else 0.0
+    return stats
+
+
+def clear_memory():
+    global _memory_bytes
+    with _lock:
+        _memory.clear()
+        _sizes.clear()
+        _memory_bytes = 0
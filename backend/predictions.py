@@ -0,0 +1,53 @@
+import json
+
+# Prédictions enregistrées par post : une ligne par (post_uri, modèle, version du modèle).
+# label = prédiction principale (ex. "Faux", "joy"), scores = détail complet en JSON.
+# Une nouvelle version du modèle ajoute ses propres lignes ; les anciennes restent lisibles.
+
+CREATE_PREDICTIONS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS post_predictions (
+        post_uri TEXT NOT NULL,
+        model_name TEXT NOT NULL,
+        model_version TEXT NOT NULL,
+        label TEXT,
+        scores JSONB,
+        scored_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (post_uri, model_name, model_version)
+    );
+    CREATE INDEX IF NOT EXISTS post_predictions_label_idx
+        ON post_predictions (model_name, model_version, label, post_uri);
+"""
+
+PREDICTION_COLUMNS = ["post_uri", "model_name", "model_version", "label", "scores"]
+
+_table_ready = False
+
+
+def ensure_predictions_table(conn):
+    global _table_ready
+    if not _table_ready:
+        conn.execute(CREATE_PREDICTIONS_TABLE_SQL)
+        _table_ready = True
+
+
+# Enregistre les prédictions d'un lot (COPY + upsert) dans la transaction de conn.
+# scores : un dict {label: score} par post ; un post déjà noté par cette version est mis à jour.
+def save_predictions(conn, model_name: str, model_version: str, post_uris, labels, scores):
+    from db import bulk_insert_rows
+    ensure_predictions_table(conn)
+    rows = [
+        (post_uri, model_name, model_version, label, json.dumps(post_scores))
+        for post_uri, label, post_scores in zip(post_uris, labels, scores)
+    ]
+    if not rows:
+        return {"inserted": 0, "skipped": 0, "rejected": 0}
+    return bulk_insert_rows(conn, "post_predictions", PREDICTION_COLUMNS, rows,
+                            key="post_uri, model_name, model_version",
+                            update_columns=["label", "scores", "scored_at"])
+
+
+# Enregistre les prédictions d'une page annotée (predict_pages / predict_sentiment_pages)
+def save_page_predictions(page, model_name: str, model_version: str, labels, scores):
+    from db import get_connection
+    with get_connection() as conn:
+        return save_predictions(conn, model_name, model_version, page["post_uri"].tolist(), labels, scores)
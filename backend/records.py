@@ -0,0 +1,237 @@
+import json
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+
+# Normalisation des réponses de l'API Bluesky en lots colonnaires typés (PostBatch).
+# Un seul schéma canonique pour les trois chemins d'import (recherche, fil d'un auteur,
+# post unique) : chaque page est lue en une passe puis convertie colonne par colonne
+# en tableaux NumPy (int64, datetime64[us] UTC, objets pour le texte et les booléens
+# nullables). Les insertions lisent directement ces colonnes, sans dict par post.
+
+POST_SCHEMA = {
+    "post_uri": "text",
+    "post_url": "text",
+    "post_cid": "text",
+    "text": "text",
+    "created_at_post": "timestamp",
+    "indexed_at_post": "timestamp",
+    "embed": "text",
+    "like_count": "int",
+    "repost_count": "int",
+    "reply_count": "int",
+    "did": "text",
+    "handle": "text",
+    "display_name": "text",
+    "bio": "text",
+    "followers_count": "int",
+    "follows_count": "int",
+    "posts_count": "int",
+    "created_at_profile": "timestamp",
+    "indexed_at_profile": "timestamp",
+    "viewer_muted": "bool",
+    "viewer_following": "text",
+    "viewer_blocked_by": "bool",
+    "labels": "text",
+    "collected_at": "timestamp",
+}
+POST_COLUMNS = list(POST_SCHEMA)
+
+# Colonnes décrivant l'auteur (profil), diffusées sur tout un lot pour le fil d'un compte
+PROFILE_COLUMNS = [
+    "did", "handle", "display_name", "bio",
+    "followers_count", "follows_count", "posts_count",
+    "created_at_profile", "indexed_at_profile",
+    "viewer_muted", "viewer_following", "viewer_blocked_by",
+    "labels",
+]
+
+
+def utc_now():
+    return datetime.now(timezone.utc)
+
+
+# Tableau 1-D d'objets Python (listes, dicts...) sans que NumPy tente d'en faire une matrice
+def object_column(values):
+    column = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        column[i] = value
+    return column
+
+
+# Horodatages ISO 8601 -> datetime64[us] UTC (NaT si absent ou invalide).
+# Cas courant de l'API ("...Z") parsé directement par NumPy ; pandas sinon (décalages horaires).
+def _parse_timestamps(values):
+    if all(value is None or (isinstance(value, str) and (value == "" or value.endswith("Z"))) for value in values):
+        try:
+            return np.array([value[:-1] if value else None for value in values], dtype="datetime64[us]")
+        except ValueError:
+            pass
+    parsed = pd.to_datetime(pd.Series(values, dtype=object), utc=True, errors="coerce", format="ISO8601")
+    return parsed.dt.tz_localize(None).to_numpy(dtype="datetime64[us]")
+
+
+# Conversion d'une colonne de valeurs brutes vers le type du schéma canonique
+def typed_column(name, values):
+    kind = POST_SCHEMA.get(name)
+    if kind == "int":
+        return np.fromiter((value or 0 for value in values), dtype=np.int64, count=len(values))
+    if kind == "timestamp":
+        return _parse_timestamps(values)
+    if kind == "text":
+        return object_column([value if value != "" else None for value in values])
+    return object_column(values)
+
+
+# Horodatage NumPy (UTC) -> datetime Python avec fuseau, None pour NaT
+def to_datetime(value):
+    if value is None or np.isnat(value):
+        return None
+    return value.astype("datetime64[us]").item().replace(tzinfo=timezone.utc)
+
+
+def to_datetime64(value):
+    if value is None:
+        return np.datetime64("NaT", "us")
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return np.datetime64(value, "us")
+
+
+def _clean_text(value):
+    return value.replace("\n", " ").strip() if isinstance(value, str) else ""
+
+
+def _post_values(post_view):
+    record = post_view.record
+    author = post_view.author
+    viewer = getattr(author, "viewer", None)
+    rkey = post_view.uri.split("/")[-1]
+    return (
+        post_view.uri,
+        f"https://bsky.app/profile/{author.handle}/post/{rkey}",
+        post_view.cid,
+        _clean_text(getattr(record, "text", "")),
+        getattr(record, "created_at", None),
+        getattr(post_view, "indexed_at", None),
+        json.dumps(getattr(record, "embed", {}) or {}, default=str),
+        getattr(post_view, "like_count", 0),
+        getattr(post_view, "repost_count", 0),
+        getattr(post_view, "reply_count", 0),
+        author.did,
+        author.handle,
+        getattr(author, "display_name", None),
+        _clean_text(getattr(author, "description", "")),
+        getattr(author, "followers_count", 0),
+        getattr(author, "follows_count", 0),
+        getattr(author, "posts_count", 0),
+        getattr(author, "created_at", None),
+        getattr(author, "indexed_at", None),
+        getattr(viewer, "muted", None) if viewer else None,
+        getattr(viewer, "following", None) if viewer else None,
+        getattr(viewer, "blocked_by", None) if viewer else None,
+        json.dumps(getattr(author, "labels", []) or [], default=str),
+    )
+
+
+# Lot de posts en colonnes : {nom de colonne: tableau NumPy}, toutes de même longueur
+class PostBatch:
+    def __init__(self, columns):
+        self.columns = columns
+
+    @classmethod
+    def empty(cls):
+        return cls({name: typed_column(name, []) for name in POST_COLUMNS})
+
+    @classmethod
+    def concat(cls, batches):
+        batches = [batch for batch in batches if len(batch)]
+        if not batches:
+            return cls.empty()
+        names = [name for name in batches[0].columns if all(name in batch.columns for batch in batches)]
+        return cls({name: np.concatenate([batch.columns[name] for batch in batches]) for name in names})
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __setitem__(self, name, values):
+        if not isinstance(values, np.ndarray):
+            values = object_column(values)
+        if self.columns and len(values) != len(self):
+            raise ValueError(f"Colonne {name} : {len(values)} valeurs pour un lot de {len(self)} posts")
+        self.columns[name] = values
+
+    # Sous-lot (indices ou masque booléen) ; les colonnes sont indexées, pas recopiées post par post
+    def take(self, selection):
+        return PostBatch({name: column[selection] for name, column in self.columns.items()})
+
+    # Remplace des colonnes par une valeur constante (ex. profil du compte pour son fil)
+    def assign(self, **values):
+        columns = dict(self.columns)
+        for name, value in values.items():
+            columns[name] = typed_column(name, [value] * len(self))
+        return PostBatch(columns)
+
+    # Valeurs Python d'une colonne, prêtes pour COPY / JSON (horodatages en ISO 8601 UTC)
+    def python_values(self, name):
+        column = self.columns[name]
+        if column.dtype.kind == "M":
+            strings = np.datetime_as_string(column, unit="us", timezone="UTC")
+            return np.where(np.isnat(column), None, strings).tolist()
+        return column.tolist()
+
+    # Tuples dans l'ordre des colonnes demandées (transposition unique du lot)
+    def rows(self, names):
+        return list(zip(*[self.python_values(name) for name in names]))
+
+    def records(self, names=None):
+        names = list(names or self.columns)
+        return [dict(zip(names, row)) for row in self.rows(names)]
+
+    def to_pandas(self):
+        return pd.DataFrame({
+            name: (column.tolist() if column.ndim > 1 else column) for name, column in self.columns.items()
+        })
+
+
+# Une page de PostView (recherche, fil d'auteur, fil de discussion) -> PostBatch.
+# Les posts malformés sont ignorés ; collected_at est commun à toute la page.
+def normalize_post_views(post_views, collected_at=None):
+    rows = []
+    for post_view in post_views:
+        try:
+            rows.append(_post_values(post_view))
+        except Exception:
+            continue
+    names = POST_COLUMNS[:-1]
+    values = list(zip(*rows)) if rows else [()] * len(names)
+    columns = {name: typed_column(name, list(column)) for name, column in zip(names, values)}
+    columns["collected_at"] = np.full(len(rows), to_datetime64(collected_at or utc_now()), dtype="datetime64[us]")
+    return PostBatch(columns)
+
+
+# Profil (get_profile) -> dict avec les noms de colonnes canoniques
+def normalize_profile(profile, collected_at=None):
+    viewer = getattr(profile, "viewer", None)
+    return {
+        "did": profile.did,
+        "handle": profile.handle,
+        "display_name": getattr(profile, "display_name", None),
+        "bio": _clean_text(getattr(profile, "description", "")),
+        "followers_count": getattr(profile, "followers_count", 0),
+        "follows_count": getattr(profile, "follows_count", 0),
+        "posts_count": getattr(profile, "posts_count", 0),
+        "created_at_profile": getattr(profile, "created_at", None),
+        "indexed_at_profile": getattr(profile, "indexed_at", None),
+        "viewer_muted": getattr(viewer, "muted", None) if viewer else None,
+        "viewer_following": getattr(viewer, "following", None) if viewer else None,
+        "viewer_blocked_by": getattr(viewer, "blocked_by", None) if viewer else None,
+        "labels": json.dumps(getattr(profile, "labels", []) or [], default=str),
+        "collected_at": (collected_at or utc_now()).isoformat(),
+    }
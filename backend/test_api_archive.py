@@ -0,0 +1,55 @@
+from types import SimpleNamespace as NS
+import pytest
+import api_archive
+from api_archive import ArchiveWriter, ReplayClient
+from test_checkpoints import post_view
+
+# Aller-retour enregistrement -> rejeu des réponses de l'API, sans réseau ni base de données.
+
+
+def test_replay_serves_recorded_responses_in_order(tmp_path):
+    writer = ArchiveWriter(str(tmp_path), chunk_records=1)
+    writer.write("search_posts", {"q": "vaccin", "limit": 2, "cursor": None}, NS(posts=[], cursor="c1"))
+    writer.write("search_posts", {"q": "vaccin", "limit": 2, "cursor": None}, NS(posts=[], cursor="c2"))
+    writer.write("search_posts", {"q": "vaccin", "limit": 2, "cursor": "c1"}, NS(posts=[], cursor=None))
+    writer.close()
+    assert len(api_archive.chunk_paths(str(tmp_path))) == 3
+
+    client = ReplayClient(str(tmp_path))
+    search = client.app.bsky.feed.search_posts
+    assert len(client) == 3
+    # Paramètres absents et None confondus ; la dernière réponse est ensuite répétée
+    assert search({"q": "vaccin", "limit": 2}).cursor == "c1"
+    assert search({"q": "vaccin", "limit": 2, "cursor": None}).cursor == "c2"
+    assert search({"q": "vaccin", "limit": 2}).cursor == "c2"
+    assert search({"q": "vaccin", "limit": 2, "cursor": "c1"}).cursor is None
+    assert client.calls == 4
+    with pytest.raises(LookupError):
+        search({"q": "autre", "limit": 2})
+
+
+def test_atproto_models_are_replayed_as_models(tmp_path):
+    models = pytest.importorskip("atproto").models
+    profile = models.AppBskyActorDefs.ProfileViewDetailed(did="did:plc:a", handle="a.bsky.social",
+                                                          followers_count=12)
+    writer = ArchiveWriter(str(tmp_path))
+    writer.write("get_profile", {"actor": "a.bsky.social"}, profile)
+    writer.close()
+
+    replayed = ReplayClient(str(tmp_path)).app.bsky.actor.get_profile({"actor": "a.bsky.social"})
+    assert isinstance(replayed, models.AppBskyActorDefs.ProfileViewDetailed)
+    assert replayed.model_dump() == profile.model_dump()
+
+
+def test_recorded_pages_are_normalized_again(tmp_path):
+    writer = ArchiveWriter(str(tmp_path))
+    views = [post_view(1, "2024-06-01T00:00:00Z"), post_view(2, "2024-06-02T00:00:00Z")]
+    writer.write("search_posts", {"q": "vaccin"}, NS(posts=views, cursor=None))
+    writer.write("resolve_handle", {"handle": "a.bsky.social"}, NS(did="did:plc:a"))
+    writer.close()
+
+    pages = list(api_archive.iter_pages(str(tmp_path)))
+    assert [source for source, _ in pages] == ["search"]
+    page = pages[0][1]
+    assert list(page["post_uri"]) == [view.uri for view in views]
+    assert list(page["text"]) == ["post 1", "post 2"]
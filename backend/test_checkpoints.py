@@ -0,0 +1,76 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace as NS
+import pytest
+import checkpoints
+from records import normalize_post_views
+
+# Régression : un repost, un post épinglé ou un post antidaté en tête du fil ne doit ni
+# arrêter le rattrapage ni faire sauter les posts plus récents qui le suivent.
+
+FRONTIER = datetime(2024, 6, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def post_view(i, indexed_at, created_at=None):
+    author = NS(did="did:plc:a", handle="a.bsky.social", display_name="A", description="",
+                followers_count=0, follows_count=0, posts_count=0, created_at=None, indexed_at=None,
+                viewer=None, labels=[])
+    record = NS(text=f"post {i}", created_at=created_at or indexed_at, embed=None)
+    return NS(uri=f"at://did:plc:a/app.bsky.feed.post/p{i}", cid=f"c{i}", record=record, author=author,
+              indexed_at=indexed_at, like_count=0, repost_count=0, reply_count=0)
+
+
+def page(views, reasons=None):
+    batch = normalize_post_views(views)
+    if reasons is not None:
+        batch["feed_reason"] = reasons
+    return batch
+
+
+@pytest.fixture
+def store(monkeypatch):
+    saved = {"checkpoint": {
+        "newest_indexed_at": FRONTIER, "newest_post_uri": "at://did:plc:a/app.bsky.feed.post/p0",
+        "pending_indexed_at": None, "pending_post_uri": None, "last_cursor": None,
+    }}
+    monkeypatch.setattr(checkpoints, "load_checkpoint", lambda source, key: dict(saved["checkpoint"]))
+    monkeypatch.setattr(checkpoints, "save_checkpoint", lambda source, key, checkpoint: saved.update(checkpoint=checkpoint))
+    return saved
+
+
+def collect(pages):
+    cursor_pages = lambda cursor: iter([(p, str(i + 1) if i + 1 < len(pages) else None) for i, p in enumerate(pages)])
+    return [uri for batch in checkpoints._iter_new_pages("profile", "a", cursor_pages) for uri in batch["post_uri"]]
+
+
+def test_repost_and_pin_of_old_posts_do_not_stop_catch_up(store):
+    pages = [
+        page([post_view(90, "2023-01-01T00:00:00Z"), post_view(91, "2023-02-01T00:00:00Z"),
+              post_view(3, "2024-06-03T00:00:00Z")], ["pin", "repost", None]),
+        page([post_view(2, "2024-06-02T00:00:00Z"), post_view(0, "2024-06-01T12:00:00Z")], [None, None]),
+        page([post_view(-1, "2024-05-01T00:00:00Z")], [None]),
+    ]
+    collected = collect(pages)
+    assert collected == [f"at://did:plc:a/app.bsky.feed.post/p{i}" for i in (90, 91, 3, 2)]
+    assert store["checkpoint"]["newest_post_uri"].endswith("/p3")
+    assert store["checkpoint"]["last_cursor"] is None
+
+
+def test_backdated_post_does_not_stop_catch_up(store):
+    pages = [
+        page([post_view(5, "2024-06-05T00:00:00Z", created_at="2020-01-01T00:00:00Z"),
+              post_view(4, "2024-06-04T00:00:00Z")]),
+        page([post_view(3, "2024-06-03T00:00:00Z"), post_view(1, "2024-05-01T00:00:00Z")]),
+    ]
+    collected = collect(pages)
+    assert collected == [f"at://did:plc:a/app.bsky.feed.post/p{i}" for i in (5, 4, 3)]
+    assert store["checkpoint"]["newest_post_uri"].endswith("/p5")
+
+
+def test_out_of_order_post_at_top_does_not_stop_catch_up(store):
+    pages = [
+        page([post_view(7, "2024-01-01T00:00:00Z"), post_view(6, "2024-06-06T00:00:00Z")]),
+        page([post_view(0, "2024-06-01T12:00:00Z")]),
+    ]
+    collected = collect(pages)
+    assert collected == ["at://did:plc:a/app.bsky.feed.post/p6"]
+    assert store["checkpoint"]["newest_post_uri"].endswith("/p6")
@@ -14,29 +14,30 @@ except ImportError:
     print("Veuillez installer le SDK AT Protocol Python : pip install atproto")
     sys.exit(1)
 
+from bluesky_session import get_client
+from records import PostBatch, PROFILE_COLUMNS, normalize_post_views, normalize_profile
+
 # Identifiants Bluesky
 BLUESKY_IDENTIFIER = 'bbskyprojet.bsky.social'
 BLUESKY_APP_PASSWORD = 'n3b7-57x2-m552-lbjv'
 OUTPUT_CSV_SEARCH = 'bluesky_search_results.csv'
 
 def search_bluesky_posts(query, limit=100, lang=None):
-    client = Client(base_url="https://bsky.social")
     try:
-        print(f"Tentative de connexion à Bluesky pour {BLUESKY_IDENTIFIER}...")
-        client.login(BLUESKY_IDENTIFIER, BLUESKY_APP_PASSWORD)
-        print("Connexion réussie !\n")
+        client = get_client(BLUESKY_IDENTIFIER, BLUESKY_APP_PASSWORD)
 
         all_posts = []
+        collected = 0
         cursor = None
 
         print(f"Recherche de posts contenant '{query}' avec une limite de {limit}...")
         if lang:
             print(f"Filtrage par langue : {lang}")
 
-        while len(all_posts) < limit:
+        while collected < limit:
             params = {
                 "q": query,
-                "limit": min(100, limit - len(all_posts)),
+                "limit": min(100, limit - collected),
                 "cursor": cursor
             }
             if lang:
@@ -51,43 +52,11 @@ def search_bluesky_posts(query, limit=100, lang=None):
                 print("Plus de posts disponibles pour cette recherche.\n")
                 break
 
-            for post_view in batch:
-                try:
-                    record = post_view.record
-                    author = post_view.author
-                    viewer = getattr(author, 'viewer', None)
-
-                    info = {
-                        'post_uri': post_view.uri,
-                        'post_url': f"https://bsky.app/profile/{author.handle}/post/{post_view.uri.split('/')[-1]}",
-                        'post_cid': post_view.cid,
-                        'text': getattr(record, 'text', '').replace('\n', ' ').strip(),
-                        'createdAt_post': getattr(record, 'created_at', ''),
-                        'indexedAt_post': getattr(post_view, 'indexed_at', ''),
-                        'embed': json.dumps(getattr(record, 'embed', {}) or {}, default=str),
-                        'likeCount': getattr(post_view, 'like_count', 0),
-                        'repostCount': getattr(post_view, 'repost_count', 0),
-                        'replyCount': getattr(post_view, 'reply_count', 0),
-                        'did': author.did,
-                        'handle': author.handle,
-                        'displayName': getattr(author, 'display_name', ''),
-                        'followersCount': getattr(author, 'followers_count', 0),
-                        'followsCount': getattr(author, 'follows_count', 0),
-                        'postsCount': getattr(author, 'posts_count', 0),
-                        'createdAt_profile': getattr(author, 'created_at', ''),
-                        'indexedAt_profile': getattr(author, 'indexed_at', ''),
-                        'viewer_muted': getattr(viewer, 'muted', None) if viewer else None,
-                        'viewer_following': getattr(viewer, 'following', None) if viewer else None,
-                        'viewer_blockedBy': getattr(viewer, 'blocked_by', None) if viewer else None,
-                        #'labels': json.dumps(getattr(author, 'labels', []) or []),
-                        'collectedAt': datetime.utcnow().isoformat() + 'Z'
-                    }
-
-                    all_posts.append(info)
-
-                except Exception as post_e:
-                    print(f"Erreur lors du traitement du post {getattr(post_view, 'uri', 'inconnu')} : {post_e}")
-                    continue
+            page = normalize_post_views(batch)
+            if len(page) < len(batch):
+                print(f"{len(batch) - len(page)} post(s) malformé(s) ignoré(s) dans ce batch")
+            all_posts.append(page)
+            collected += len(page)
 
             cursor = getattr(search_response, "cursor", None)
             print(f"Cursor pour la prochaine requête : {cursor}\n")
@@ -96,7 +65,7 @@ def search_bluesky_posts(query, limit=100, lang=None):
                 break
 
             if all_posts:
-              df = pd.DataFrame(all_posts)
+              df = PostBatch.concat(all_posts).to_pandas()
             return df
         else:
             print("Aucun post n'a été collecté, retour d'un DataFrame vide.")
@@ -126,11 +95,8 @@ def collect_user_posts_to_dataframe(profile_url: str, limit: int) -> pd.DataFram
     print(f"Handle extrait : {handle}")
 
     # 2. Connexion au client Bluesky
-    client = Client(base_url="https://bsky.social")
     try:
-        print(f"Tentative de connexion à Bluesky pour {BLUESKY_IDENTIFIER}...")
-        client.login(BLUESKY_IDENTIFIER, BLUESKY_APP_PASSWORD)
-        print("Connexion réussie !\n")
+        client = get_client(BLUESKY_IDENTIFIER, BLUESKY_APP_PASSWORD)
     except Exception as e:
         print(f"❌ Erreur de connexion à Bluesky : {e}")
         return pd.DataFrame()
@@ -138,29 +104,22 @@ def collect_user_posts_to_dataframe(profile_url: str, limit: int) -> pd.DataFram
     # 3. Récupération du profil
     try:
         profile = client.app.bsky.actor.get_profile({'actor': handle})
-        user_data = {
-            'username': profile.handle,
-            'user_id': profile.did,
-            'bio': profile.description.replace('\n', ' ').strip() if isinstance(profile.description, str) else '',
-            'followers_count': getattr(profile, 'followers_count', 0),
-            'follows_count': getattr(profile, 'follows_count', 0),
-            'posts_count': getattr(profile, 'posts_count', 0),
-            'profile_created_at': getattr(profile, 'created_at', ''),
-        }
+        user_data = {name: value for name, value in normalize_profile(profile).items() if name in PROFILE_COLUMNS}
     except Exception as e:
         print(f"❌ Erreur lors de la récupération du profil de '{handle}' : {e}")
         return pd.DataFrame()
 
     # 4. Récupération des posts
     posts = []
+    collected = 0
     cursor = None
     print(f"Récupération des posts pour l'utilisateur '{handle}' avec une limite de {limit}...")
 
     try:
-        while len(posts) < limit:
+        while collected < limit:
             resp = client.app.bsky.feed.get_author_feed({
                 'actor': handle,
-                'limit': min(100, limit - len(posts)),
+                'limit': min(100, limit - collected),
                 'cursor': cursor
             })
 
@@ -171,23 +130,10 @@ def collect_user_posts_to_dataframe(profile_url: str, limit: int) -> pd.DataFram
                 print("Plus de posts disponibles pour cet utilisateur.\n")
                 break
 
-            for item in batch:
-                post = item.post
-                record = post.record
-
-                post_data = {
-                    **user_data, # Inclut les données de l'utilisateur dans chaque post
-                    'post_uri': post.uri,
-                    'post_url': f"https://bsky.app/profile/{handle}/post/{post.uri.split('/')[-1]}",
-                    'post_text': getattr(record, 'text', '').replace('\n', ' ').strip(),
-                    'post_created_at': getattr(record, 'created_at', ''),
-                    'post_indexed_at': getattr(post, 'indexed_at', ''),
-                    'like_count': getattr(post, 'like_count', 0),
-                    'repost_count': getattr(post, 'repost_count', 0),
-                    'reply_count': getattr(post, 'reply_count', 0),
-                    'collected_at': datetime.utcnow().isoformat() + 'Z',
-                }
-                posts.append(post_data)
+            # Les données de l'utilisateur sont incluses dans chaque post
+            page = normalize_post_views(item.post for item in batch).assign(**user_data)
+            posts.append(page)
+            collected += len(page)
 
             cursor = getattr(resp, 'cursor', None)
             if not cursor:
@@ -198,7 +144,7 @@ def collect_user_posts_to_dataframe(profile_url: str, limit: int) -> pd.DataFram
 
     # 5. Conversion en DataFrame et retour
     if posts:
-        df = pd.DataFrame(posts)
+        df = PostBatch.concat(posts).to_pandas()
         print(f"✅ Collecte terminée. {len(df)} posts prêts pour le DataFrame.")
         return df
     else:
@@ -237,11 +183,8 @@ def collect_single_post_to_dataframe(post_url: str) -> pd.DataFrame:
     print(f"Handle extrait : {handle}, ID du post extrait : {post_id}")
 
     # 2. Connexion au client Bluesky
-    client = Client(base_url="https://bsky.social")
     try:
-        print(f"Tentative de connexion à Bluesky pour {BLUESKY_IDENTIFIER}...")
-        client.login(BLUESKY_IDENTIFIER, BLUESKY_APP_PASSWORD)
-        print("Connexion réussie !\n")
+        client = get_client(BLUESKY_IDENTIFIER, BLUESKY_APP_PASSWORD)
     except Exception as e:
         print(f"❌ Erreur de connexion à Bluesky : {e}")
         return pd.DataFrame()
@@ -263,29 +206,14 @@ def collect_single_post_to_dataframe(post_url: str) -> pd.DataFrame:
     # 5. Récupération du post via son URI
     try:
         post_thread = client.app.bsky.feed.get_post_thread({'uri': uri})
-        post = post_thread.thread.post
-        record = post.record
-
-        post_data = {
-            'username': handle,
-            'user_id': did,
-            'post_uri': post.uri,
-            'post_cid': post.cid,
-            'post_text': getattr(record, 'text', '').replace('\n', ' ').strip(),
-            'post_created_at': getattr(record, 'created_at', ''),
-            'post_indexed_at': getattr(post, 'indexed_at', ''),
-            'like_count': getattr(post, 'like_count', 0),
-            'repost_count': getattr(post, 'repost_count', 0),
-            'reply_count': getattr(post, 'reply_count', 0),
-            'collected_at': datetime.utcnow().isoformat() + 'Z',
-        }
+        page = normalize_post_views([post_thread.thread.post])
         print("✅ Post récupéré avec succès.")
     except Exception as e:
         print(f"❌ Erreur lors de la récupération du post '{post_url}' : {e}")
         return pd.DataFrame()
 
     # 6. Conversion en DataFrame et retour
-    df = pd.DataFrame([post_data]) # Créer un DataFrame à partir d'une liste contenant un seul dictionnaire
+    df = page.to_pandas()
     return df
 
 
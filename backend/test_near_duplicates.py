@@ -0,0 +1,60 @@
+import numpy as np
+from near_duplicates import LshIndex, signature, NEAR_DUP_PERMUTATIONS, NEAR_DUP_THRESHOLD
+
+# Signatures MinHash et seuil de rapprochement de l'index LSH, sans base de données.
+
+TEXT = ("Le gouvernement cache la vérité sur les effets secondaires du vaccin, partagez ce message "
+        "avant qu'il soit supprimé, vos proches doivent savoir ce qui se passe vraiment dans les hôpitaux")
+VARIANT = TEXT.replace("vos proches", "vos amis")
+OTHER = ("Très belle randonnée ce matin dans les Alpes, le lac était gelé et la lumière magnifique "
+         "sur les sommets, on y retourne le week-end prochain avec toute la famille")
+
+
+def similarity(a, b):
+    return np.count_nonzero(a == b) / NEAR_DUP_PERMUTATIONS
+
+
+def test_signature_is_stable_and_ignores_case_and_spacing():
+    sig = signature(TEXT)
+    assert sig.shape == (NEAR_DUP_PERMUTATIONS,) and sig.dtype == np.uint32
+    assert np.array_equal(sig, signature("  " + TEXT.upper().replace(" ", "   ")))
+
+
+def test_short_texts_have_no_signature():
+    assert signature("merci !") is None
+    assert signature("") is None
+    assert signature(None) is None
+
+
+def test_variant_matches_above_threshold_and_unrelated_text_does_not():
+    index = LshIndex()
+    index.add(1, signature(TEXT))
+    index.add(2, signature(OTHER))
+
+    assert index.match(signature(TEXT)) == (1, 1.0)
+    cluster_id, score = index.match(signature(VARIANT))
+    assert cluster_id == 1
+    assert score == similarity(signature(TEXT), signature(VARIANT)) >= NEAR_DUP_THRESHOLD
+    assert similarity(signature(TEXT), signature(OTHER)) < NEAR_DUP_THRESHOLD
+    assert LshIndex().match(signature(OTHER)) is None
+
+
+def test_threshold_is_applied_to_estimated_similarity():
+    index = LshIndex()
+    index.add(1, signature(TEXT))
+    score = similarity(signature(TEXT), signature(VARIANT))
+    assert index.match(signature(VARIANT), threshold=score) == (1, score)
+    assert index.match(signature(VARIANT), threshold=score + 1 / NEAR_DUP_PERMUTATIONS) is None
+
+
+def test_match_finds_clusters_before_and_after_merge(monkeypatch):
+    monkeypatch.setattr(LshIndex, "MERGE_EVERY", 3)
+    index = LshIndex()
+    texts = [f"{TEXT} (copie numéro {i})" for i in range(4)] + [OTHER]
+    for cluster_id, text in enumerate(texts, start=10):
+        index.add(cluster_id, signature(text))
+    # Les 3 premiers ajouts sont fusionnés dans les tableaux triés, les suivants sont récents
+    assert len(index) == 5 and index._pending_rows == [3, 4]
+    assert index.match(signature(OTHER)) == (14, 1.0)
+    assert index.match(signature(texts[0]))[0] in range(10, 14)
+    assert index.match(signature(texts[0]), threshold=1.0) == (10, 1.0)
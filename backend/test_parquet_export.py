@@ -0,0 +1,70 @@
+import json
+import os
+from datetime import datetime, timezone
+import pyarrow.parquet as pq
+import parquet_export
+from parquet_export import PartitionedParquetWriter, NULL_PARTITION
+
+# Règles de mise en tampon et d'écriture de l'export Parquet partitionné, sans base de données.
+
+
+def batch(writer, *posts):
+    rows = [(uri, datetime.fromisoformat(created).replace(tzinfo=timezone.utc) if created else None)
+            for uri, created in posts]
+    return parquet_export._rows_to_batch(writer.schema, ["post_uri", "created_at_post"], rows)
+
+
+def buffered(writer):
+    return {key: rows for key, rows in writer._buffered_rows.items() if rows}
+
+
+def test_partition_is_written_once_its_source_moves_past_it(tmp_path):
+    writer = PartitionedParquetWriter(str(tmp_path), row_group_rows=100)
+    writer.write("search", batch(writer, ("s1", "2024-05-30"), ("s2", "2024-05-31")))
+    writer.write("user", batch(writer, ("u1", "2024-05-01")))
+    assert buffered(writer) == {("search", "2024-05"): 2, ("user", "2024-05"): 1}
+
+    # Lot "search" de juin : mai est terminé pour search, pas pour user
+    writer.write("search", batch(writer, ("s3", "2024-06-01")))
+    assert buffered(writer) == {("search", "2024-06"): 1, ("user", "2024-05"): 1}
+    assert list(writer._writers) == [("search", "2024-05")]
+
+
+def test_full_row_group_is_written_immediately(tmp_path):
+    writer = PartitionedParquetWriter(str(tmp_path), row_group_rows=3)
+    writer.write("search", batch(writer, ("s1", "2024-05-01"), ("s2", "2024-05-02")))
+    assert buffered(writer) == {("search", "2024-05"): 2}
+    writer.write("search", batch(writer, ("s3", "2024-05-03")))
+    assert buffered(writer) == {}
+    assert list(writer._writers) == [("search", "2024-05")]
+
+
+def test_buffer_cap_writes_the_largest_partition(tmp_path):
+    writer = PartitionedParquetWriter(str(tmp_path), row_group_rows=100, max_buffered_rows=4)
+    writer.write("search", batch(writer, ("s1", "2024-05-01"), ("s2", "2024-05-02"), ("s3", "2024-05-03")))
+    writer.write("user", batch(writer, ("u1", "2024-01-01")))
+    assert buffered(writer) == {("search", "2024-05"): 3, ("user", "2024-01"): 1}
+    writer.write("single", batch(writer, ("p1", "2024-02-01")))
+    assert buffered(writer) == {("user", "2024-01"): 1, ("single", "2024-02"): 1}
+
+
+def test_close_writes_partitions_and_manifest(tmp_path):
+    writer = PartitionedParquetWriter(str(tmp_path), row_group_rows=100, max_open_files=1)
+    writer.write("search", batch(writer, ("s1", "2024-05-01"), ("s0", None)))
+    writer.write("search", batch(writer, ("s2", "2024-06-01")))
+    writer.write("user", batch(writer, ("u1", "2024-06-15")))
+    manifest = writer.close()
+
+    paths = [f["path"] for f in manifest["files"]]
+    assert paths == [
+        "source=search/created_month=2024-05/part-00000.parquet",
+        "source=search/created_month=2024-06/part-00000.parquet",
+        f"source=search/created_month={NULL_PARTITION}/part-00000.parquet",
+        "source=user/created_month=2024-06/part-00000.parquet",
+    ]
+    assert manifest["rows"] == 4
+    assert json.load(open(tmp_path / "_manifest.json"))["files"] == manifest["files"]
+    assert not [name for _, _, names in os.walk(tmp_path) for name in names if name.endswith(".tmp")]
+    table = pq.read_table(tmp_path / paths[0])
+    assert table.schema == writer.schema
+    assert table.column("post_uri").to_pylist() == ["s1"]
@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+import post_search
+
+# Régression : avec plusieurs sources, une table très active ne doit pas masquer ses
+# correspondances plus anciennes que sa fenêtre récente (SEARCH_RECENT_WINDOW), et les posts
+# sans date de création restent trouvables.
+
+START = datetime(2024, 6, 1, tzinfo=timezone.utc)
+
+
+def post(source, i, minutes, text):
+    created = START + timedelta(minutes=minutes) if minutes is not None else None
+    return {"post_uri": f"at://{source}/{i:06d}", "text": text, "created_at_post": created, "source": source}
+
+
+# Même sémantique que les sous-requêtes SQL de _source_query, sur des listes en mémoire
+def fake_fetch(tables):
+    def fetch(source, filters, limit, strategy):
+        rows = [row for row in tables[source] if (row["created_at_post"] is None) == bool(filters.get("undated"))]
+        if filters.get("undated"):
+            if filters.get("cursor_post_uri"):
+                rows = [row for row in rows if row["post_uri"] < filters["cursor_post_uri"]]
+        elif filters.get("cursor_created_at"):
+            cursor = (filters["cursor_created_at"], filters["cursor_post_uri"])
+            rows = [row for row in rows if (row["created_at_post"], row["post_uri"]) < cursor]
+        rows.sort(key=lambda row: (row["created_at_post"], row["post_uri"]), reverse=True)
+        if filters.get("q") and strategy == "recent":
+            rows = rows[:post_search.SEARCH_RECENT_WINDOW]
+        if filters.get("q"):
+            rows = [row for row in rows if filters["q"] in row["text"]]
+        return rows[:limit]
+    return fetch
+
+
+@pytest.fixture
+def tables(monkeypatch):
+    # "search" : très active, ses correspondances sont sous sa fenêtre récente ;
+    # "user" : peu de posts, presque tous correspondants et plus anciens
+    tables = {
+        "search": [post("search", i, 1000 + i, "bruit") for i in range(200)]
+                  + [post("search", 1000 + i, 500 + i, "vaccin") for i in range(5)],
+        "user": [post("user", i, i, "vaccin") for i in range(30)]
+                + [post("user", 100 + i, None, "vaccin") for i in range(3)],
+    }
+    monkeypatch.setattr(post_search, "SEARCH_RECENT_WINDOW", 50)
+    monkeypatch.setattr(post_search, "check_search_schema", lambda sources: None)
+    monkeypatch.setattr(post_search, "_fetch", fake_fetch(tables))
+    return tables
+
+
+def all_pages(**kwargs):
+    uris, cursor = [], None
+    while True:
+        page = post_search.search_posts(cursor=cursor, **kwargs)
+        uris += [row["post_uri"] for row in page["items"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return uris
+
+
+def test_busy_source_matches_below_its_window_are_not_skipped(tables):
+    uris = all_pages(q="vaccin", sources=["search", "user"], limit=4)
+    dated = sorted((row for rows in tables.values() for row in rows
+                    if "vaccin" in row["text"] and row["created_at_post"] is not None),
+                   key=lambda row: (row["created_at_post"], row["post_uri"]), reverse=True)
+    undated = sorted((row["post_uri"] for row in tables["user"] if row["created_at_post"] is None), reverse=True)
+    assert uris == [row["post_uri"] for row in dated] + undated
+
+
+def test_posts_without_date_are_excluded_only_by_date_filters(tables):
+    assert len(all_pages(sources=["user"], limit=7)) == 33
+    assert len(all_pages(sources=["user"], since=START, limit=7)) == 30
+
+
+def test_cursor_round_trip():
+    created = START + timedelta(seconds=1.5)
+    assert post_search.decode_cursor(post_search.encode_cursor(created, "at://a/1")) == (created, "at://a/1")
+    assert post_search.decode_cursor(post_search.encode_cursor(None, "at://a/1")) == (None, "at://a/1")
+    with pytest.raises(ValueError):
+        post_search.decode_cursor("pas un curseur")
+
+
+def test_posts_sharing_a_date_across_sources_are_paged_by_uri(monkeypatch):
+    tables = {
+        "search": [post("search", i, 10, "vaccin") for i in range(3)],
+        "single": [post("single", i, 10, "vaccin") for i in range(2)] + [post("single", 9, 5, "vaccin")],
+    }
+    monkeypatch.setattr(post_search, "check_search_schema", lambda sources: None)
+    monkeypatch.setattr(post_search, "_fetch", fake_fetch(tables))
+    uris = all_pages(sources=["search", "single"], limit=2)
+    assert uris == ["at://single/000001", "at://single/000000", "at://search/000002",
+                    "at://search/000001", "at://search/000000", "at://single/000009"]
@@ -0,0 +1,318 @@
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import uuid
+from itertools import chain
+import numpy as np
+
+# Cache disque des identifiants de tokens par post : textes nettoyés (clean_tweets) puis
+# tokenisés en lot par le tokenizer rapide, une seule fois par (post, version du tokenizer).
+# Les rescorings (prediction_backfill) et les ré-entraînements relisent ces tableaux au
+# lieu de re-nettoyer et re-tokeniser les mêmes posts (un post Bluesky n'est pas modifiable).
+# Format, dans TOKEN_CACHE_DIR/<version>/ : des segments (append-only) de trois fichiers .npy
+# lus par mmap :
+# - uris.npy    : post_uri triés (octets, largeur fixe) -> recherche dichotomique ;
+# - offsets.npy : début des tokens de chaque post dans ids.npy (int64, n + 1 valeurs) ;
+# - ids.npy     : tokens concaténés sans padding (uint16 si le vocabulaire le permet).
+# Le masque d'attention se déduit des longueurs (1 sur les tokens, 0 sur le padding).
+# La version combine le hash des fichiers du tokenizer, max_length et CLEANING_VERSION :
+# changer l'un des trois crée un nouveau répertoire, l'ancien reste lisible. Elle est calculée
+# une fois par processus (au premier get_token_cache pour un max_length).
+# La fusion des segments (compact) est réservée à un seul processus / thread à la fois par un
+# verrou fichier ; un lecteur qui voit disparaître un segment fusionné relit la liste.
+
+TOKEN_CACHE_DIR = os.getenv("TOKEN_CACHE_DIR", "./token_cache")
+# Au-delà de ce nombre de segments, les plus petits sont fusionnés
+TOKEN_CACHE_MAX_SEGMENTS = int(os.getenv("TOKEN_CACHE_MAX_SEGMENTS", "32"))
+LOAD_SEGMENTS_ATTEMPTS = 3
+TOKENIZER_FILES = [
+    "tokenizer.json", "tokenizer_config.json", "vocab.txt",
+    "special_tokens_map.json", "added_tokens.json",
+]
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def tokenizer_version(model_path, max_length):
+    from bert_finetune import CLEANING_VERSION
+    digest = hashlib.sha256()
+    for name in TOKENIZER_FILES:
+        path = os.path.join(model_path, name)
+        if os.path.exists(path):
+            digest.update(name.encode("utf-8"))
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    digest.update(f"max_length={max_length}|cleaning={CLEANING_VERSION}".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+class _Segment:
+    def __init__(self, path):
+        self.path = path
+        self.uris = np.load(os.path.join(path, "uris.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.uris)
+
+    # Ligne de chaque URI demandée dans ce segment (-1 si absente)
+    def find(self, keys):
+        if not len(self.uris):
+            return np.full(len(keys), -1)
+        positions = np.searchsorted(self.uris, keys)
+        positions = np.minimum(positions, len(self.uris) - 1)
+        return np.where(self.uris[positions] == keys, positions, -1)
+
+
+class TokenCache:
+    def __init__(self, tokenizer, version, max_length=128, directory=TOKEN_CACHE_DIR):
+        self.tokenizer = tokenizer
+        self.version = version
+        self.max_length = max_length
+        self.directory = os.path.join(directory, version)
+        self.dtype = np.uint16 if len(tokenizer) <= np.iinfo(np.uint16).max else np.int32
+        self._segments = {}
+        self._lock = threading.Lock()
+
+    # Segments présents sur disque. Un segment supprimé par une fusion entre la lecture du
+    # répertoire et son ouverture est ignoré, et la liste relue (le segment fusionné, écrit
+    # avant la suppression, y figure alors).
+    def _load_segments(self):
+        for attempt in range(LOAD_SEGMENTS_ATTEMPTS):
+            try:
+                names = sorted(name for name in os.listdir(self.directory) if name.startswith("segment-"))
+            except FileNotFoundError:
+                return []
+            vanished = False
+            with self._lock:
+                for name in names:
+                    if name not in self._segments:
+                        try:
+                            self._segments[name] = _Segment(os.path.join(self.directory, name))
+                        except FileNotFoundError:
+                            vanished = True
+                for name in list(self._segments):
+                    if name not in names:
+                        del self._segments[name]
+                if not vanished or attempt == LOAD_SEGMENTS_ATTEMPTS - 1:
+                    return [self._segments[name] for name in names if name in self._segments]
+
+    # Pour chaque URI : (segment, ligne) si en cache, sinon None
+    def _locate(self, post_uris):
+        keys = np.array([uri.encode("utf-8") for uri in post_uris], dtype=bytes)
+        found = [None] * len(post_uris)
+        if not len(keys):
+            return found
+        for segment in self._load_segments():
+            rows = segment.find(keys)
+            for i in np.flatnonzero(rows >= 0):
+                if found[i] is None:
+                    found[i] = (segment, int(rows[i]))
+        return found
+
+    # Tokens (tableau int64 sans padding) de chaque post, None si absent du cache
+    def get(self, post_uris):
+        results = []
+        for location in self._locate(post_uris):
+            if location is None:
+                results.append(None)
+            else:
+                segment, row = location
+                results.append(np.asarray(segment.ids[segment.offsets[row]:segment.offsets[row + 1]], dtype=np.int64))
+        return results
+
+    # Tokenise les textes nettoyés en un appel (tokenizer rapide, sans padding) et les enregistre
+    def add(self, post_uris, cleaned_texts):
+        encoded = self.tokenizer(
+            list(cleaned_texts),
+            add_special_tokens=True,
+            max_length=self.max_length,
+            truncation=True,
+        )["input_ids"]
+        self._write_segment(post_uris, encoded)
+        return encoded
+
+    # Tokens de tous les posts : lus dans le cache, ou tokenisés puis ajoutés au cache
+    def encode_posts(self, post_uris, cleaned_texts):
+        results = self.get(post_uris)
+        missing = {}
+        for i, tokens in enumerate(results):
+            if tokens is None:
+                missing.setdefault(post_uris[i], i)
+        if missing:
+            indices = list(missing.values())
+            encoded = self.add(list(missing), [cleaned_texts[i] for i in indices])
+            by_uri = dict(zip(missing, encoded))
+            for i, tokens in enumerate(results):
+                if tokens is None:
+                    results[i] = np.asarray(by_uri[post_uris[i]], dtype=np.int64)
+        return results
+
+    # Matrices (n, longueur max) prêtes pour l'entraînement : input_ids et attention_mask
+    def training_arrays(self, post_uris, cleaned_texts=None, pad_token_id=None):
+        if cleaned_texts is None:
+            tokens = self.get(post_uris)
+            if any(t is None for t in tokens):
+                raise KeyError("Posts absents du cache de tokens : fournissez cleaned_texts")
+        else:
+            tokens = self.encode_posts(post_uris, cleaned_texts)
+        longest = max((len(t) for t in tokens), default=0)
+        pad = self.tokenizer.pad_token_id if pad_token_id is None else pad_token_id
+        input_ids = np.full((len(tokens), longest), pad, dtype=np.int64)
+        attention_mask = np.zeros((len(tokens), longest), dtype=np.int64)
+        for row, t in enumerate(tokens):
+            input_ids[row, :len(t)] = t
+            attention_mask[row, :len(t)] = 1
+        return input_ids, attention_mask
+
+    def _write_segment(self, post_uris, encoded):
+        if not len(post_uris):
+            return
+        keys = np.array([uri.encode("utf-8") for uri in post_uris], dtype=bytes)
+        order = np.argsort(keys, kind="stable")
+        lengths = np.fromiter((len(encoded[i]) for i in order), dtype=np.int64, count=len(order))
+        offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        ids = np.fromiter(chain.from_iterable(encoded[i] for i in order), dtype=self.dtype, count=int(offsets[-1]))
+        self._save(keys[order], offsets, ids)
+        if len(self._load_segments()) > TOKEN_CACHE_MAX_SEGMENTS:
+            # Fusion déjà en cours ailleurs : rien à faire ici, l'écriture n'attend pas
+            self.compact(wait=False)
+
+    # Écrit un segment dans un répertoire temporaire puis le renomme (jamais de segment partiel)
+    def _save(self, keys, offsets, ids):
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"segment-{np.datetime64('now', 'us').astype(np.int64):017d}-{uuid.uuid4().hex[:8]}"
+        tmp_path = os.path.join(self.directory, f".tmp-{name}")
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, "uris.npy"), keys)
+        np.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+        np.save(os.path.join(tmp_path, "ids.npy"), ids)
+        os.rename(tmp_path, os.path.join(self.directory, name))
+        return name
+
+    # Fusionne les plus petits segments (la moitié) en un seul ; compact(full=True) : tous.
+    # Sous verrou exclusif (fichier .compact.lock) : wait=False abandonne si une autre fusion
+    # est en cours. Renvoie False dans ce cas.
+    def compact(self, full=False, wait=True):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".compact.lock"), "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+            except BlockingIOError:
+                return False
+            self._compact(full)
+        return True
+
+    def _compact(self, full):
+        # Liste relue sous le verrou : une fusion précédente a pu supprimer des segments
+        segments = sorted(self._load_segments(), key=len)
+        selected = segments if full else segments[:max(2, len(segments) // 2)]
+        if len(selected) < 2:
+            return
+        keys = np.concatenate([segment.uris.astype(bytes) for segment in selected])
+        keys, first = np.unique(keys, return_index=True)
+        sources = [(segment, row) for segment in selected for row in range(len(segment))]
+        chosen = [sources[i] for i in first]
+        lengths = np.fromiter((s.offsets[r + 1] - s.offsets[r] for s, r in chosen), dtype=np.int64, count=len(chosen))
+        offsets = np.zeros(len(chosen) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        ids = np.empty(int(offsets[-1]), dtype=self.dtype)
+        for (segment, row), start, end in zip(chosen, offsets[:-1], offsets[1:]):
+            ids[start:end] = segment.ids[segment.offsets[row]:segment.offsets[row + 1]]
+        self._save(keys, offsets, ids)
+        for segment in selected:
+            shutil.rmtree(segment.path, ignore_errors=True)
+        self._load_segments()
+
+    def stats(self):
+        segments = self._load_segments()
+        return {
+            "version": self.version,
+            "directory": self.directory,
+            "segments": len(segments),
+            "posts": sum(len(segment) for segment in segments),
+            "tokens": sum(int(segment.offsets[-1]) for segment in segments),
+            "bytes": sum(
+                os.path.getsize(os.path.join(segment.path, name))
+                for segment in segments for name in ("uris.npy", "offsets.npy", "ids.npy")
+            ),
+        }
+
+
+# Cache du tokenizer du modèle fake news, un par max_length (le tokenizer seul est chargé :
+# avec le pool d'inférence, le modèle n'est pas dans ce processus). La version (hash des
+# fichiers du tokenizer) n'est calculée qu'à la création, pas à chaque appel.
+def get_token_cache(max_length=128):
+    cache = _caches.get(max_length)
+    if cache is not None:
+        return cache
+    from transformers import AutoTokenizer
+    from bert_finetune import MODEL_PATH
+    with _caches_lock:
+        if max_length not in _caches:
+            version = tokenizer_version(MODEL_PATH, max_length)
+            _caches[max_length] = TokenCache(AutoTokenizer.from_pretrained(MODEL_PATH), version, max_length)
+        return _caches[max_length]
+
+
+# Pré-remplit le cache pour les posts stockés (parcours par clé, comme le rattrapage)
+def build(sources=None, chunk_size=2048, max_length=128):
+    from psycopg import sql
+    from db import get_connection
+    from post_search import SOURCES
+    from bert_finetune import clean_tweets
+    cache = get_token_cache(max_length)
+    total = 0
+    for source in sources or list(SOURCES):
+        table, columns = SOURCES[source]
+        text = next(column for column, canonical in columns.items() if canonical == "text")
+        query = sql.SQL(
+            "SELECT post_uri, {text} FROM {table} WHERE post_uri > %s ORDER BY post_uri LIMIT %s"
+        ).format(text=sql.Identifier(text), table=sql.Identifier(table))
+        last_post_uri = ""
+        added = 0
+        while True:
+            with get_connection() as conn:
+                rows = conn.execute(query, (last_post_uri, chunk_size)).fetchall()
+            if not rows:
+                break
+            post_uris = [post_uri for post_uri, _ in rows]
+            known = cache.get(post_uris)
+            missing = [i for i, tokens in enumerate(known) if tokens is None]
+            if missing:
+                cache.add([post_uris[i] for i in missing], clean_tweets([rows[i][1] or "" for i in missing]))
+                added += len(missing)
+            last_post_uri = post_uris[-1]
+        total += added
+        print(f"✅ {added} post(s) tokenisé(s) et mis en cache pour {source}.")
+    cache.compact(full=True)
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cache disque des tokens des posts stockés")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build_parser = sub.add_parser("build", help="Tokenise les posts absents du cache")
+    build_parser.add_argument("--source", nargs="+", choices=["search", "user", "single"])
+    build_parser.add_argument("--chunk-size", type=int, default=2048)
+    sub.add_parser("compact", help="Fusionne tous les segments")
+    sub.add_parser("stats", help="Taille du cache pour la version courante du tokenizer")
+
+    args = parser.parse_args(argv)
+    if args.command == "build":
+        build(args.source, args.chunk_size)
+    elif args.command == "compact":
+        get_token_cache().compact(full=True)
+    print(json.dumps(get_token_cache().stats(), indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())